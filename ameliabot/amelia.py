@@ -1,4 +1,5 @@
 from importlib import import_module
+from collections import deque
 from itertools import *
 from socket import *
 import time
@@ -15,9 +16,75 @@ RPL_WELCOME         = '001'
 RPL_ISUPPORT        = '005'
 ERR_NICKNAMEINUSE   = '433'
 
+# The number of plugins named in the report printed after loading plugins.
+STARTUP_REPORT_PLUGINS = 5
+
+# Commands which are sent before any other queued lines.
+PRIORITY_COMMANDS = 'PONG', 'PING'
+
+# Commands which are queued with lines sent to the channel named by their first
+# parameter, so that they are not reordered with respect to those lines.
+CHANNEL_COMMANDS = 'JOIN', 'PART', 'KICK', 'MODE', 'TOPIC'
+
+# Commands which are not sent until all lines queued before them have been sent,
+# and before which no line queued after them is sent.
+BARRIER_COMMANDS = 'NICK', 'QUIT', 'JOIN'
+
+PRIVMSG_RE = re.compile(r'PRIVMSG (?P<target>\S+) :(?P<msg>.*)')
+
+# The maximum length of an IRC line, excluding the terminating CR LF.
+MAX_LINE_LEN = 510
+
+# The maximum length of a hostname, as assumed when reserving room for the
+# prefix which the server adds to the bot's messages when relaying them.
+MAX_HOST_LEN = 63
+
+# The text placed between messages merged by the `coalesce' option.
+COALESCE_SEP = ' | '
+
+# When several networks are configured, channels on any network other than the
+# primary one are known to plugins by network-qualified names of the form
+# '#CHANNEL:NETWORK', which cannot be confused with real channel names, as IRC
+# channel names may not contain ':'. Lines sent to such channels are forwarded
+# to the bot connected to the relevant network.
+NETWORK_SEP = ':'
+
+# Commands whose final parameter may be a channel name.
+TRAILING_CHANNEL_COMMANDS = 'JOIN', 'PART', 'INVITE', '341'
+
+# networks[name] is the AmeliaBot connected to the network with the given
+# (lowercase) name, where the primary network is named None.
+networks = dict()
+
+# Returns (chan, network) for the given possibly network-qualified channel name,
+# where `network' is the lowercase name of its network, or None.
+def split_network(chan):
+    name, sep, network = chan.partition(NETWORK_SEP)
+    return (name, network.lower()) if sep else (chan, None)
+
+# The AmeliaBot connected to the network of the given possibly network-qualified
+# channel name, or None if there is no such bot.
+def chan_bot(chan):
+    return networks.get(split_network(chan)[1])
+
 class NotInstalled(Exception): pass
 class AlreadyInstalled(Exception): pass
 
+# A sliding window permitting no more than `lines' lines to be sent in any
+# period of `seconds' seconds, by recording the times of the last `lines' lines.
+class SendWindow(object):
+    __slots__ = 'seconds', 'times'
+    def __init__(self, seconds, lines):
+        self.seconds = seconds
+        self.times = deque(maxlen=max(int(lines), 1))
+
+    def ready(self, now):
+        return len(self.times) < self.times.maxlen \
+            or now - self.times[0] >= self.seconds
+
+    def record(self, now):
+        self.times.append(now)
+
 default_conf = {
     'server':        'irc.freenode.net',
     'port':          6667,
@@ -29,7 +96,10 @@ default_conf = {
     'plugins':       [],
     'timeout':       180, # 180s = 3m
     'bang_cmd':      True,
-    'flood_limits':  [(40,20), (0.5,1)]
+    'flood_limits':  [(40,20), (0.5,1)],
+    'startup_report': True,
+    'workers':       0,
+    'network':       None
 }
 
 class AmeliaBot(Mac):
@@ -37,6 +107,10 @@ class AmeliaBot(Mac):
         # Load configuration
         self.conf = default_conf.copy()
         if conf: self.conf.update(conf)
+        self.network = self.conf['network'] and self.conf['network'].lower()
+        if self.network in networks:
+            raise ValueError('Duplicate network name: %r.' % self.network)
+        networks[self.network] = self
 
         # Initialise socket
         sock = socket(AF_INET, SOCK_STREAM)
@@ -51,12 +125,26 @@ class AmeliaBot(Mac):
             'PREFIX':    ('ohv','@%+'),
             'CHANMODES': ('be','k','l','') }
         self.closing = False
+        self.plugin_times = dict()
 
-        # Initialise flood-protection system
-        self.send_times = []
-        self.flood_buffer = []
-        self.deferred_buffer = []
-        self.flood_active = False
+        # Initialise flood-protection system. Outgoing lines are queued
+        # separately for each target or channel they name (or under None, for
+        # other lines), and the queues are served in round-robin order, except
+        # that priority lines are always sent first. A line naming several
+        # targets is held in each of their queues, and is sent only when it is
+        # at the front of all of them. Each line is numbered in the order it was
+        # queued, and the numbers of queued barrier lines are held in order in
+        # `send_barriers', so that lines are not reordered across them.
+        self.send_windows = [SendWindow(s, l)
+                             for (s, l) in self.conf['flood_limits']]
+        self.send_queues = dict()
+        self.send_order = deque()
+        self.send_priority = deque()
+        self.send_barriers = deque()
+        self.send_seq = 0
+        self.send_queued = 0
+        self.send_stats = {
+            'sent': 0, 'throttled': 0, 'max_queued': 0, 'coalesced': 0}
 
         # Initialise events
         std.install(self)
@@ -76,17 +164,37 @@ class AmeliaBot(Mac):
         self.send_cmd('NICK %s' % self.nick)
         self.send_cmd('USER %(user)s %(host)s %(server)s :%(name)s' % self.conf) 
 
+    # Imports and installs each configured plugin, recording in plugin_times
+    # the time in seconds taken to import and to install each one.
     def load_plugins(self):
         loaded_plugins = []
         for name in self.conf['plugins']:
+            start = time.time()
             plugin = import_module(name)
-            loaded_plugins.append(plugin)
+            self.plugin_times[name] = [time.time() - start, 0.0]
+            loaded_plugins.append((name, plugin))
 
-        for plugin in loaded_plugins:
+        for name, plugin in loaded_plugins:
+            start = time.time()
             try:
                 plugin.install(self)
             except AlreadyInstalled:
                 pass
+            self.plugin_times[name][1] = time.time() - start
+
+        if self.conf['startup_report']:
+            print '%s Loaded %d plugins in %.3fs; slowest: %s.' % (
+                time.strftime('%H:%M:%S'), len(loaded_plugins),
+                sum(imap(sum, self.plugin_times.itervalues())),
+                ', '.join('%s (%.3fs)' % (name, sum(times)) for (name, times)
+                          in self.slowest_plugins(STARTUP_REPORT_PLUGINS)))
+
+    # A list of up to `count' (name, [import_s, install_s]) pairs for the
+    # plugins which took the longest time to load, slowest first.
+    def slowest_plugins(self, count=None):
+        plugins = sorted(self.plugin_times.iteritems(),
+                         key=lambda (n, ts): sum(ts), reverse=True)
+        return plugins[:count]
 
     def h_err_nicknameinuse(self, bot, *args):
         self.nick += "_"
@@ -107,6 +215,10 @@ class AmeliaBot(Mac):
                 val = match.group('ms', 'ps')
             elif key == 'CHANMODES' and val:
                 val = tuple(val.split(','))
+            elif key == 'TARGMAX':
+                val = {cmd.upper(): int(n) if n else None for (cmd, _, n)
+                       in (item.partition(':') for item in (val or '').split(',')
+                           if item)}
             bot.isupport[key] = val
 
     def h_rpl_welcome(self, *args):
@@ -115,61 +227,263 @@ class AmeliaBot(Mac):
 
     def h_pre_autojoin(self, *args):
         for channel in self.conf['channels']:
-            self.send_cmd('JOIN %s' % channel)
+            self.send_cmd('JOIN %s' % self.qualify(channel))
         self.drive('AUTOJOIN', self)
 
     def mainloop(self):
         return gear.mainloop()
 
+    #---------------------------------------------------------------------------
+    # Network-qualified channel names: see NETWORK_SEP.
+
+    def is_channel(self, name):
+        return name[:1] in (self.isupport.get('CHANTYPES') or '#&')
+
+    # The name by which plugins know the given channel on this network, which
+    # is `name' itself if it is already network-qualified.
+    def qualify(self, name):
+        if self.network is None or NETWORK_SEP in name \
+        or not self.is_channel(name): return name
+        return name + NETWORK_SEP + self.network
+
+    # Qualifies each channel name among the parameters of a received message.
+    def qualify_args(self, command, args):
+        if self.network is None: return args
+        last = len(args) - (command not in TRAILING_CHANNEL_COMMANDS)
+        return tuple(
+            ','.join(self.qualify(n) for n in a.split(',')) if i < last else a
+            for (i, a) in enumerate(args))
+
+    # Returns the given outgoing line with each channel name among its
+    # parameters replaced by func(name).
+    def map_channels(self, line, func):
+        head, sep, tail = line.partition(' :')
+        words = head.split(' ')
+        map_param = lambda p: ','.join(
+            func(n) if self.is_channel(n) else n for n in p.split(','))
+        words[1:] = map(map_param, words[1:])
+        if sep and words[0].upper() in TRAILING_CHANNEL_COMMANDS:
+            tail = map_param(tail)
+        return ' '.join(words) + sep + tail
+
+    # The line to be sent to the server for the given outgoing line.
+    def unqualify_line(self, line):
+        if NETWORK_SEP not in line: return line
+        return self.map_channels(line, lambda n: split_network(n)[0])
+
+    # The lowercase name of the network to which the given outgoing line should
+    # be sent, as determined by the first channel name among its parameters.
+    def line_network(self, line):
+        found = []
+        def check(name):
+            if not found: found.append(split_network(name)[1])
+            return name
+        self.map_channels(line, check)
+        return found[0] if found else self.network
+
     def send_msg(self, target, msg, **kwds):
         self.send_line('PRIVMSG %s :%s' % (target, msg), **kwds)
         self.activity = True
+
+    # The maximum length of a line sent by the bot, such that the line is not
+    # truncated when the server relays it to other clients with the prefix
+    # ':NICK!USER@HOST ', where USER may be given an extra '~' by the server.
+    def max_line_len(self):
+        nick = getattr(self, 'nick', self.conf['nick'])
+        prefix = ':%s!~%s@ ' % (nick, self.conf['user'])
+        return MAX_LINE_LEN - len(prefix) - MAX_HOST_LEN
+
+    # Sends the same message to each of the given targets, using as few lines
+    # as the server's TARGMAX or MAXTARGETS parameter permits.
+    # Targets on other networks are passed to the bots connected to them.
+    def send_msgs(self, targets, msg, **kwds):
+        if type(msg) is unicode: msg = msg.encode('utf-8')
+        max_targets = self.max_targets('PRIVMSG')
+        max_len = self.max_line_len() - len('PRIVMSG  :') - len(msg)
+        group, others = [], dict()
+        for target in targets:
+            if self.is_channel(target):
+                network = split_network(target)[1]
+                if network != self.network and network in networks:
+                    others.setdefault(network, []).append(target)
+                    continue
+            if group and (len(group) == max_targets
+            or len(','.join(group + [target])) > max_len):
+                self.send_msg(','.join(group), msg, **kwds)
+                del group[:]
+            group.append(target)
+        if group: self.send_msg(','.join(group), msg, **kwds)
+        for network, targets in others.iteritems():
+            networks[network].send_msgs(targets, msg, **kwds)
+
+    # The maximum number of comma-separated targets the server accepts for the
+    # given command, or None if there is no limit.
+    def max_targets(self, command):
+        targmax = self.isupport.get('TARGMAX')
+        if targmax is not None:
+            return targmax.get(command.upper(), 1)
+        maxtargets = self.isupport.get('MAXTARGETS')
+        return int(maxtargets) if maxtargets else 1
     
     def send_cmd(self, cmd, **kwds):
         self.send_line(cmd, **kwds)
         self.activity = True
 
-    def send_line(self, line, defer=True, **kwds):
+    # Sends the given IRC line, subject to flood protection. If `defer' is
+    # True, the line is not sent before the next TICK event. If `priority' is
+    # True, the line is sent before any queued lines other than priority lines.
+    # If `coalesce' is True, and the line is a PRIVMSG which is still queued
+    # when it would be sent, it may be merged with following queued messages
+    # to the same target which also have `coalesce' and the same keywords.
+    # Lines addressed to channels on other networks are passed to their bots.
+    def send_line(self, line, defer=True, priority=False, **kwds):
         if type(line) is unicode:
             line = line.encode('utf-8')
+        line = line[:MAX_LINE_LEN]
+
+        if len(networks) > 1 and (self.network or NETWORK_SEP in line):
+            network = self.line_network(line)
+            if network != self.network:
+                if network in networks:
+                    networks[network].send_line(
+                        line, defer=defer, priority=priority, **kwds)
+                else:
+                    print '! no connection to network %r: %s' % (network, line)
+                return
 
-        flood_limits = self.conf['flood_limits']
+        command, _, params = line.partition(' ')
+        command = command.upper()
+        if command == 'PRIVMSG':
+            match = PRIVMSG_RE.match(line)
+            target, msg = match.group('target', 'msg') if match else (None,None)
+        elif command == 'NOTICE':
+            target, msg = params.partition(' ')[0], None
+        else:
+            target, msg = None, None
+
+        if command in CHANNEL_COMMANDS:
+            keys = params.partition(' ')[0].lower().split(',')
+        elif target is not None:
+            keys = target.lower().split(',')
+        else:
+            keys = [None]
+
+        entry = (line, target, msg, kwds)
+        if priority or command in PRIORITY_COMMANDS:
+            self.send_priority.append(entry)
+        else:
+            seq = self.send_seq
+            self.send_seq += 1
+            if command in BARRIER_COMMANDS:
+                self.send_barriers.append(seq)
+            item = (seq, keys, entry)
+            for key in keys:
+                queue = self.send_queues.get(key)
+                if queue is None:
+                    queue = self.send_queues[key] = deque()
+                    self.send_order.append(key)
+                queue.append(item)
+        self.send_queued += 1
+        if self.send_queued > self.send_stats['max_queued']:
+            self.send_stats['max_queued'] = self.send_queued
+
+        if not defer: self.send_pending()
+
+    # Sends as many queued lines as the flood limits currently permit.
+    def send_pending(self):
+        if not self.send_queued: return
         now = time.time()
-        cut = now - max(s for (s,l) in flood_limits)
-        while self.send_times and self.send_times[0] < cut:
-            del self.send_times[0]
-
-        for flood_seconds, flood_lines in flood_limits:
-            cut = now - flood_seconds
-            times = dropwhile(lambda t: t < cut, self.send_times)
-            if len(list(times)) >= flood_lines:
-                self.flood_active = True
+        while self.send_queued:
+            if not all(w.ready(now) for w in self.send_windows):
+                self.send_stats['throttled'] += 1
                 break
+            if self.send_priority:
+                entry = self.send_priority.popleft()
+            else:
+                entry = self.send_next()
+            self.send_queued -= 1
+            for window in self.send_windows:
+                window.record(now)
+            self.write_line(*entry)
 
-        if defer:
-            self.deferred_buffer.append((line, kwds))
-            self.flood_active = True
-        elif self.flood_active:
-            self.flood_buffer.append((line, kwds))
-        else:
-            self.send_times.append(now)
-            line = line[:510]
-            self.dump('%s\r\n' % line)
-            match = re.match(r'PRIVMSG (?P<target>\S+) :(?P<msg>.*)', line)
-            if match: self.drive('SEND_MSG',
-                self, match.group('target'), match.group('msg'), kwds)
+    # Removes from the queues and returns the entry of the next line to be sent
+    # in round-robin order, among those which may be sent without reordering.
+    # The earliest queued line may always be sent, so one is always found.
+    def send_next(self):
+        for i in xrange(len(self.send_order)):
+            seq, keys, entry = self.send_queues[self.send_order[0]][0]
+            if self.send_ready(seq, keys): break
+            self.send_order.rotate(-1)
+        if self.send_barriers and self.send_barriers[0] == seq:
+            self.send_barriers.popleft()
+
+        first_key = self.send_order.popleft()
+        for key in keys:
+            queue = self.send_queues[key]
+            queue.popleft()
+            if len(keys) == 1 and queue and entry[3].get('coalesce'):
+                entry = self.coalesce(entry, queue)
+            if not queue:
+                del self.send_queues[key]
+                if key != first_key: self.send_order.remove(key)
+        if first_key in self.send_queues:
+            self.send_order.append(first_key)
+        return entry
+
+    # True if the queued line numbered `seq', which is queued under each of
+    # `keys', may be sent before all other queued lines.
+    def send_ready(self, seq, keys):
+        if self.send_barriers:
+            barrier = self.send_barriers[0]
+            if barrier < seq: return False
+            if barrier == seq: return all(
+                q[0][0] >= seq for q in self.send_queues.itervalues())
+        return all(self.send_queues[k][0][0] == seq for k in keys)
+
+    # Removes from the front of `queue' any messages which may be merged with
+    # the message in `entry', and returns an entry for the merged message.
+    # Messages queued after a queued barrier line are not merged.
+    def coalesce(self, entry, queue):
+        line, target, msg, kwds = entry
+        if msg is None or msg.startswith('\1'): return entry
+        barrier = self.send_barriers[0] if self.send_barriers else None
+        msgs = [msg]
+        length, max_len = len(line), self.max_line_len()
+        while queue:
+            nseq, _, (nline, ntarget, nmsg, nkwds) = queue[0]
+            if nmsg is None or nmsg.startswith('\1') or ntarget != target \
+            or nkwds != kwds or barrier is not None and nseq > barrier: break
+            length += len(COALESCE_SEP) + len(nmsg)
+            if length > max_len: break
+            queue.popleft()
+            self.send_queued -= 1
+            self.send_stats['coalesced'] += 1
+            msgs.append(nmsg)
+        if len(msgs) == 1: return entry
+        line = 'PRIVMSG %s :%s' % (target, COALESCE_SEP.join(msgs))
+        return (line, target, msgs, kwds)
+
+    # `msg' is None, a message, or a list of messages merged into this line,
+    # and `target' may contain several comma-separated targets.
+    def write_line(self, line, target, msg, kwds):
+        self.dump('%s\r\n' % self.unqualify_line(line))
+        self.send_stats['sent'] += 1
+        if msg is None: return
+        msgs = msg if type(msg) is list else (msg,)
+        for target in target.split(','):
+            for msg in msgs:
+                self.drive('SEND_MSG', self, target, msg, kwds)
+
+    # A dict mapping each target (or None, for non-message lines, or
+    # 'PRIORITY', for priority lines) to the number of lines queued for it.
+    def queue_depths(self):
+        depths = {k: len(q) for (k, q) in self.send_queues.iteritems()}
+        if self.send_priority:
+            depths['PRIORITY'] = len(self.send_priority)
+        return depths
 
     def h_tick(self, bot):
-        if not self.flood_active: return
-        flood_lines = self.flood_buffer
-        deferred_lines = self.deferred_buffer
-        self.flood_buffer = []
-        self.deferred_buffer = []
-        self.flood_active = False
-        for line, kwds in flood_lines:
-            self.send_line(line, defer=False, **kwds)
-        for line, kwds in deferred_lines:
-            self.send_line(line, defer=False, **kwds)
+        self.send_pending()
 
 if __name__ == '__main__':
     gear = AmeliaBot()
@@ -5,10 +5,9 @@ import time
 
 __is_local__ = True
 
-last_ping = time.time()
-ping_sent = False
-
 def install(poll):
+    poll.last_ping = time.time()
+    poll.ping_sent = False
     poll.link('PING', ping)
     poll.link(TICK, tick)
     poll.link('CLOSING', handle_close)
@@ -25,17 +24,14 @@ def ping(bot, prefix, server):
     bot.dump(reply)
 
 def found(bot, *args):
-    global last_ping
-    global ping_sent
-    last_ping = time.time()
-    ping_sent = False
+    bot.last_ping = time.time()
+    bot.ping_sent = False
 
 def tick(bot):
-    global ping_sent
-    elapsed = time.time() - last_ping
-    if elapsed > bot.conf['timeout']/2 and not ping_sent:
+    elapsed = time.time() - bot.last_ping
+    if elapsed > bot.conf['timeout']/2 and not bot.ping_sent:
         bot.dump('PING :%s\r\n' % bot.nick)
-        ping_sent = True
+        bot.ping_sent = True
     elif elapsed > bot.conf['timeout']:
         print '! ping timeout: %ss' % elapsed
         yield sign(CLOSE, bot)
@@ -17,7 +17,7 @@ def update(obj):
         yield sign(RECV_ERR, obj, excpt)
         return
     ################
-    ilog(obj.data)
+    ilog(obj, obj.data)
     if not obj.data:
         yield sign(CLOSE, obj)
     else:
@@ -33,27 +33,27 @@ def flush(obj):
         except Exception as excpt:
             yield sign(SEND_ERR, obj, excpt)
             return
-        olog(obj.queue[:size])
+        olog(obj, obj.queue[:size])
         obj.queue = obj.queue[size:]
         yield sign(DUMPED, obj)
     ##################
 
-ibuf = ''
-obuf = ''
+# The incomplete final line of the data received and sent by each object,
+# which is logged when completed, prefixed by the object's network, if any.
+ibufs = dict()
+obufs = dict()
 TERM = '\r\n'
 
-def ilog(data):
-    global ibuf
-    ibuf += data
-    ibuf = ibuf.split(TERM)
-    for line in ibuf[:-1]:
-        print '%s > %s' % (time.strftime('%H:%M:%S'), line)
-    ibuf = ibuf[-1]
-    
-def olog(data):
-    global obuf
-    obuf += data
-    obuf = obuf.split(TERM)
-    for line in obuf[:-1]:
-        print '%s < %s' % (time.strftime('%H:%M:%S'), line)
-    obuf = obuf[-1]
+def ilog(obj, data):
+    log(obj, data, ibufs, '>')
+
+def olog(obj, data):
+    log(obj, data, obufs, '<')
+
+def log(obj, data, bufs, arrow):
+    lines = (bufs.pop(obj, '') + data).split(TERM)
+    network = getattr(obj, 'network', None)
+    for line in lines[:-1]:
+        print '%s %s%s %s' % (time.strftime('%H:%M:%S'),
+            '%s ' % network if network else '', arrow, line)
+    if lines[-1]: bufs[obj] = lines[-1]
@@ -22,7 +22,8 @@ class Gear(object):
         r, w, x = [], [], []
 
         rmap = lambda obj: obj.is_read
-        wmap = lambda obj: obj.is_write or obj.queue
+        wmap = lambda obj: obj.is_write or obj.queue \
+                           or getattr(obj, 'connecting', False)
         xmap = lambda obj: obj.is_write and obj.is_read
         
         r = filter(rmap, self.rlist)
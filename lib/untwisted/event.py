@@ -20,6 +20,8 @@ DUMPED = get_event()
 RECV_ERR = get_event()
 SEND_ERR = get_event()
 TICK = get_event()
+PACKET = get_event()
+CONNECT = get_event()
 
 __all__ = [
             'get_event',
@@ -36,5 +38,7 @@ __all__ = [
             'SEND_ERR',
             'ACCEPT',
             'DUMPED',
-            'TICK'
+            'TICK',
+            'PACKET',
+            'CONNECT'
           ]
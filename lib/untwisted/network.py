@@ -25,6 +25,7 @@ from untwisted.dispatch import *
 from untwisted.magic import *
 from socket import *
 from core import gear
+import errno
 
 def default(event, child=None, *args):
     if isinstance(child, Mode):
@@ -77,6 +78,24 @@ class Work(socket):
 
         self.queue = ''
 
+        # The state of untwisted.utils.framing.
+        self.framing_buffer  = None
+        self.framing_skip    = 0
+        self.framing_inflate = None
+
+        # True while a connection started by connect_ex is in progress.
+        self.connecting = False
+
+    def connect_ex(self, address):
+        """ Starts connecting a non-blocking socket to address. When the
+            connection is made, untwisted.utils.std signals CONNECT(obj).
+            If it fails, RECV_ERR is signalled as for any other error. """
+
+        result = socket.connect_ex(self, address)
+        if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.connecting = True
+        return result
+
     def dump(self, data):
         """ If you are going to use send 
             then you can't use dump.
@@ -92,6 +111,35 @@ class Work(socket):
         for l in gear.rlist, gear.wlist, gear.xlist, gear.tick_list:
             if self in l: l.remove(self)
 
+    def register(self):
+        """ Adds this instance back to the reactor after destroy. """
+
+        for l in gear.rlist, gear.wlist, gear.xlist, gear.tick_list:
+            if self not in l: l.append(self)
+
+    def terminate(self):
+        """ Unregisters, shuts down and closes the socket, ignoring any
+            errors, as when a connection is abandoned. """
+
+        self.destroy()
+        try: self.shutdown(SHUT_RDWR)
+        except error: pass
+        try: self.close()
+        except error: pass
+
+    def transfer(self, poll):
+        """ Unregisters this instance and returns a new Work for the same
+            socket in the given poll, with the same buffered input and output,
+            as when the module handling the connection is reloaded. The
+            attributes of this instance are otherwise not copied. """
+
+        self.destroy()
+        work = Work(poll, self.sock, self.is_read, self.is_write)
+        for name in ('BLOCK', 'SIZE', 'stack', 'queue', 'framing_buffer',
+        'framing_skip', 'framing_inflate', 'connecting'):
+            setattr(work, name, getattr(self, name))
+        return work
+
 """ These are exotic names for classes.
     Howevr, the intention isn't being meaningful
     since we have docs for it.
@@ -0,0 +1,182 @@
+""" Framing of the data received by a Work into messages.
+
+    Each framer is installed in a Mode in place of untwisted.utils.common's
+    append and shrug, after untwisted.utils.std:
+
+        mode.link_module(std)
+        framer = Lines('\\n')
+        framer.install(mode)
+
+    or with util.LinkSet.link_module(framer). The data received so far by each
+    Work is kept in a Buffer, from which complete messages are read in place,
+    so that the time taken is linear in the amount of data received, however
+    it is divided between calls to recv.
+
+    The state of each framer for a Work is kept in its attributes framing_buffer,
+    framing_skip and framing_inflate, which are carried over to a new Work by
+    Work.transfer, so that a connection may be handed over to a new Mode, as
+    when a module is reloaded, without losing any partial message.
+
+    Lines signals FOUND(work, line) for each line, as shrug does.
+    LengthPrefixed signals PACKET(work, data) for each message, for protocols
+    in which each message starts with its length. Inflate wraps either of these
+    to decompress a stream compressed as a single zlib stream.
+"""
+
+from untwisted.network import sign
+from untwisted.event import *
+import struct
+import zlib
+
+class Buffer(object):
+    """ A first-in, first-out queue of bytes. Data is appended to a bytearray,
+        buf, and consumed from the front by advancing an offset, pos; the
+        consumed part is only discarded once it is at least half of the
+        array, so that each byte received is copied a bounded number of
+        times, no matter how the data is divided. Offsets given to the
+        methods below are relative to the front of the queue. """
+
+    __slots__ = 'buf', 'pos'
+
+    def __init__(self, data=''):
+        self.buf = bytearray(data)
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def append(self, data):
+        if self.pos and 2*self.pos >= len(self.buf):
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf.extend(data)
+
+    def skip(self, size):
+        """ Discards the first size bytes. """
+
+        self.pos = min(self.pos + size, len(self.buf))
+
+    def unpack(self, struct_, offset=0):
+        """ The result of struct_.unpack_from, where struct_ is a
+            struct.Struct, for the data at the given offset. """
+
+        return struct_.unpack_from(self.buf, self.pos + offset)
+
+    def get(self, start, end):
+        """ A copy of the bytes from start to end as a str. """
+
+        return memoryview(self.buf)[self.pos+start:self.pos+end].tobytes()
+
+    def view(self, start, end):
+        """ A read-only buffer referring to the bytes from start to end,
+            without copying them, for functions such as zlib.decompress
+            which do not accept a memoryview. It is only valid until the
+            next append. """
+
+        return buffer(self.buf, self.pos + start, end - start)
+
+    def find(self, sub, start=0):
+        """ The offset of the first occurrence of sub at or after start, or
+            -1 if there is none. """
+
+        index = self.buf.find(sub, self.pos + start)
+        return index - self.pos if index >= 0 else -1
+
+def get_buffer(obj):
+    """ The Buffer of data received by the Work obj, created if necessary. """
+
+    if obj.framing_buffer is None:
+        obj.framing_buffer = Buffer()
+    return obj.framing_buffer
+
+class Framer(object):
+    """ The base of the framers, which implements install and uninstall.
+        Subclasses define feed(obj, data), which appends the given data to
+        the buffer of obj, and yields the events which are to be signalled. """
+
+    def install(self, mode):
+        mode.link(DATA, self.update)
+
+    def uninstall(self, mode):
+        mode.unlink(DATA, self.update)
+
+    def update(self, obj):
+        for event in self.feed(obj, obj.data):
+            yield sign(*event)
+
+class Lines(Framer):
+    """ Signals FOUND(obj, line) for each line ending with delim. If
+        max_length is given, any longer line is discarded as it is received,
+        without being buffered. """
+
+    def __init__(self, delim='\r\n', max_length=None):
+        self.delim      = delim
+        self.max_length = max_length
+
+    def feed(self, obj, data):
+        buffer = get_buffer(obj)
+        start = max(len(buffer) - len(self.delim) + 1, 0)
+        buffer.append(data)
+        while True:
+            end = buffer.find(self.delim, start)
+            if end < 0:
+                if self.max_length is not None \
+                and len(buffer) > self.max_length + len(self.delim):
+                    # Keep only what may be the start of the delimiter.
+                    buffer.skip(len(buffer) - len(self.delim) + 1)
+                    obj.framing_skip = 1
+                break
+            if not obj.framing_skip and (self.max_length is None
+            or end <= self.max_length):
+                yield FOUND, obj, buffer.get(0, end)
+            obj.framing_skip = 0
+            buffer.skip(end + len(self.delim))
+            start = 0
+
+class LengthPrefixed(Framer):
+    """ Signals PACKET(obj, data) for each message, which starts with its
+        length as given by the struct format header (such as '!H' or '<I'),
+        and data is the rest of the message. If inclusive is True, the length
+        counts the length field itself; otherwise, it counts only the data.
+        If max_length is given, any longer message is discarded as it is
+        received, without being buffered. """
+
+    def __init__(self, header, inclusive=True, max_length=None):
+        self.header     = struct.Struct(header)
+        self.inclusive  = inclusive
+        self.max_length = max_length
+
+    def feed(self, obj, data):
+        buffer = get_buffer(obj)
+        skip = obj.framing_skip
+        if skip:
+            obj.framing_skip = max(skip - len(data), 0)
+            if skip >= len(data): return
+            data = data[skip:]
+        buffer.append(data)
+        size = self.header.size
+        while len(buffer) >= size:
+            length, = buffer.unpack(self.header)
+            if not self.inclusive: length += size
+            length = max(length, size)
+            if self.max_length is not None and length > self.max_length:
+                obj.framing_skip = max(length - len(buffer), 0)
+                buffer.skip(length)
+                continue
+            if len(buffer) < length: break
+            message = buffer.get(size, length)
+            buffer.skip(length)
+            yield PACKET, obj, message
+
+class Inflate(Framer):
+    """ Decompresses the data received as a single zlib stream, and passes it
+        to the framer inner. """
+
+    def __init__(self, inner, wbits=zlib.MAX_WBITS):
+        self.inner = inner
+        self.wbits = wbits
+
+    def feed(self, obj, data):
+        if obj.framing_inflate is None:
+            obj.framing_inflate = zlib.decompressobj(self.wbits)
+        return self.inner.feed(obj, obj.framing_inflate.decompress(data))
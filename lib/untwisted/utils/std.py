@@ -17,6 +17,8 @@ def update(obj):
     try:
         obj.data = obj.recv(obj.SIZE)
     except Exception as excpt:
+        # A failed connection is reported by RECV_ERR alone.
+        obj.connecting = False
         yield sign(RECV_ERR, obj, excpt)
         return
     ################
@@ -28,6 +30,17 @@ def update(obj):
         yield sign(DATA, obj)
 
 def flush(obj):
+    if obj.connecting:
+        obj.connecting = False
+        try:
+            err = obj.getsockopt(SOL_SOCKET, SO_ERROR)
+        except error:
+            # The socket was closed by a handler of an earlier event.
+            return
+        # Otherwise, the error is reported by update, as RECV_ERR.
+        if err: return
+        yield sign(CONNECT, obj)
+
     if obj.queue:
         data = obj.queue[:obj.BLOCK]
         try:
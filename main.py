@@ -25,11 +25,22 @@ if __name__ == '__main__':
     import amelia
     from untwisted.event import CLOSE
     
-    bot = amelia.AmeliaBot(conf)
-    bot.domain = 'bot'
+    # Each item of `networks' configures an additional connection, sharing the
+    # same process and plugins, by overriding items of the main configuration.
+    networks = conf.pop('networks', {})
+    bots = []
+    for network, net_conf in [(None, {})] + sorted(networks.iteritems()):
+        bot_conf = dict(conf, plugins=list(conf['plugins']), network=network)
+        bot_conf.update(net_conf)
+        bot = amelia.AmeliaBot(bot_conf)
+        bot.domain = 'bot' if network is None else 'bot:%s' % network
+        bots.append(bot)
+
+    bot = bots[0]
     try:
         bot.mainloop()
     except BaseException as e:
-        bot.drive('EXCEPTION', bot, e)
+        for bot in bots:
+            bot.drive('EXCEPTION', bot, e)
         bot.mainloop()
 
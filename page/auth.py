@@ -21,13 +21,13 @@ PASSWORD_FILE = 'conf/auth_password.txt'
 IDENTIFY_DURATION_S = 60*60
 
 passed = set()
+
+# identified[network, id] = time.clock() of the last admin command given by
+# the user with the given ID on the given network after using !identify.
 identified = dict()
 
-def reload(prev):
-    if hasattr(prev, 'passed') and isinstance(prev.passed, set):
-        passed.update(prev.passed)
-    if hasattr(prev, 'identified') and isinstance(prev.identified, dict):
-        identified.update(prev.identified)
+# See util.preserve_reload_state.
+__reload_preserve__ = 'passed', 'identified'
 
 # Decorates an untwisted event handler which takes arguments 'bot' and 'id',
 # causing its body to be executed iff the specified user is an admin according
@@ -52,7 +52,7 @@ def admin(func):
 # True if the given user is authenticated as an admin, or otherwise False.
 @util.mfun(link, 'auth.check')
 def check(bot, id, ret):
-    if identify_check(id):
+    if identify_check(bot, id):
         yield ret(True); return
 
     if os.path.exists(ADMINS_FILE):
@@ -81,19 +81,20 @@ def h_identify(bot, id, target, args, full_msg):
         with open(PASSWORD_FILE) as file:
             password = file.read().strip()
         if args.strip() == password:
-            identified[id] = time.clock()
+            identified[bot.network, id] = time.clock()
             reply(bot, id, target, 'Authentication successful.')
         else:
             reply(bot, id, target, 'Authentication failed: incorrect password.')
     else:   
         reply(bot, id, target, 'No admin password is configured.')
 
-def identify_check(id):
-    if id not in identified:
+def identify_check(bot, id):
+    key = bot.network, id
+    if key not in identified:
         return False
-    elif time.clock() - identified[id] > IDENTIFY_DURATION_S:
-        del identified[id]
+    elif time.clock() - identified[key] > IDENTIFY_DURATION_S:
+        del identified[key]
         return False
     else:
-        identified[id] = time.clock()
+        identified[key] = time.clock()
         return True
@@ -33,13 +33,29 @@ def notice(bot, source, head, *args, **kwds):
     for source, target in targets(source, include_self=include_self):
         bot.drive(('BRIDGE', head), bot, target, source, *args)
 
+# A list of (source, target) pairs, where `source' is the capitalisation of
+# `source_chan' given in the configuration, and each `target' is bridged to it.
 def targets(source_chan, include_self=False):
+    table = routes_self if include_self else routes
+    return table.get(source_chan.lower(), ())
+
+# Returns a dict mapping each lowercased location in `bridges' to its list of
+# (source, target) pairs, for use by targets(). `source' is the capitalisation
+# given in the configuration. If `include_self' is False, each location is
+# excluded from its own targets.
+def compile_routes(bridges, include_self=False):
+    table = dict()
     for bridge in bridges:
-        sources = [c for c in bridge if c.lower() == source_chan.lower()]
-        if not sources: continue
-        for target in bridge:
-            if target.lower() != source_chan.lower() or include_self:
-                yield (sources[0], target)
+        lbridge = [c.lower() for c in bridge]
+        for lsource in set(lbridge):
+            source = bridge[lbridge.index(lsource)]
+            table.setdefault(lsource, []).extend(
+                (source, target) for (target, ltarget) in zip(bridge, lbridge)
+                if ltarget != lsource or include_self)
+    return table
+
+routes = compile_routes(bridges)
+routes_self = compile_routes(bridges, include_self=True)
 
 @link(('BRIDGE', 'MESSAGE'), action=False)
 @link(('BRIDGE', 'ACTION'),  action=True)
@@ -112,7 +128,7 @@ def h_bridge(bot, target_chan, msg, source, no_proxy=False, **kwds):
 def h_bridge_names_req(bot, target, source, query):
     if not target.startswith('#'): return
     if query and query.lower() != target.lower(): return
-    names = channel.track_channels[target.lower()]
+    names = list(channel.track_channels[target.lower()])
     notice(bot, target, 'NAMES_RES', source, target, names)
 
 
@@ -133,6 +149,7 @@ def h_message(*args, **kwds):
 
 @link('OTHER_JOIN')
 def h_other_join(bot, id, chan):
+    if channel.is_netjoin(id.nick, chan): return
     cmsg = '%s joined the channel.' % id.nick
     yield sign('IRC', bot, chan, cmsg, no_proxy=True)
 
@@ -154,6 +171,15 @@ def h_other_quit(bot, id, msg, chan):
         (id.nick, (' (%s)' % msg) if msg else '')
     yield sign('IRC', bot, chan, cmsg, no_proxy=True)
 
+@link('NETSPLIT', verb='quit the network')
+@link('NETJOIN',  verb='rejoined the channel')
+def h_netsplit(bot, servers, chans, verb):
+    for chan, ids in chans.iteritems():
+        chan = channel.capitalisation.get(chan, chan)
+        cmsg = '%s %s (netsplit: %s %s).' % (
+            (channel.netsplit_nicks(ids), verb) + servers)
+        yield sign('IRC', bot, chan, cmsg, no_proxy=True)
+
 @link('OTHER_NICK_CHAN')
 def h_other_nick(bot, id, new_nick, chan):
     cmsg = '%s is now known as %s.' % (id.nick, new_nick)
@@ -210,27 +236,51 @@ def substitute_reply(context, local_name, msg_local, msg_bridge, cancel_bridge):
             cancel_bridge()
     return reply
 
+# Returns a dict mapping each lowercased context in `substitutions' to a pair
+# (regex, names), where names[find.lower()] = (find, repl) for each substitution
+# in that context, and `regex' matches any such `find' as a whole word, ignoring
+# case, preferring longer names. Where several substitutions have the same
+# context and `find', only the first is used.
+def compile_substitutions(substitutions):
+    table = dict()
+    for context, find, repl in substitutions:
+        table.setdefault(context.lower(), dict()).setdefault(
+            find.lower(), (find, repl))
+    return {context: (re.compile(r'\b(%s)\b' % '|'.join(
+                re.escape(f) for f in sorted(names, key=len, reverse=True)),
+                re.I), names)
+            for (context, names) in table.iteritems()}
+
+compiled_substitutions = compile_substitutions(substitutions)
+
 # Apply any appropriate substitutions to the r'\b'-separated words in `text'.
 def substitute_text(context, text):
-    context = context.lower()
-    for r_context, find, repl in substitutions:
-        if r_context.lower() == context:
-            text = re.sub(
-                r'\b(%s)\b' % re.escape(find),
-                lambda match: _substitute_name(match.group(), find, repl),
-                text, flags=re.I)
-    return text
-
-# Apply any appropriate substitutions that wholly match `name'.
+    compiled = compiled_substitutions.get(context.lower())
+    if compiled is None: return text
+    regex, names = compiled
+    return regex.sub(lambda match: _substitute_name(
+        match.group(), *names[match.group().lower()]), text)
+
+# Apply any appropriate substitution that wholly matches `name'.
 def substitute_name(context, name):
-    context = context.lower()
-    for r_context, find, repl in substitutions:
-        if r_context.lower() == context and find.lower() == name.lower():
-            name = _substitute_name(name, find, repl)
-    return name
+    compiled = compiled_substitutions.get(context.lower())
+    if compiled is None: return name
+    find_repl = compiled[1].get(name.lower())
+    return _substitute_name(name, *find_repl) if find_repl else name
 
-# Apply to `repl' any changes in capitalisation from `find' to `name'.
+# Apply to `repl' any changes in capitalisation from `find' to `name'. The
+# results are cached, up to MAX_CACHED_NAMES at a time.
 def _substitute_name(name, find, repl):
+    key = name, find, repl
+    if key not in name_cache:
+        if len(name_cache) >= MAX_CACHED_NAMES: name_cache.clear()
+        name_cache[key] = _substitute_name_uncached(name, find, repl)
+    return name_cache[key]
+
+MAX_CACHED_NAMES = 4096
+name_cache = dict()
+
+def _substitute_name_uncached(name, find, repl):
     def iter():
         identity = lambda x: x
         trans = identity
@@ -3,17 +3,20 @@
 # in one channel are broadcast to the other, and vice versa.
 
 import inspect
+import os.path
 import re
 
 from untwisted.magic import sign
 
 from runtime import later
 import auth
+import store
 import util
 import channel
 import message
 
-LINKS_FILE = 'state/chan_link_persistent.txt'
+LINKS_FILE = 'state/chan_link_persistent.json'
+OLD_LINKS_FILE = 'state/chan_link_persistent.txt'
 
 link, link_install, uninstall = util.LinkSet().triple()
 
@@ -24,11 +27,23 @@ links = dict()
 decay_links = set()
 
 # (c1.lower(), c2.lower()) in persistent_links if a link from c1 to c2
-# will be created upon the next restart.
-try:
-    persistent_links = set(util.read_list(LINKS_FILE))
-except IOError:
-    persistent_links = set()
+# will be created upon the next restart. Each such pair is persisted as a key
+# in links_store, whose snapshot is a list of [c1, c2] pairs.
+links_store = store.Store(LINKS_FILE,
+    encode=lambda records: sorted(map(list, records)),
+    decode=lambda obj: {tuple(pair): True for pair in obj})
+
+def read_persistent_links():
+    pairs = set(links_store.load())
+    if not any(map(os.path.exists, (LINKS_FILE, links_store.journal_path))) \
+    and os.path.exists(OLD_LINKS_FILE):
+        # Import links saved in the obsolete format.
+        for c1, c2 in util.read_list(OLD_LINKS_FILE):
+            pairs.add((c1.lower(), c2.lower()))
+            links_store.put((c1.lower(), c2.lower()), True)
+    return pairs
+
+persistent_links = read_persistent_links()
 
 def install(bot):
     for c1, c2 in persistent_links:
@@ -37,21 +52,19 @@ def install(bot):
         links[c1].add(c2)
     link_install(bot)
 
-def reload(prev):
-    if hasattr(prev, 'links') and isinstance(prev.links, dict):
-        links.update(prev.links)
-    if hasattr(prev, 'decay_links') and isinstance(prev.decay_links, set):
-        for decay_chan in prev.decay_links:
-            if decay_chan not in links: continue
-            decay_links.add(decay_chan)
+# See util.preserve_reload_state.
+__reload_preserve__ = 'links', 'decay_links'
 
 def add_persistent_link(c1, c2):
-    persistent_links.add((c1.lower(), c2.lower()))
-    util.write_list(LINKS_FILE, list(persistent_links))
+    key = c1.lower(), c2.lower()
+    if key in persistent_links: return
+    persistent_links.add(key)
+    links_store.put(key, True)
 
 def del_persistent_link(c1, c2):
-    persistent_links.discard((c1.lower(), c2.lower()))
-    util.write_list(LINKS_FILE, list(persistent_links))
+    key = c1.lower(), c2.lower()
+    persistent_links.discard(key)
+    links_store.delete(key)
 
 # Establish a link from channel c1 to c2, and from c2 to c1 if mutual is True.
 # If an existing link is marked to decay, unmark it. If persistent is True,
@@ -155,7 +168,7 @@ def h_add_chan_link(bot, id, chan, from_chan, full_msg):
     if not chan or not re.match(r'#\S*$', from_chan):
         message.reply(bot, id, chan, 'Error: invalid argument: "%s".' % from_chan)
     else:
-        yield add_link(bot, from_chan, chan, True, True)
+        yield add_link(bot, bot.qualify(from_chan), chan, True, True)
 
 @link('!add-chan-link-from')
 @auth.admin
@@ -163,7 +176,7 @@ def h_add_chan_link(bot, id, chan, from_chan, full_msg):
     if not chan or not re.match(r'#\S*$', from_chan):
         message.reply(bot, id, chan, 'Error: invalid argument: "%s".' % from_chan)
     else:
-        yield add_link(bot, from_chan, chan, False, True)
+        yield add_link(bot, bot.qualify(from_chan), chan, False, True)
 
 @link('!del-chan-link')
 @auth.admin
@@ -171,50 +184,82 @@ def h_del_chan_link(bot, id, chan, args, full_msg):
     if not chan or not re.match(r'#\S*$', args):
         message.reply(bot, id, chan, 'Error: invalid argument: "%s".' % args)
     else:
-        yield del_link(bot, chan, args)
+        yield del_link(bot, chan, bot.qualify(args))
 
 #===============================================================================
+# Relay formats, each taking the name of the source channel as its first field.
+FMT_JOIN   = '%s: \2%s\2 [%s@%s] has joined.'
+FMT_PART   = '%s: %s has left%s'
+FMT_KICK   = '%s: %s was kicked by %s%s'
+FMT_QUIT   = '%s: %s has quit%s'
+FMT_SPLIT  = '%s: %s %s (netsplit: %s %s).'
+FMT_NICK   = '%s: %s is now known as \2%s\2.'
+FMT_MSG    = '%s: <%s> %s'
+FMT_ACTION = '%s: * %s %s'
+FMT_TOPIC  = '%s: %s set topic to: %s'
+FMT_UNTOPIC= '%s: %s unset the topic.'
+FMT_MODE   = '%s: %s set mode: %s'
+
+ACTION_RE = re.compile(r'\x01ACTION (?P<act>.*?)\x01?$')
+
+# Sends `msg' to each channel linked from `chan', except those in which `nick'
+# is present, if given. The message is sent to all such channels at once, and
+# unless `coalesce' is False, may be merged with other queued relay messages.
+def relay(bot, chan, msg, nick=None, coalesce=True):
+    lchans = links.get(chan.lower())
+    if not lchans: return
+    if nick is not None:
+        lchans = [c for c in lchans
+                  if nick not in channel.track_channels.get(c, ())]
+        if not lchans: return
+    bot.send_msgs(lchans, msg, no_link=True, coalesce=coalesce)
+
+# The capitalisation of `chan' as given by the server.
+def cap_chan(chan):
+    return channel.capitalisation.get(chan.lower(), chan)
+
 @link('OTHER_JOIN')
 def h_other_join(bot, id, chan):
     if chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: \2%s\2 [%s@%s] has joined.' % (chan, id.nick, id.user, id.host)
-    for lchan in links[chan.lower()]: bot.send_msg(lchan, msg, no_link=True)
+    if channel.is_netjoin(id.nick, chan): return
+    relay(bot, chan, FMT_JOIN % (cap_chan(chan), id.nick, id.user, id.host))
 
 @link('SOME_PART')
 def h_other_part(bot, id, chan, pmsg):
     if chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: %s has left%s' % (chan, id.nick, ': %s' % pmsg if pmsg else '.')
-    for lchan in links[chan.lower()]: bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_PART % (
+        cap_chan(chan), id.nick, ': %s' % pmsg if pmsg else '.'))
 
 @link('SOME_KICKED')
 def h_other_kicked(bot, knick, op_id, chan, kmsg):
     if chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: %s was kicked by %s%s' % (
-        chan, knick, op_id.nick, ': %s' % kmsg if kmsg else '.')
-    for lchan in links[chan.lower()]: bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_KICK % (
+        cap_chan(chan), knick, op_id.nick, ': %s' % kmsg if kmsg else '.'))
 
 @link('OTHER_QUIT_CHAN')
 def h_other_quit_chan(bot, id, qmsg, chan):
     if chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: %s has quit%s' % (chan, id.nick, ': %s'%qmsg if qmsg else '.')
-    for lchan in links[chan.lower()]:
-        lnicks = yield channel.names(bot, lchan, include_prefix=False)
-        if id.nick.lower() in map(str.lower, lnicks): continue
-        bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_QUIT % (
+        cap_chan(chan), id.nick, ': %s' % qmsg if qmsg else '.'), nick=id.nick)
+
+@link('NETSPLIT', verb='quit')
+@link('NETJOIN',  verb='rejoined')
+def h_netsplit(bot, servers, chans, verb):
+    for chan, ids in chans.iteritems():
+        if chan not in links: continue
+        cchan = cap_chan(chan)
+        for lchan in links[chan]:
+            lnicks = channel.track_channels.get(lchan, ())
+            lids = [id for id in ids if id.nick not in lnicks]
+            if not lids: continue
+            msg = FMT_SPLIT % (
+                (cchan, channel.netsplit_nicks(lids), verb) + servers)
+            bot.send_msg(lchan, msg, no_link=True, coalesce=True)
 
 @link('OTHER_NICK_CHAN')
 def h_other_nick_chan(bot, id, nnick, chan):
     if chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: %s is now known as \2%s\2.' % (chan, id.nick, nnick)
-    for lchan in links[chan.lower()]:
-        lnicks = yield channel.names(bot, lchan, include_prefix=False)
-        if id.nick.lower() in map(str.lower, lnicks): continue
-        bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_NICK % (cap_chan(chan), id.nick, nnick), nick=id.nick)
 
 @link('MESSAGE',  a=lambda bot, id, chan, msg:
                     (bot, id.nick, id, chan, msg))
@@ -225,14 +270,13 @@ def h_other_nick_chan(bot, id, nnick, chan):
 def h_message(*args, **kwds):
     bot, nick, id, chan, msg = kwds['a'](*args)
     if not chan or chan.lower() not in links: return
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    p_nick = channel.prefix_nick(bot, nick, chan)
-    match = re.match(r'\x01ACTION (?P<act>.*?)\x01?$', msg)
-    msg = '%s: * %s %s' % (chan, nick, match.group('act')) if match else \
-          '%s: <%s> %s' % (chan, p_nick, msg)
-    for lchan in links[chan.lower()]:
-        bot.send_msg(lchan, msg, no_link=True)
-        if id is not None and id.nick.lower() != bot.nick.lower():
+    chan = cap_chan(chan)
+    match = ACTION_RE.match(msg)
+    msg = FMT_ACTION % (chan, nick, match.group('act')) if match else \
+          FMT_MSG % (chan, channel.prefix_nick(bot, nick, chan), msg)
+    relay(bot, chan, msg, coalesce=False)
+    if id is not None and id.nick.lower() != bot.nick.lower():
+        for lchan in links[chan.lower()]:
             yield later(sign('PROXY_MSG', bot, id, lchan, msg,
                              no_link=True, no_auto=True))
 
@@ -247,14 +291,11 @@ def h_proxy_msg(bot, id, chan, msg, no_link=False, **kwds):
 def h_topic(bot, source, chan, topic):
     if chan.lower() not in links: return
     if isinstance(source, tuple): source = source[0]
-    msg = '%s: %s set topic to: %s' % (chan, source, topic) if topic else \
-          '%s: %s unset the topic.' % (chan, source)
-    for lchan in links[chan.lower()]: bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_TOPIC % (chan, source, topic) if topic else
+                     FMT_UNTOPIC % (chan, source))
 
 @link('MODE')
 def h_chan_mode(bot, source, chan, *args):
     if chan.lower() not in links: return
     if isinstance(source, tuple): source = source[0]
-    chan = channel.capitalisation.get(chan.lower(), chan)
-    msg = '%s: %s set mode: %s' % (chan, source, ' '.join(args))
-    for lchan in links[chan.lower()]: bot.send_msg(lchan, msg, no_link=True)
+    relay(bot, chan, FMT_MODE % (cap_chan(chan), source, ' '.join(args)))
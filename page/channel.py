@@ -1,14 +1,19 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from itertools import *
 import inspect
+import string
+import time
 import re
 
 from untwisted.magic import sign, hold
+from untwisted.event import TICK
 
+from amelia import split_network
 import util
 link, install, uninstall = util.LinkSet().triple()
 
 
+RPL_ISUPPORT    = '005'
 ERR_NOTONCHAN   = '442'
 ERR_CHOPNEEDED  = '482'
 ERR_NOSUCHCHAN  = '403'
@@ -18,17 +23,161 @@ RPL_CHANMODEIS  = '324'
 RPL_NAMEREPLY   = '353'
 RPL_ENDOFNAMES  = '366'
 
+# The number of seconds without further QUITs or JOINs after which a netsplit
+# or netjoin is considered complete and reported, and the number of seconds for
+# which users lost in a netsplit are remembered in order to detect a netjoin.
+NETSPLIT_BATCH_S  = 2
+NETSPLIT_EXPIRE_S = 3600
+
+#===============================================================================
+# Case-insensitive comparison of nicks, according to the ISUPPORT CASEMAPPING
+# of each network, where the primary network is named None.
+
+CASEMAPPINGS = {
+    'ascii':          ('', ''),
+    'rfc1459':        ('[]\\~', '{}|^'),
+    'strict-rfc1459': ('[]\\',  '{}|'),
+}
+DEFAULT_CASEMAPPING = 'rfc1459'
+
+def casemap_table(name):
+    upper, lower = CASEMAPPINGS[name]
+    return string.maketrans(
+        string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+
+default_table = casemap_table(DEFAULT_CASEMAPPING)
+
+# casemappings[network] and casemap_tables[network] are the name and translation
+# table of the casemapping of the given network, if it has been reported.
+casemappings = dict()
+casemap_tables = dict()
+
+# Sets the casemapping of the given network, returning True if it has changed.
+def set_casemapping(name, network=None):
+    if name is not None: name = name.lower()
+    if name not in CASEMAPPINGS: name = DEFAULT_CASEMAPPING
+    if casemappings.get(network, DEFAULT_CASEMAPPING) == name: return False
+    casemappings[network] = name
+    casemap_tables[network] = casemap_table(name)
+    return True
+
+# Returns a string which is equal for all nicks considered equal to `nick' by
+# the server of the given network. This is always the same for `nick' and
+# `nick.lower()'.
+def fold(nick, network=None):
+    if type(nick) is unicode: return nick.lower()
+    return nick.translate(casemap_tables.get(network, default_table))
+
+# A list of nicks on the given network, without duplicates, which remembers the
+# capitalisation of each and supports constant-time case-insensitive membership
+# tests, insertion and removal. Iterating over a NickList yields each nick in
+# order of insertion.
+class NickList(object):
+    __slots__ = '_nicks', 'network'
+    def __init__(self, nicks=(), network=None):
+        self._nicks = OrderedDict()
+        self.network = network
+        for nick in nicks: self.append(nick)
+    def __iter__(self):
+        return self._nicks.itervalues()
+    def __len__(self):
+        return len(self._nicks)
+    def __contains__(self, nick):
+        return fold(nick, self.network) in self._nicks
+    def __repr__(self):
+        return 'NickList(%r)' % list(self)
+
+    # The capitalisation of the given nick in this list, or `default'.
+    def get(self, nick, default=None):
+        return self._nicks.get(fold(nick, self.network), default)
+
+    # Adds the given nick, or changes its capitalisation if already present.
+    def append(self, nick):
+        self._nicks[fold(nick, self.network)] = nick
+
+    def remove(self, nick):
+        try: del self._nicks[fold(nick, self.network)]
+        except KeyError: raise ValueError('%r is not in NickList' % nick)
+
+    def discard(self, nick):
+        self._nicks.pop(fold(nick, self.network), None)
+
+    def rename(self, old_nick, new_nick):
+        if self._nicks.pop(fold(old_nick, self.network), None) is not None:
+            self.append(new_nick)
+
+    # Recomputes the keys of this list after a change of casemapping.
+    def refold(self):
+        nicks, self._nicks = self._nicks, OrderedDict()
+        for nick in nicks.itervalues(): self.append(nick)
+
+# A dict whose keys are nicks on the given network, compared case-insensitively.
+# The keys produced by iteration are those of fold(), which for most nicks are
+# equal to nick.lower().
+class NickDict(dict):
+    __slots__ = 'network',
+    def __init__(self, items=(), network=None):
+        super(NickDict, self).__init__()
+        self.network = network
+        if isinstance(items, dict): items = items.iteritems()
+        for nick, value in items: self[nick] = value
+    def __getitem__(self, nick):
+        return super(NickDict, self).__getitem__(fold(nick, self.network))
+    def __setitem__(self, nick, value):
+        super(NickDict, self).__setitem__(fold(nick, self.network), value)
+    def __delitem__(self, nick):
+        super(NickDict, self).__delitem__(fold(nick, self.network))
+    def __contains__(self, nick):
+        return super(NickDict, self).__contains__(fold(nick, self.network))
+    has_key = __contains__
+    def get(self, nick, default=None):
+        return super(NickDict, self).get(fold(nick, self.network), default)
+    def pop(self, nick, *default):
+        return super(NickDict, self).pop(fold(nick, self.network), *default)
+    def setdefault(self, nick, default=None):
+        return super(NickDict, self).setdefault(
+            fold(nick, self.network), default)
+    def update(self, items=(), **kwds):
+        if isinstance(items, dict): items = items.iteritems()
+        for nick, value in chain(items, kwds.iteritems()): self[nick] = value
+    # Recomputes the keys of this dict after a change of casemapping. Since the
+    # original capitalisation of the keys is lost, a NickList containing them,
+    # which has not yet itself been refolded, should be given if possible.
+    def refold(self, nicks=None):
+        items = self.items()
+        self.clear()
+        for key, value in items:
+            self[nicks._nicks.get(key, key) if nicks else key] = value
+
+# Like defaultdict(cls), for a NickList or NickDict class `cls', but creating
+# each value for the network of the (lowercase) channel name given as its key.
+class ChannelDict(dict):
+    __slots__ = 'cls',
+    def __init__(self, cls):
+        super(ChannelDict, self).__init__()
+        self.cls = cls
+    def __missing__(self, chan):
+        value = self[chan] = self.cls(network=split_network(chan)[1])
+        return value
+
+#===============================================================================
 # names_channels[chan.lower()]
 # list of NAMES query results collected so far, including prefixes.
 names_channels = defaultdict(list)
 
 # track_channels[chan.lower()]
-# list of nicks known to be in chan.
-track_channels = defaultdict(list)
+# NickList of nicks known to be in chan.
+track_channels = ChannelDict(NickList)
+
+# nick_channels[network, fold(nick)]
+# set of chan.lower() for each chan in track_channels containing nick, where
+# `network' is that of the channels (see amelia.NETWORK_SEP). This is maintained
+# by add_member, remove_member and rename_member.
+nick_channels = dict()
 
 # umode_channels[chan.lower()][nick.lower()]
-# string of modes that nick is known to have on chan.
-umode_channels = defaultdict(dict)
+# string of modes that nick is known to have on chan, in a NickDict.
+umode_channels = ChannelDict(NickDict)
 
 # cmode_channels[chan.lower()][mode_char]
 # set if mode_char is set on chan; None if set with no parameter; else, a string.
@@ -42,24 +191,79 @@ topic_channels = dict()
 # the canonical capitalisation of chan, according to certain server messages.
 capitalisation = dict()
 
-def hard_reload(prev):
-    reload(prev, hard=True)
+# These are kept only by a soft reload. See util.preserve_reload_state.
+__reload_preserve__ = 'names_channels', 'topic_channels', 'capitalisation'
 
-def reload(prev, hard=False):
+def hard_reload(prev):
+    reload(prev)
+
+def reload(prev):
+    if hasattr(prev, 'casemappings'):
+        for network, name in prev.casemappings.iteritems():
+            set_casemapping(name, network)
+    elif hasattr(prev, 'casemapping'):
+        set_casemapping(prev.casemapping)
     if hasattr(prev,'track_channels') and isinstance(prev.track_channels,dict):
-        track_channels.update(prev.track_channels)
+        track_channels.update((c, NickList(ns, split_network(c)[1]))
+            for (c, ns) in prev.track_channels.iteritems())
     if hasattr(prev,'umode_channels') and isinstance(prev.umode_channels,dict):
-        umode_channels.update(prev.umode_channels)
+        umode_channels.update((c, NickDict(ms, split_network(c)[1]))
+            for (c, ms) in prev.umode_channels.iteritems())
+    index_nick_channels()
     if hasattr(prev,'cmode_channels') and isinstance(prev.cmode_channels,dict):
         cmode_channels.update(prev.cmode_channels)
-    if hard: return
 
-    if hasattr(prev,'names_channels') and isinstance(prev.names_channels,dict):
-        names_channels.update(prev.names_channels)
-    if hasattr(prev,'topic_channels') and isinstance(prev.topic_channels,dict):
-        topic_channels.update(prev.topic_channels)
-    if hasattr(prev,'capitalisation') and isinstance(prev.capitalisation,dict):
-        capitalisation.update(prev.capitalisation)
+@link(RPL_ISUPPORT)
+def h_rpl_isupport(bot, *args):
+    if 'CASEMAPPING' not in bot.isupport: return
+    if not set_casemapping(bot.isupport['CASEMAPPING'], bot.network): return
+    for chan, umodes in umode_channels.iteritems():
+        if bot_channel(bot, chan): umodes.refold(track_channels.get(chan))
+    for chan, nicks in track_channels.iteritems():
+        if bot_channel(bot, chan): nicks.refold()
+    index_nick_channels()
+
+#===============================================================================
+# Maintenance of track_channels and nick_channels.
+
+# Returns the set of lowercase names of channels in which nick is known to be,
+# on the network to which the given bot is connected.
+def user_channels(bot, nick):
+    key = bot.network, fold(nick, bot.network)
+    return nick_channels.get(key, frozenset())
+
+# True if the given lowercase channel is on the network of the given bot.
+def bot_channel(bot, chan):
+    return split_network(chan)[1] == bot.network
+
+def member_key(chan, nick):
+    network = split_network(chan)[1]
+    return network, fold(nick, network)
+
+def add_member(chan, nick):
+    track_channels[chan].append(nick)
+    nick_channels.setdefault(member_key(chan, nick), set()).add(chan)
+
+def remove_member(chan, nick):
+    if chan in track_channels:
+        track_channels[chan].discard(nick)
+    key = member_key(chan, nick)
+    chans = nick_channels.get(key)
+    if chans is not None:
+        chans.discard(chan)
+        if not chans: del nick_channels[key]
+
+def rename_member(chan, old_nick, new_nick):
+    if chan in track_channels and old_nick in track_channels[chan]:
+        remove_member(chan, old_nick)
+        add_member(chan, new_nick)
+
+# Rebuilds nick_channels from the contents of track_channels.
+def index_nick_channels():
+    nick_channels.clear()
+    for chan, nicks in track_channels.iteritems():
+        for nick in nicks:
+            nick_channels.setdefault(member_key(chan, nick), set()).add(chan)
 
 #===============================================================================
 # Provision of TOPIC query.
@@ -258,27 +462,21 @@ def h_names(bot, chan, new_names):
     pre_ms, pre_cs = bot.isupport['PREFIX']
     for prefix, nick in (split_name(bot,n) for n in new_names):
         # Update track_channels
-        if nick.lower() not in map(str.lower, track_names):
-            track_names.append(nick)
-        elif nick not in track_names:
-            track_names = [n for n in track_names if n.lower() != nick.lower()]
-            track_names.append(nick)
+        add_member(chan, nick)
 
         # Update umode_channels
-        if len(prefix)==1 and nick.lower() in umode_names and prefix in pre_cs:
+        if len(prefix)==1 and nick in umode_names and prefix in pre_cs:
             # Add the mode and remove all known higher modes.
             i = pre_cs.index(prefix)
-            umode_names[nick.lower()] = pre_ms[i] + ''.join(
-                m for m in umode_names[nick.lower()] if m not in pre_ms[:i])
+            umode_names[nick] = pre_ms[i] + ''.join(
+                m for m in umode_names[nick] if m not in pre_ms[:i])
         else:
             # Set to exactly the given modes.
-            umode_names[nick.lower()] = ''.join(
+            umode_names[nick] = ''.join(
                 m for c in prefix if c in pre_cs
                   for i in [pre_cs.index(c)]
                   for m in pre_ms[i:i+1])
 
-    track_channels[chan] = track_names
-    umode_channels[chan] = umode_names
     yield sign('NAMES_SYNC', bot, chan, track_names, umode_names)
 
 @link('CHAN_TOPIC')
@@ -335,30 +533,22 @@ def h_self_join(bot, chan):
 
 @link('SOME_JOIN')
 def h_some_join(bot, id, chan):
-    names = track_channels[chan.lower()]
-    if id.nick.lower() in map(str.lower, names): return
-    names.append(id.nick)
-    track_channels[chan.lower()] = names
+    add_member(chan.lower(), id.nick)
 
 @link('SOME_NICK_CHAN_FINAL')
 def h_some_nick_chan(bot, id, new_nick, chan):
-    chan, old_nick = chan.lower(), id.nick.lower()
-    if chan in track_channels:
-        names = track_channels[chan]
-        names = [(new_nick if n.lower() == old_nick else n) for n in names]
-        track_channels[chan] = names
+    chan, old_nick = chan.lower(), id.nick
+    rename_member(chan, old_nick, new_nick)
     if chan in umode_channels and old_nick in umode_channels[chan]:
-        umode_channels[chan][new_nick.lower()] = umode_channels[chan].pop(old_nick)
+        umode_channels[chan][new_nick] = umode_channels[chan].pop(old_nick)
 
 @link('OTHER_PART_FINAL',      a=lambda id, chan, msg:          (id.nick, chan))
 @link('OTHER_KICKED_FINAL',    a=lambda knick, opid, chan, msg: (knick, chan))
 @link('OTHER_QUIT_CHAN_FINAL', a=lambda id, msg, chan:          (id.nick, chan))
 def h_other_exit_chan(bot, *args, **kwds):
-    nick, chan = map(str.lower, kwds['a'](*args))
-    if chan in track_channels:
-        names = track_channels[chan]
-        names = [n for n in names if n.lower() != nick]
-        track_channels[chan] = names
+    nick, chan = kwds['a'](*args)
+    chan = chan.lower()
+    remove_member(chan, nick)
     if chan in umode_channels and nick in umode_channels[chan]:
         del umode_channels[chan][nick]
 
@@ -366,7 +556,10 @@ def h_other_exit_chan(bot, *args, **kwds):
 @link('SELF_KICKED_FINAL')
 def h_self_part_kicked_final(bot, chan, *args):
     chan = chan.lower()
-    if chan in track_channels: del track_channels[chan]
+    if chan in track_channels:
+        for nick in list(track_channels[chan]):
+            remove_member(chan, nick)
+        del track_channels[chan]
     if chan in umode_channels: del umode_channels[chan]
     if chan in cmode_channels: del cmode_channels[chan]
     if chan in topic_channels: del topic_channels[chan]
@@ -380,12 +573,122 @@ def h_self_part_kicked_final(bot, chan, *args):
 @link('CLOSING',    e='CLOSING_CHAN',    a=lambda:           None)
 def h_general(bot, *args, **kwds):
     e, id = kwds['e'], kwds['a'](*args)
-    for chan, names in track_channels.iteritems():
-        if id and id.nick.lower() not in map(str.lower, names): continue
+    if e == 'OTHER_QUIT_CHAN':
+        servers = netsplit_servers(args[1])
+        if servers is not None:
+            netsplit_quit(bot, id, servers)
+            return
+    chans = list(user_channels(bot, id.nick) if id else
+                 (c for c in track_channels if bot_channel(bot, c)))
+    for chan in chans:
         eargs = args + (chan,)
         yield sign(e,            bot, *eargs)
         yield sign(e + '_FINAL', bot, *eargs)
 
+#===============================================================================
+# Aggregation of netsplits and netjoins.
+#
+# When a user quits with a message of the form "SERVER1 SERVER2", indicating
+# that they were lost in a netsplit, no OTHER_QUIT_CHAN events are raised;
+# instead, the user is removed from track_channels immediately, and after no
+# further such quits have occurred for NETSPLIT_BATCH_S seconds, a single event
+#     NETSPLIT, bot, (server1, server2), {chan.lower(): [id1, id2, ...], ...}
+# is raised, followed by NETSPLIT_FINAL, with the same arguments. Subsequently,
+# when such users rejoin channels, the usual JOIN events are still raised, but
+# is_netjoin() returns True for them, and they are similarly reported by
+#     NETJOIN, bot, (server1, server2), {chan.lower(): [id1, id2, ...], ...}
+# followed by NETJOIN_FINAL.
+
+# A group of users, in various channels, to be reported as a single event.
+class NetBatch(object):
+    __slots__ = 'servers', 'chans', 'keys', 'time'
+    def __init__(self, servers):
+        self.servers = servers
+        self.chans = OrderedDict()
+        self.keys = set()
+        self.time = None
+    def add(self, chan, id):
+        self.chans.setdefault(chan, []).append(id)
+        self.keys.add((chan, fold(id.nick, split_network(chan)[1])))
+        self.time = time.time()
+
+# netsplit_batches[network, servers] and netjoin_batches[network, servers]
+# NetBatch of users in the netsplit or netjoin not yet reported.
+netsplit_batches = dict()
+netjoin_batches = dict()
+
+# split_users[network, fold(nick)] = (servers, time)
+# for each user recently lost in a netsplit between the given servers.
+split_users = dict()
+split_users_expire = 0
+
+# Returns (server1, server2) if `msg' is the QUIT message of a user lost in a
+# netsplit, or otherwise None.
+def netsplit_servers(msg):
+    match = re.match(r'([^\s/:@!]+\.[^\s/:@!]+) ([^\s/:@!]+\.[^\s/:@!]+)$',
+                     msg or '')
+    if match and match.group(1).lower() != match.group(2).lower():
+        return match.groups()
+
+# True if the given nick has just rejoined the given channel after a netsplit.
+def is_netjoin(nick, chan):
+    chan = chan.lower()
+    key = chan, fold(nick, split_network(chan)[1])
+    return any(key in batch.keys for batch in netjoin_batches.itervalues())
+
+def netsplit_quit(bot, id, servers):
+    batch = netsplit_batches.get((bot.network, servers))
+    if batch is None:
+        batch = netsplit_batches[bot.network, servers] = NetBatch(servers)
+    for chan in list(user_channels(bot, id.nick)):
+        batch.add(chan, id)
+        remove_member(chan, id.nick)
+        if chan in umode_channels and id.nick in umode_channels[chan]:
+            del umode_channels[chan][id.nick]
+    split_users[bot.network, fold(id.nick, bot.network)] = \
+        (servers, time.time())
+
+# Returns a string listing the nicks of the given IDs, for use in reporting a
+# netsplit or netjoin, abbreviated if there are more than `max_nicks' of them.
+def netsplit_nicks(ids, max_nicks=8):
+    nicks = [id.nick for id in ids]
+    if len(nicks) > max_nicks:
+        nicks = nicks[:max_nicks-1] + ['%d others' % (len(nicks)-max_nicks+1)]
+    if len(nicks) == 1: return nicks[0]
+    return '%s and %s' % (', '.join(nicks[:-1]), nicks[-1])
+
+@link('SOME_JOIN')
+def h_some_join_netjoin(bot, id, chan):
+    user = bot.network, fold(id.nick, bot.network)
+    if user not in split_users: return
+    servers, split_time = split_users[user]
+    if split_time < time.time() - NETSPLIT_EXPIRE_S: return
+    batch = netjoin_batches.get((bot.network, servers))
+    if batch is None:
+        batch = netjoin_batches[bot.network, servers] = NetBatch(servers)
+    batch.add(chan.lower(), id)
+
+@link(TICK)
+def h_tick_netsplit(bot):
+    if not (netsplit_batches or netjoin_batches or split_users): return
+    now = time.time()
+    for batches, event in (netsplit_batches, 'NETSPLIT'), \
+                          (netjoin_batches, 'NETJOIN'):
+        for (network, servers), batch in batches.items():
+            if network != bot.network: continue
+            if batch.time > now - NETSPLIT_BATCH_S: continue
+            del batches[network, servers]
+            if event == 'NETJOIN':
+                for chan, nick in batch.keys:
+                    split_users.pop((network, nick), None)
+            yield sign(event,            bot, servers, batch.chans)
+            yield sign(event + '_FINAL', bot, servers, batch.chans)
+    global split_users_expire
+    if split_users_expire < now - NETSPLIT_BATCH_S:
+        split_users_expire = now
+        for user, (servers, split_time) in split_users.items():
+            if split_time < now - NETSPLIT_EXPIRE_S: del split_users[user]
+
 #===============================================================================
 # Management of "quiet" channels.
 
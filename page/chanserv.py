@@ -30,8 +30,7 @@ def evict_chanserv(bot, chan):
         return
     if chan not in map(str.lower, evict_channels): return
 
-    names = map(str.lower, channel.track_channels[chan])
-    if 'ChanServ'.lower() not in names: return
+    if 'ChanServ' not in channel.track_channels[chan]: return
 
     bot.send_cmd('KICK %s ChanServ' % chan)
 
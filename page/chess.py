@@ -8,17 +8,18 @@ import socket
 
 from untwisted.mode import Mode
 from untwisted.network import Work
-from untwisted.event import DATA, BUFFER, FOUND, CLOSE, RECV_ERR
-from untwisted.utils import std
-from untwisted.utils.common import append, shrug
+from untwisted.event import FOUND, CLOSE, RECV_ERR, CONNECT
+from untwisted.utils import std, framing
 from untwisted.magic import sign
 
 import util
 import debug
 import runtime
+import reconnect
 from util import NotInstalled, AlreadyInstalled
 
 SOCKET_ADDRESS = 'state/chess'
+# The least delay before reconnecting; see reconnect.wait.
 RECONNECT_DELAY_SECONDS = 1
 
 ch_work = []
@@ -26,8 +27,7 @@ ch_mode = Mode()
 ch_mode.domain = 'ch'
 ch_link = util.LinkSet()
 ch_link.link_module(std)
-ch_link.link(DATA, append)
-ch_link.link(BUFFER, shrug, '\n')
+ch_link.link_module(framing.Lines('\n'))
 if '--debug' in sys.argv: ch_link.link_module(debug)
 
 ab_mode = None
@@ -55,12 +55,12 @@ def init_work(address):
     work.address = address
     ch_work.append(work)
     work.setblocking(0)
-    work.connect_ex(address)
+    reconnect.attempt(reconnect.get_link('chess'))
+    reconnect.connect(work, address)
 
 def kill_work(work):
-    work.destroy()
-    work.shutdown(socket.SHUT_RDWR)
-    work.close()
+    reconnect.cancel(work)
+    work.terminate()
     ch_work.remove(work)
 
 def install(bot):
@@ -84,14 +84,22 @@ def uninstall(bot):
     ab_link.uninstall(ab_mode)
     ab_mode = None
 
+install, uninstall = util.depend(install, uninstall,
+    'reconnect')
+
 @ab_link('!chess')
 def h_chess(bot, id, target, args, full_msg):
     if not target: return
     for work in ch_work:
         work.dump('%s <%s> %s\n' % (target, id.nick, args))
 
+@ch_link(CONNECT)
+def ch_connect(work):
+    reconnect.connected(reconnect.get_link('chess'))
+
 @ch_link(FOUND)
 def ch_found(work, line):
+    reconnect.established(reconnect.get_link('chess'))
     match = re.match(r'(#\S+) (.*)', line.strip())
     if not match: return
     ab_mode.send_msg(match.group(1), match.group(2))
@@ -100,5 +108,7 @@ def ch_found(work, line):
 @ch_link(RECV_ERR)
 def ch_close_recv_error(work, *args):
     kill_work(work)
-    yield runtime.sleep(RECONNECT_DELAY_SECONDS)
+    link = reconnect.get_link('chess')
+    reconnect.failed(link, args[0] if args else 'connection closed')
+    yield reconnect.wait(link, RECONNECT_DELAY_SECONDS)
     init_work(work.address)
@@ -11,6 +11,7 @@ from untwisted.usual import Stop
 from util import LinkSet, AlreadyInstalled, NotInstalled
 from message import reply as echo
 from auth import admin
+import amelia
 import util
 import auth
 
@@ -26,30 +27,31 @@ def _echo(bot, id, target, args, full_msg):
 @link('!raw')
 @admin
 def _raw(bot, id, target, args, full_msg):
-    bot.send_cmd(args)
+    bot.send_cmd(args, priority=True)
 
 @link('!msg')
 @admin
 def _msg(bot, id, target, args, full_msg):
     match = re.match('(?P<whom>\S*)\s*(?P<msg>.*)$', args)
-    bot.send_msg(*match.group('whom', 'msg'))
+    bot.send_msg(*match.group('whom', 'msg'), priority=True)
 
 @link('!act')
 @admin
 def _act(bot, id, target, args, full_msg):
     match = re.match('(?P<whom>\S*)\s*(?P<msg>.*)$', args)
-    bot.send_msg(match.group('whom'), '\1ACTION ' + match.group('msg') + '\1')
+    bot.send_msg(match.group('whom'), '\1ACTION ' + match.group('msg') + '\1',
+                 priority=True)
 
 @link('!j')
 @link('!join')
 @admin
 def _join(bot, id, target, args, full_msg):
-    bot.send_cmd('JOIN :%s' % args)
+    bot.send_cmd('JOIN :%s' % bot.qualify(args))
 
 @link('!part')
 @admin
 def _part(bot, id, target, args, full_msg):
-    bot.send_cmd('PART :%s' % (args or target))
+    bot.send_cmd('PART :%s' % bot.qualify(args or target))
 
 @link('!quit')
 @admin
@@ -90,6 +92,28 @@ def _mcall(bot, id, target, args, full_msg, reply):
         result = e
     reply(repr(result))
 
+@link('!send-queue')
+@admin
+def _send_queue(bot, id, target, args, full_msg):
+    depths = sorted(bot.queue_depths().iteritems(), key=lambda (t,n): -n)
+    echo(bot, id, target, '%d line(s) queued%s. Sent: %d; throttled: %d times;'
+        ' max queued: %d; coalesced: %d.' % (
+            bot.send_queued,
+            ' (%s)' % ', '.join('%s: %d' % (t or '*', n) for (t,n) in depths[:5])
+                if depths else '',
+            bot.send_stats['sent'], bot.send_stats['throttled'],
+            bot.send_stats['max_queued'], bot.send_stats['coalesced']),
+        priority=True)
+
+@link('!plugin-times')
+@admin
+def _plugin_times(bot, id, target, args, full_msg):
+    count = int(args) if args.strip().isdigit() else 5
+    echo(bot, id, target, 'Plugins loaded in %.3fs. Slowest: %s.' % (
+        sum(map(sum, bot.plugin_times.itervalues())),
+        ', '.join('%s (import %.3fs, install %.3fs)' % ((name,) + tuple(times))
+                  for (name, times) in bot.slowest_plugins(count)) or 'none'))
+
 @link('!load')
 @admin
 def _load(bot, id, target, args, full_msg):
@@ -123,7 +147,9 @@ def h_soft_reload(bot, id, target, args, full_msg):
 def h_hard_reload(bot, id, target, args, full_msg):
     return h_reload(bot, id, target, hard=True)
 
+# Modules are reinstalled on every bot, on any network, which had them installed.
 def h_reload(bot, id, target, hard):
+    bots = [bot] + [b for b in amelia.networks.itervalues() if b is not bot]
     plugins = bot.conf['plugins']
     def order(m):
         name = m.__name__
@@ -135,17 +161,26 @@ def h_reload(bot, id, target, hard):
     names = [m.__name__ for m in local]
     
     old_modules = dict()
+    old_bots = dict()
     expns = dict()
 
     # Uninstall all local modules (see util.module_is_local for definition).
     for module in reversed(local):
         try:
-            if not hard and hasattr(module, 'reload_uninstall'):
-                module.reload_uninstall(bot)
-            elif hard and hasattr(module, 'hard_reload_uninstall'):
-                module.hard_reload_uninstall(bot)
-            elif hasattr(module, 'uninstall'):
-                module.uninstall(bot)
+            mbots = []
+            for mbot in bots:
+                try:
+                    if not hard and hasattr(module, 'reload_uninstall'):
+                        module.reload_uninstall(mbot)
+                    elif hard and hasattr(module, 'hard_reload_uninstall'):
+                        module.hard_reload_uninstall(mbot)
+                    elif hasattr(module, 'uninstall'):
+                        module.uninstall(mbot)
+                except NotInstalled:
+                    continue
+                mbots.append(mbot)
+            if not mbots:
+                raise NotInstalled
         except NotInstalled:
             names.remove(module.__name__)
         except Exception as e:
@@ -153,6 +188,7 @@ def h_reload(bot, id, target, hard):
             traceback.print_exc()
         else:
             old_modules[module.__name__] = module
+            old_bots[module.__name__] = mbots
         del sys.modules[module.__name__]
     if expns:
         echo(bot, id, target, 'Errors during uninstall: ' + repr(expns))
@@ -163,27 +199,32 @@ def h_reload(bot, id, target, hard):
         try:
             module = import_module(name)
             if name not in old_modules: continue
+            if not hard:
+                util.preserve_reload_state(module, old_modules[name])
             if hasattr(module, 'reload') and not hard:
                 module.reload(old_modules[name])
             elif hasattr(module, 'hard_reload') and hard:
                 module.hard_reload(old_modules[name])
             if hasattr(module, 'install'):
-                try:
-                    module.install(bot)
-                except AlreadyInstalled:
-                    pass
+                for mbot in old_bots[name]:
+                    try:
+                        module.install(mbot)
+                    except AlreadyInstalled:
+                        pass
         except Exception as e:
             expns[name] = e
             traceback.print_exc()
     if expns:
         for name in expns:
             if name in old_modules and hasattr(old_modules[name], 'uninstall'):
-                try: old_modules[name].uninstall(bot)
-                except NotInstalled: pass
-                except: traceback.print_exc()
+                for mbot in old_bots[name]:
+                    try: old_modules[name].uninstall(mbot)
+                    except NotInstalled: pass
+                    except: traceback.print_exc()
         echo(bot, id, target, 'Errors during reinstall: ' + repr(expns))
 
-    yield sign('POST_RELOAD', bot)
+    for mbot in bots:
+        yield util.msign(mbot, 'POST_RELOAD', mbot)
     echo(bot, id, target, 'Reload complete.')
 
     raise Stop
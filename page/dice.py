@@ -8,10 +8,8 @@ from numbers import Integral
 import re
 import random
 import math
-import os
-import os.path
+import bisect
 import time
-import json
 import datetime
 import string
 import sys
@@ -23,6 +21,8 @@ import util
 import message
 import modal
 import channel
+import workers
+import store
 
 link, install, uninstall = util.LinkSet().triple()
 
@@ -45,6 +45,9 @@ MAX_NAMES_EXPANDED = 5000
 MAX_STACK_DEPTH    = 500
 MAX_MESSAGE_LENGTH = 400
 
+# The time limit, in seconds, for a !roll evaluated by a worker process.
+ROLL_TIMEOUT_S = 10
+
 #===============================================================================
 @link('HELP*', ('BRIDGE', 'HELP*'))
 def h_help(bot, reply, args):
@@ -112,9 +115,13 @@ def h_roll(bot, id, target, args, full_msg, action):
     def reply(rmsg):
         message.reply(bot, id, target, rmsg, prefix=False)
         bot.drive('runtime.later', sign('PROXY_MSG', bot, id, target, rmsg))
-    return roll(bot, id, target, args, action, reply)
+    return roll(bot, id, target, args, action, reply, defer=True)
 
-def roll(bot, id, target, args, action=False, reply=None, error_reply=None):
+# If `defer' is true and the bot has worker processes, returns a generator
+# which evaluates the roll in a worker process and then replies; otherwise,
+# evaluates the roll immediately and returns the result of `reply'.
+def roll(bot, id, target, args, action=False, reply=None, error_reply=None,
+         defer=False):
     reply = reply or (lambda rmsg: rmsg)
     error_reply = error_reply or reply
     def reply_(rmsg=None, from_name=None, prefix=True):
@@ -125,7 +132,12 @@ def roll(bot, id, target, args, action=False, reply=None, error_reply=None):
         if rmsg is None: rmsg = from_name(id.nick)
         if prefix and target is not None: rmsg = '%s: %s' % (id.nick, rmsg)
         return error_reply(rmsg)
-    defs = PrivateDefs(id) if target is None else global_defs.get(target.lower())
+    if defer and workers.enabled(bot):
+        defs, chan_defs = snapshot_defs(bot, id, target)
+        return h_roll_defs_deferred(bot, id, target, args, AutoDefs(defs),
+            chan_defs, action, reply_, error_reply_)
+    defs = PrivateDefs(bot, id) if target is None else \
+           global_defs.get(target.lower())
     defs = AutoDefs(defs)
     return h_roll_defs(bot, id, target, args, defs, action, reply_, error_reply_)
 
@@ -137,26 +149,50 @@ def h_simple_roll(bot, name, target, args, reply, action):
 
 def h_roll_defs(bot, id, target, args, defs, action, reply, error_reply):
     try:
-        msg, rolls = eval_string(
-            parse_string(args), defs=defs, user_id=id, irc=True,
-            max_len            = MAX_MESSAGE_LENGTH,
-            max_names_expanded = MAX_NAMES_EXPANDED,
-            max_stack_depth    = MAX_STACK_DEPTH)
-
-        if target and target.startswith('#'):
-            bot.drive('DICE_ROLLS', bot, id, target, rolls, msg)
-
-        if action:
-            from_name = lambda name: '* %s %s' % (name, msg)
-            return reply(from_name=from_name, prefix=False)
-        else:
-            return reply(msg)
+        msg, rolls = eval_roll(args, defs, id)
+        return roll_reply(bot, id, target, msg, rolls, action, reply)
     except UserError as e:
         return error_reply('Error: %s' % e.message)
     except Exception as e:
         error_reply('Error: %r' % e)
         raise
 
+def h_roll_defs_deferred(
+    bot, id, target, args, defs, chan_defs, action, reply, error_reply
+):
+    try:
+        msg, rolls = yield workers.call(bot, eval_roll, args, defs, id,
+                                        chan_defs, timeout=ROLL_TIMEOUT_S)
+        roll_reply(bot, id, target, msg, rolls, action, reply)
+    except UserError as e:
+        error_reply('Error: %s' % e.message)
+    except workers.WorkerTimeout:
+        error_reply('Error: the evaluation took too long.')
+    except Exception as e:
+        error_reply('Error: %r' % e)
+        raise
+
+def roll_reply(bot, id, target, msg, rolls, action, reply):
+    if target and target.startswith('#'):
+        bot.drive('DICE_ROLLS', bot, id, target, rolls, msg)
+
+    if action:
+        from_name = lambda name: '* %s %s' % (name, msg)
+        return reply(from_name=from_name, prefix=False)
+    else:
+        return reply(msg)
+
+# Returns (str, [roll_spec_1, roll_spec_2, ...]) as the result of the given
+# !roll arguments. If `chan_defs' is given, it is used as in eval_string_parts.
+# This may be called in a worker process, given the result of snapshot_defs().
+def eval_roll(args, defs, user_id, chan_defs=None):
+    return eval_string(
+        parse_string(args), defs=defs, user_id=user_id, irc=True,
+        chan_defs          = chan_defs,
+        max_len            = MAX_MESSAGE_LENGTH,
+        max_names_expanded = MAX_NAMES_EXPANDED,
+        max_stack_depth    = MAX_STACK_DEPTH)
+
 #===============================================================================
 # Evaluation of abstract syntax trees produced by the !roll argument parser.
 
@@ -173,20 +209,24 @@ class EvalRecord():
         self.stack_depth = 0
 
 EvalContext = namedtuple('EvalContext', (
-    'defs', 'user_id', 'record', 'max_names_expanded', 'max_stack_depth'))
+    'defs', 'user_id', 'chan_defs', 'record', 'max_names_expanded',
+    'max_stack_depth'))
 
 # Returns (str, [roll_spec_1, roll_spec_2, ...])
 def eval_string(*args, **kwds):
     parts, rolls = eval_string_parts(*args, **kwds)
     return (''.join(parts), rolls)
 
-# Returns (str_iterator, [roll_spec_1, roll_spec_2, ...])
+# Returns (str_iterator, [roll_spec_1, roll_spec_2, ...]). If `chan_defs' is
+# given, it is a dict mapping the lowercase name of each channel shared by the
+# bot and `user_id' to a dict of the definitions in that channel, or None, and
+# is used instead of the current state to resolve names like "#channel:name".
 def eval_string_parts(
-    string, max_len=None, irc=False, defs=None, user_id=None,
+    string, max_len=None, irc=False, defs=None, user_id=None, chan_defs=None,
     max_names_expanded=None, max_stack_depth=None
 ):
     context = EvalContext(
-        defs=defs, user_id=user_id, record=EvalRecord(),
+        defs=defs, user_id=user_id, chan_defs=chan_defs, record=EvalRecord(),
         max_names_expanded=max_names_expanded,
         max_stack_depth=max_stack_depth)
 
@@ -282,11 +322,17 @@ def e_name_(name, namespace, ast_node, context):
         if context.user_id is None:
             raise RollNameError(str(ast_node.source))
         chan_lower = namespace.lower()
-        if context.user_id.nick.lower() not in \
-        map(str.lower, channel.track_channels[chan_lower]):
+        if context.chan_defs is not None:
+            in_chan = chan_lower in context.chan_defs
+        else:
+            in_chan = context.user_id.nick in channel.track_channels[chan_lower]
+        if not in_chan:
             raise UserError('To use "%s", you and this bot must both be in %s.'
             % (abbrev_middle(str(ast_node.source)), abbrev_right(namespace)))
-        context = context._replace(defs=AutoDefs(global_defs.get(chan_lower)))
+        chan_defs = context.chan_defs[chan_lower] \
+                    if context.chan_defs is not None else \
+                    global_defs.get(chan_lower)
+        context = context._replace(defs=AutoDefs(chan_defs))
     if context.defs is None or name not in context.defs:
         raise RollNameError(name)
     def e_name_gen():
@@ -858,56 +904,76 @@ def rd_func_remove_punctuation(context, parts):
 #===============================================================================
 # Maintenance of global definitions.
 
+# The definitions are persisted by a store.Store, in which the key (chan, name)
+# holds GlobalDef.save_jdict() for each definition, and the key (chan,) holds
+# the decay_start of each channel's GlobalDefs. Only changed records are written
+# to disk, so save_def and related functions should be called after each change.
 def load_defs():
-    if not os.path.exists(DEF_FILE):
-        return {}
-    with open(DEF_FILE, 'r') as file:
-        jdict = util.recursive_encode(json.load(file), 'utf8')
-        return {c: GlobalDefs(jdict=d) for (c,d) in jdict.iteritems()}
+    global_defs = {}
+    for key, value in def_store.load().iteritems():
+        chan = key[0]
+        if chan not in global_defs:
+            global_defs[chan] = GlobalDefs()
+        if len(key) > 1:
+            global_defs[chan][key[1]] = GlobalDef(name=key[1], jdict=value)
+        else:
+            global_defs[chan].decay_start = value
+    return global_defs
+
+# Converts between the records of def_store and the JSON object saved in
+# DEF_FILE, which has the same format as a dict of GlobalDefs.save_jdict().
+def encode_defs(records):
+    jdict = {}
+    for key, value in records.iteritems():
+        cdict = jdict.setdefault(key[0], {'names': {}})
+        if len(key) > 1:
+            cdict['names'][key[1]] = value
+        else:
+            cdict['decay_start'] = value
+    return jdict
+
+def decode_defs(jdict):
+    records = {}
+    for chan, cdict in jdict.iteritems():
+        for name, ddict in cdict['names'].iteritems():
+            records[chan, name] = ddict
+        if cdict.get('decay_start') is not None:
+            records[chan,] = cdict['decay_start']
+    return records
+
+# Records the current state of the definition `name' in `chan'.
+def save_def(chan, name):
+    defs = global_defs.get(chan)
+    if defs is not None and name in defs:
+        def_store.put((chan, name), defs[name].save_jdict())
+    else:
+        def_store.delete((chan, name))
 
-def save_defs(backup=True):
-    prune_defs()
-    jstring = json.dumps({
-        c: d.save_jdict() for (c,d) in global_defs.iteritems()},
-        separators=(',', ':'))
-
-    if backup:
-        if not os.path.exists(os.path.dirname(DEF_BACKUP_NAME)):
-            os.mkdir(os.path.dirname(DEF_BACKUP_NAME))
-        prev_name = None
-        for n in xrange(DEF_BACKUPS, -1, -1):
-            name = (DEF_BACKUP_NAME % n) if n > 0 else DEF_FILE
-            # To prevent floods of changes from destroying all viable backups,
-            # the oldest, 2nd-oldest, and 3rd-oldest backups are only replaced
-            # by files newer than them by resp. 1 day, 1 hour, and 5 minutes.
-            # (Unless DEF_BACKUPS < 4, in which case the 4th-, 3rd- and
-            # 2nd-newest backups, when they exist, assume these roles.)
-            min_d = 86400 if n == max(3, DEF_BACKUPS-1) else \
-                     3600 if n == max(2, DEF_BACKUPS-2) else \
-                      300 if n == max(1, DEF_BACKUPS-3) else None
-            if os.path.exists(name) and prev_name is not None \
-            and (not os.path.exists(prev_name) \
-            or os.stat(name).st_mtime - os.stat(prev_name).st_mtime > min_d):
-                os.rename(name, prev_name)
-            prev_name = name
-
-    if not os.path.exists(os.path.dirname(DEF_FILE)):
-        os.mkdir(os.path.dirname(DEF_FILE))
-
-    with open(DEF_FILE, 'w') as file:
-        file.write(jstring)
+# Records the current decay_start of the definitions in `chan'.
+def save_decay(chan):
+    defs = global_defs.get(chan)
+    if defs is not None and defs.decay_start is not None:
+        def_store.put((chan,), defs.decay_start)
+    else:
+        def_store.delete((chan,))
 
 def prune_defs():
     now, to_remove = int(time.time()), []
     for name, defs in global_defs.iteritems():
         if name in channel.track_channels:
-            defs.decay_start = None
+            if defs.decay_start is not None:
+                defs.decay_start = None
+                save_decay(name)
         elif defs.decay_start is None:
             defs.decay_start = now
+            save_decay(name)
         elif defs.decay_start < now - DEF_DECAY_S:
             to_remove.append(name)
     for name in to_remove:
-        del global_defs[name]
+        defs = global_defs.pop(name)
+        for def_name in defs:
+            save_def(name, def_name)
+        save_decay(name)
 
 class DictStack(object, DictMixin):
     __slots__ = 'stack'
@@ -924,10 +990,18 @@ class DictStack(object, DictMixin):
                 if all(key not in self.stack[j] for j in xrange(i)):
                     yield key
 
+# A dict of GlobalDef instances keyed by name, which additionally maintains
+# `name_index', a sorted list of (name.lower(), name) for each definition, and
+# `owner_index', mapping each 'nick!user@host'.lower() of the definitions' ids
+# (or '*!*@*' where the id is None) to the set of names having that id. These
+# are used by def_search, and are only maintained by __setitem__ and
+# __delitem__, so other methods of modifying the dict must not be used.
 class GlobalDefs(dict):
-    __slots__ = 'decay_start'
+    __slots__ = 'decay_start', 'name_index', 'owner_index'
     def __init__(self, decay_start=None, jdict=None):
         super(GlobalDefs, self).__init__()
+        self.name_index = []
+        self.owner_index = {}
         if jdict is None:
             self.decay_start = decay_start
         else:
@@ -943,6 +1017,19 @@ class GlobalDefs(dict):
     def touch(self):
         if self.decay_start is not None:
             self.decay_start = time.time()
+    def __setitem__(self, name, defn):
+        if name in self: del self[name]
+        super(GlobalDefs, self).__setitem__(name, defn)
+        bisect.insort(self.name_index, (name.lower(), name))
+        self.owner_index.setdefault(def_owner(defn), set()).add(name)
+    def __delitem__(self, name):
+        defn = self[name]
+        super(GlobalDefs, self).__delitem__(name)
+        del self.name_index[bisect.bisect_left(
+            self.name_index, (name.lower(), name))]
+        owner = def_owner(defn)
+        self.owner_index[owner].discard(name)
+        if not self.owner_index[owner]: del self.owner_index[owner]
 
 class Def(object):
     __slots__ = 'name', '_body_str', '_body_ast'
@@ -990,9 +1077,9 @@ class GlobalDef(Def):
 
 # Definitions usable by a user by private message.
 class PrivateDefs(DictStack):
-    def __init__(self, id):
+    def __init__(self, bot, id):
         key = ('%s!%s@%s' % id).lower()
-        stack = [UserChannelDefs(id)]
+        stack = [UserChannelDefs(bot, id)]
         if key in global_defs:
             stack.insert(0, global_defs[key])
         super(PrivateDefs, self).__init__(*stack)
@@ -1000,17 +1087,17 @@ class PrivateDefs(DictStack):
 # Definitions from channels a user is in, where the most recently changed
 # definition takes priority in case of a name collision.
 class UserChannelDefs(DictMixin):
-    __slots__ = 'id'
+    __slots__ = 'bot', 'id'
 
-    def __init__(self, id):
+    def __init__(self, bot, id):
+        self.bot = bot
         self.id = id
 
     def __getitem__(self, key):
         defn = None
-        for chan, nicks in channel.track_channels.iteritems():
-            if chan.lower() in global_defs and key in global_defs[chan.lower()] \
-            and any(self.id.nick.lower() == n.lower() for n in nicks):
-                chan_defn = global_defs[chan.lower()][key]
+        for chan in channel.user_channels(self.bot, self.id.nick):
+            if chan in global_defs and key in global_defs[chan]:
+                chan_defn = global_defs[chan][key]
                 if defn is None or chan_defn.time > defn.time:
                     defn = chan_defn
         if defn is None:
@@ -1018,12 +1105,29 @@ class UserChannelDefs(DictMixin):
         return defn
 
     def __iter__(self):
-        for chan, nicks in channel.track_channels.iteritems():
-            if chan.lower() in global_defs \
-            and any(self.id.nick.lower() == n.lower() for n in nicks):
-                for key in global_defs[chan.lower()]:
+        for chan in channel.user_channels(self.bot, self.id.nick):
+            if chan in global_defs:
+                for key in global_defs[chan]:
                     yield key
 
+# Returns (defs, chan_defs), where `defs' is a dict of the definitions usable by
+# `id' in `target' (or by private message, if `target' is None), and `chan_defs'
+# is as in eval_string_parts; these contain copies of the current definitions,
+# so that they may be passed to a worker process.
+def snapshot_defs(bot, id, target):
+    chan_defs = {
+        chan: dict(global_defs[chan]) if chan in global_defs else None
+        for chan in channel.user_channels(bot, id.nick)}
+    if target is not None:
+        return dict(global_defs.get(target.lower(), ())), chan_defs
+    defs = dict()
+    for cdefs in chan_defs.itervalues():
+        for name, defn in (cdefs or {}).iteritems():
+            if name not in defs or defn.time > defs[name].time:
+                defs[name] = defn
+    defs.update(global_defs.get(('%s!%s@%s' % id).lower(), ()))
+    return defs, chan_defs
+
 # Automatic definitions provided in addition to, and possibly derived from, an
 # iterable dict-like container of underlying definitions. Not iterable.
 class AutoDefs(DictStack):
@@ -1082,6 +1186,9 @@ class CaseAutoDef(Def):
         else:
             return rd_func_title_case(context, str_iter)
 
+def_store = store.Store(
+    DEF_FILE, encode=encode_defs, decode=decode_defs,
+    backups=DEF_BACKUPS, backup_name=DEF_BACKUP_NAME)
 global_defs = load_defs()
 
 #-------------------------------------------------------------------------------
@@ -1177,7 +1284,9 @@ def h_roll_def_p(bot, id, target, args, full_msg):
         name=name, id=def_id, modes=def_modes, time=now, body_str=body)
     defs.touch()
     global_defs[chan] = defs
-    save_defs()
+    save_def(chan, name)
+    save_decay(chan)
+    prune_defs()
 
     msg = 'Defined.'
     odefs = sorted(o for o in defs if o.lower() == name.lower() and o != name)
@@ -1223,10 +1332,12 @@ def h_roll_def_m(bot, id, target, args, full_msg):
     if chan in global_defs:
         for defn in ddefs:
             del global_defs[chan][defn.name]
+            save_def(chan, defn.name)
         global_defs[chan].touch()
         if not global_defs[chan]:
             del global_defs[chan]
-        save_defs()
+        save_decay(chan)
+        prune_defs()
 
     udefs_str = ', '.join(d.name for d in udefs)
     if len(udefs_str) > 300: udefs_str = udefs_str[:300] + '(...)'
@@ -1254,8 +1365,7 @@ def h_roll_def_q(bot, id, target, args, full_msg):
         chan = args.pop(0)
         chan_case = channel.capitalisation.get(chan, chan)
         chan = chan.lower()
-        nick = id.nick.lower()
-        if not any(nick == n.lower() for n in channel.track_channels[chan]):
+        if id.nick not in channel.track_channels[chan]:
             return message.reply(bot, id, target,
                 'Error: both you and this bot must be present in %s to search'
                 ' its definitions.' % chan_case)
@@ -1270,12 +1380,12 @@ def h_roll_def_q(bot, id, target, args, full_msg):
     chan = chan_case.lower()
     if chan in global_defs:
         global_defs[chan].touch()
+        save_decay(chan)
     if args:
         count = roll_def_query(
             bot, id, target, args, chan, chan_case,
             multiple=True, skip_empty=True)
-        for ex_chan, nicks in channel.track_channels.iteritems():
-            if all(n.lower() != id.nick.lower() for n in nicks): continue
+        for ex_chan in sorted(channel.user_channels(bot, id.nick)):
             ex_chan_case = channel.capitalisation.get(ex_chan, ex_chan)
             count += roll_def_query(
                 bot, id, target, args, ex_chan, ex_chan_case,
@@ -1305,8 +1415,9 @@ def roll_def_query(
 
     if len(defs) == 0:
         chan_defs = sum(
-            len(defs) for chan, defs in global_defs.iteritems() if defs
-            and id.nick.lower() in map(str.lower, channel.track_channels[chan]))
+            len(global_defs[chan])
+            for chan in channel.user_channels(bot, id.nick)
+            if chan in global_defs)
         suffix = ' Use \2!rd? *\2 to view definitions in all of your channels' \
                  ' or \2!rd? #CHANNEL\2 for those in a particular channel.' \
                  if private and chan_defs and not args else ''
@@ -1366,36 +1477,72 @@ def roll_def_query(
 # An iterator over the definitions matched by `queries' as per !rd? and !rd-,
 # sorted according to (1) the position of the first matching positive query in the
 # sequence, and (2) by the case-insensitive name of the definition.
-def def_search(chan, queries, *args, **kwds):
+def def_search(chan, queries, match_case=True):
     pos, neg = [], []
     for query in queries:
         if query.startswith('!'):
-            neg.append(query[1:])
+            neg.append(DefQuery(query[1:], match_case))
         else:
-            pos.append(query)
+            pos.append(DefQuery(query, match_case))
     if not pos:
-        pos.append('*')
+        pos.append(DefQuery('*', match_case))
 
-    results = []
-    for defn_name, defn in global_defs.get(chan, {}).iteritems():
-        if any(def_match(neg_q, d, *args, **kwds) for neg_q in neg):
-            continue
-        for pos_q, pos_q_index in izip(pos, count()):
-            if def_match(pos_q, defn, *args, **kwds):
-                sort_key = (pos_q_index, defn_name.lower(), defn_name)
-                results.append((defn, sort_key))
-                break
+    defs = global_defs.get(chan)
+    if not defs: return iter(())
+
+    excluded = set()
+    for neg_q in neg:
+        excluded.update(neg_q.search(defs))
 
-    return (d for (d,_) in sorted(results, key=lambda t: t[1]))
+    results = {}
+    for pos_q_index, pos_q in izip(count(), pos):
+        for name in pos_q.search(defs):
+            if name not in excluded and name not in results:
+                results[name] = pos_q_index
+
+    return (defs[n] for n in sorted(results,
+            key=lambda n: (results[n], n.lower(), n)))
 
 # True iff `query' positively matches `defn' as per !rd? and !rd-.
 def def_match(query, defn, match_case=True):
-    if '!' in query or '@' in query:
-        id_str = ('%s!%s@%s' % defn.id) if defn.id is not None else '*!*@*'
-        return re.match(util.wc_to_re(query), id_str, flags=re.I) is not None
-    else:
-        flags = 0 if match_case else re.I
-        return re.match(util.wc_to_re(query), defn.name, flags=flags) is not None
+    return DefQuery(query, match_case).match(defn)
+
+# The string matched against queries of the form NICK!USER@HOST.
+def def_owner(defn):
+    return ('%s!%s@%s' % defn.id).lower() if defn.id is not None else '*!*@*'
+
+# A compiled query as per !rd? and !rd-, which may be matched against many
+# definitions without being recompiled.
+class DefQuery(object):
+    __slots__ = 'owner', 'regex', 'prefix', 'literal', 'match_case'
+    def __init__(self, query, match_case=True):
+        self.owner = '!' in query or '@' in query
+        self.match_case = match_case and not self.owner
+        flags = 0 if self.match_case else re.I
+        self.regex = re.compile(util.wc_to_re(query), flags)
+        self.prefix = re.match(r'[^*?]*', query).group()
+        self.literal = len(self.prefix) == len(query)
+
+    def match(self, defn):
+        string = def_owner(defn) if self.owner else defn.name
+        return self.regex.match(string) is not None
+
+    # An iterator over the names of the definitions in the given GlobalDefs
+    # instance matching this query, in no particular order.
+    def search(self, defs):
+        if self.owner:
+            for owner, names in defs.owner_index.iteritems():
+                if self.regex.match(owner):
+                    for name in names: yield name
+        elif self.literal and self.match_case:
+            if self.prefix in defs: yield self.prefix
+        else:
+            # Consider only the names starting with the query's literal prefix.
+            index, prefix = defs.name_index, self.prefix.lower()
+            for i in xrange(bisect.bisect_left(index, (prefix,)), len(index)):
+                lower_name, name = index[i]
+                if not lower_name.startswith(prefix): break
+                if self.regex.match(name): yield name
 
 #===============================================================================
 # Miscellaneous utilities:
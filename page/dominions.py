@@ -7,13 +7,12 @@ import sys
 import re
 import os.path
 
-from bs4 import BeautifulSoup
-
 from untwisted.magic import sign
-from util import recursive_encode
+from util import recursive_encode, BeautifulSoup
 import channel
 import runtime
 import message
+import store
 import util
 import auth
 
@@ -31,16 +30,18 @@ AI = re.compile(r'AI$')
 link = util.LinkSet()
 is_installed = False
 
+# The periodic update is run by the first bot on which this is installed.
 def install(bot):
     global is_installed   
     link.install(bot)
+    if is_installed: return
     is_installed = True
     bot.drive('DOMINIONS_TICK', bot, log_level=2)
 
 def uninstall(bot):
     global is_installed
     link.uninstall(bot)
-    is_installed = False
+    is_installed = bool(link.installed_modes)
 
 install, uninstall = util.depend(install, uninstall,
     'auth', 'identity', 'channel')
@@ -54,6 +55,8 @@ class State(object):
         if jdict is not None: self.load_jdict(jdict)
 
     def load_path(self, path):
+        # Complete any write left pending from before this module was reloaded.
+        store.flush()
         jdict = {}
         if os.path.exists(path):
             try:
@@ -64,9 +67,9 @@ class State(object):
         jdict = recursive_encode(jdict, 'utf-8')
         self.load_jdict(jdict)
 
+    # The file is written in the background by the store module.
     def save_path(self, path):
-        with open(path, 'w') as file:
-            json.dump(self.save_jdict(), file, indent=4)
+        store.write_file(path, json.dumps(self.save_jdict(), indent=4))
 
     def load_jdict(self, jdict):
         all_urls = set()
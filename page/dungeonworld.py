@@ -55,8 +55,7 @@ def h_help_insert_missed_roll(bot, reply, args):
 @link('!view-missed-rolls')
 def h_view_missed_rolls(bot, id, target, args, full_msg):
     if args:
-        nicks = map(str.lower, channel.track_channels[args.lower()])
-        if id.nick.lower() not in nicks:
+        if id.nick not in channel.track_channels[args.lower()]:
             message.reply(bot, id, target,
                 'Error: you must be in "%s" to view its rolls.' % args)
             return
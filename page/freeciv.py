@@ -19,14 +19,16 @@ import time
 from untwisted.magic import sign
 import untwisted.mode
 import untwisted.event
-import untwisted.utils.common
 import untwisted.utils.std
+from untwisted.utils.framing import Buffer
 
 from util import UserError
 from message import reply
+import amelia
 import runtime
 import channel
 import auth
+import store
 import util
 import bridge
 import identity
@@ -41,6 +43,8 @@ MAX_RECONNECT_DELAY_S = 3600 # 1 hour
 TURN_NOTIFY_INTERVAL_S = 12 * 3600 # 12 hours
 INDIVIDUAL_TURN_NOTIFY_INTERVAL_S = 0
 RECV_TIMEOUT_S = 3 * 60 # 3 minutes
+MAX_DELTA_PACKETS = 100000 # The greatest size of the delta state, in packets.
+RECV_SIZE = 64 * 1024
 
 Version = namedtuple('Version', ('major_version', 'minor_version', 'patch_version'))
 DEFAULT_VERSION = Version(2, 6, 0)
@@ -48,8 +52,18 @@ AUX_CAPABILITY = 'techloss_forgiveness'
 STAGE_NEW, STAGE_INITIAL, STAGE_ACCEPTED, STAGE_LOADED = range(4)
 PACKETS = {}
 
+# The numbers of the packet types which are decoded when received, except by
+# connections in debug mode; other packets are discarded by split_packets()
+# without being decoded. A packet type is added to this set by fc_recv(), unless
+# it is registered with `interest=False'.
+RECV_INTEREST = set()
+
 COMPRESSION_BORDER = 0x4001
 JUMBO_SIZE = 0xFFFF
+PACKET_LENGTH = struct.Struct('!H')
+JUMBO_LENGTH = struct.Struct('!I')
+PACKET_TYPE_8 = struct.Struct('!B')
+PACKET_TYPE_16 = struct.Struct('!H')
 MAX_LEN_MSG = 1536
 MAX_LEN_PASSWORD = 512
 MAX_LEN_USERNAME = 48 # Hardcoded in Freeciv's packets.def.
@@ -68,7 +82,6 @@ PHASE_UNKNOWN = -2
 ab_link = util.LinkSet()
 fc_link = util.LinkSet()
 fc_link.link_module(untwisted.utils.std)
-fc_link.link(untwisted.event.DATA, untwisted.utils.common.append)
 fc_mode = None
 
 conf_loaded = False
@@ -106,22 +119,101 @@ connections = {}
 TurnInfo = namedtuple('TurnInfo', ('phase_mode', 'turn', 'phase'))
 
 class FreecivState(object):
-    data_version = 2
+    data_version = 4
     def __init__(self, name):
         self.name = name
         self.version = DEFAULT_VERSION
         self.debug = False
         self.stage = STAGE_NEW
         self.conn_id = None
-        self.last_recv = {}
-        self.last_send = {}
+        self.last_recv = DeltaState()
+        self.last_send = DeltaState()
+        self.recv_buf = Buffer()
+        self.packet_buf = Buffer()
         self.chunk_rem = 0
-        self.chunk_buf = ''
+        self.decompress_obj = None
         self.last_recv_time = None
+        self.recv_interest = RECV_INTEREST
+
+# The last packet sent or received of each type and key, on which the encoding of
+# the next depends, and from which the state of the game is read. Each packet is
+# stored as a tuple of its field values, ordered as the fields of its type, and
+# tables[number][(key1, ..., keyN)] holds the packet with the given key fields.
+# When read as a dict, as by `last_recv[PACKET_GAME_INFO,]', the key is instead
+# (number, key1, ..., keyN), and each packet is given as a new dict of its fields.
+class DeltaState(object):
+    __slots__ = 'tables', 'count'
+    def __init__(self):
+        self.tables = {}
+        self.count = 0
+
+    # The tuple of values stored with the given key, or None.
+    def lookup(self, key):
+        table = self.tables.get(key[0])
+        return table.get(key[1:]) if table is not None else None
+
+    def put(self, key, values):
+        table = self.tables.get(key[0])
+        if table is None: table = self.tables[key[0]] = {}
+        if key[1:] not in table: self.count += 1
+        table[key[1:]] = values
+
+    def discard(self, key):
+        table = self.tables.get(key[0])
+        if table is not None and table.pop(key[1:], None) is not None:
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __getitem__(self, key):
+        values = self.lookup(key)
+        if values is None: raise KeyError(key)
+        return PACKETS[key[0]].values_dict(values)
+
+    def get(self, key, default=None):
+        values = self.lookup(key)
+        return PACKETS[key[0]].values_dict(values) \
+               if values is not None else default
+
+    # Yields (key, packet) for each stored packet of the given type.
+    def iterpackets(self, number):
+        packet = PACKETS[number]
+        for key, values in self.tables.get(number, {}).iteritems():
+            yield (number,) + key, packet.values_dict(values)
+
+    def iteritems(self):
+        return chain.from_iterable(imap(self.iterpackets, self.tables))
+
+    # Returns {number: (count, size)}, where `count' is the number of packets of
+    # each type stored, and `size' is the approximate number of bytes used by
+    # them, counting each object not shared with other packets.
+    def memory_usage(self):
+        usage = {}
+        for number, table in self.tables.iteritems():
+            usage[number] = len(table), sys.getsizeof(table) + sum(
+                sizeof(k) + sizeof(v) for (k, v) in table.iteritems())
+        return usage
+
+# The approximate size in bytes of `obj' and of the objects it contains, other
+# than those which are (usually) shared.
+def sizeof(obj):
+    if obj is None or type(obj) is bool: return 0
+    if type(obj) is int and -5 <= obj <= 256: return 0
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(imap(sizeof, obj))
+    elif isinstance(obj, util.md_array):
+        size += sys.getsizeof(obj.array) + sizeof(obj.dimensions)
+    return size
 
 def install(bot):
     global fc_mode
     ab_link.install(bot)
+    if len(ab_link.installed_modes) > 1: return
     if fc_mode is None: fc_mode = untwisted.mode.Mode()
     fc_link.install(fc_mode)
     if not conf_loaded: load_conf()
@@ -154,10 +246,10 @@ def reload(prev):
         conf_username = conf['servers'][address]['username']
         if compatible and address in conf['servers'] \
         and conf_username in (None, work.freeciv_state.username):
-            work.destroy()
-            new_work = untwisted.network.Work(fc_mode, work.sock)
+            new_work = work.transfer(fc_mode)
             new_work.freeciv_state = FreecivState(name=address)
             new_work.freeciv_state.__dict__.update(work.freeciv_state.__dict__)
+            new_work.freeciv_state.recv_interest = RECV_INTEREST
             new_work.freeciv_state.debug = 'debug' in get_server_flags(address)
             connections[address] = new_work
         else:
@@ -173,10 +265,11 @@ def uninstall(bot, reload=False):
     try:
         global fc_mode
         ab_link.uninstall(bot)
-        fc_link.uninstall(fc_mode)
-        del fc_mode
+        if not ab_link.installed_modes:
+            fc_link.uninstall(fc_mode)
+            del fc_mode
     finally:
-        if not reload:
+        if not reload and not ab_link.installed_modes:
             for work in connections.itervalues():
                 disconnect(work)
             connections.clear()
@@ -203,6 +296,7 @@ def connect_raw(host, port, username, password, allow_local=False, debug=False):
                             ' address.' % state.name)
         work = untwisted.network.Work(fc_mode, socket.socket(fam, typ, pro))
         work.setblocking(0)
+        work.SIZE = RECV_SIZE
         work.freeciv_state = state
         connections[state.name] = work
         work.connect_ex(adr)
@@ -234,6 +328,8 @@ def disconnect(work):
 def load_conf():
     global conf, conf_loaded
     cur_version = conf['conf_version']
+    # Complete any write left pending from before this module was reloaded.
+    store.flush()
     if os.path.exists(CONF_FILE):
         try:
             with open(CONF_FILE, 'r') as file:
@@ -247,8 +343,7 @@ def load_conf():
     conf_loaded = True
 
 def save_conf():
-    with open(CONF_FILE, 'w') as file:
-       json.dump(conf, file, indent=4) 
+    store.write_file(CONF_FILE, json.dumps(conf, indent=4))
 
 def upgrade_conf(conf):
     if conf['conf_version'] == 1:
@@ -453,6 +548,27 @@ def h_fc_q(bot, id, target, args, full_msg):
         reply(bot, id, target, 'Error: %s' % e)
         if not isinstance(e, UserError): raise
 
+# Shows the number of packets held in the delta state of each connection, and
+# their approximate memory usage, with that of the largest packet types.
+@ab_link('!fc-mem', '!freeciv-mem')
+@auth.admin
+def h_fc_mem(bot, id, target, args, full_msg):
+    if not connections: return reply(bot, id, target,
+        'There are no connected Freeciv servers.', prefix=False)
+    for address, work in sorted(connections.iteritems()):
+        state, types = work.freeciv_state, defaultdict(lambda: [0, 0])
+        for delta_state in state.last_recv, state.last_send:
+            for number, (count, size) in delta_state.memory_usage().iteritems():
+                types[number][0] += count
+                types[number][1] += size
+        largest = sorted(types.iteritems(), key=lambda (n, (c, s)): -s)[:3]
+        reply(bot, id, target, '%s: %d/%d packets, %.1f KiB%s.' % (
+            address, sum(c for (c, s) in types.itervalues()), MAX_DELTA_PACKETS,
+            sum(s for (c, s) in types.itervalues()) / 1024.0,
+            ' (%s)' % ', '.join('%s: %d, %.1f KiB' % (
+                PACKETS[n].name, c, s / 1024.0) for (n, (c, s)) in largest)
+            if largest else ''), prefix=False)
+
 def cmd_chan(cmd_suf, bot, id, target, args, need_op):
     match = re.match(r'(?P<chan>#\S+)\s*(?P<args>.*)$', args)
     chan, args = match.group('chan', 'args') if match else (target, args)
@@ -461,7 +577,7 @@ def cmd_chan(cmd_suf, bot, id, target, args, need_op):
         ' name. See \2!help fc%s\2.' % cmd_suf)
     lchan = chan.lower()
     cchan = channel.capitalisation.get(lchan, chan)
-    if bot.nick.lower() not in map(str.lower, channel.track_channels[lchan]):
+    if bot.nick not in channel.track_channels[lchan]:
         raise UserError('To use this command, this bot must be in %s.%s' 
             % (cchan, '' if 'invite' not in sys.modules or bot not in
             sys.modules['invite'].link.installed_modes else (' You may cause it'
@@ -488,7 +604,7 @@ def should_report_player(player):
 @fc_link('FC_LOOP')
 def h_fc_loop():
     while ab_link.installed_modes:
-        bot, = ab_link.installed_modes
+        bot = any_bot()
         now = time.time()
 
         for addr, sconf in conf['servers'].iteritems():
@@ -501,17 +617,26 @@ def h_fc_loop():
                     yield sign('FC_CONN_ERR', state, 'timed out.')
                     continue
 
+                # Reset connections whose delta state has grown too large. No
+                # part of it may be discarded while the server still relies on
+                # it, so the state is instead rebuilt from a new connection.
+                if len(state.last_recv) + len(state.last_send) > MAX_DELTA_PACKETS:
+                    yield sign('FC_CONN_ERR', state, 'delta state limit exceeded.')
+                    continue
+
                 if state.stage < STAGE_LOADED: continue
 
                 # Notify users of their turns in games.
                 lntime = sconf.get('last_notify_time')
                 if lntime is None or lntime + TURN_NOTIFY_INTERVAL_S <= now:
                     for chan, cconf in conf['channels'].iteritems():
+                        cbot = amelia.chan_bot(chan)
+                        if cbot not in ab_link.installed_modes: continue
                         for csname, csconf in cconf.iteritems():
                             if csconf['address'] != addr: continue
                             nicks = list(channel.track_channels[chan])
                             yield notify_users(
-                                bot, chan, nicks, addr, csname, individual=False)
+                                cbot, chan, nicks, addr, csname, individual=False)
 
             else:
                 # Reconnect to disconnected servers.
@@ -586,7 +711,7 @@ def notify_users(bot, chan, nicks, addr, dname, individual):
         save_conf()
 
 def report_server_status(addrs, chans):
-    bot, = ab_link.installed_modes
+    bot = any_bot()
     for addr in addrs:
         tinfo = None
         if addr in connections:
@@ -599,8 +724,8 @@ def report_server_status(addrs, chans):
             bot.send_msg(chan, '%s: %s' % (dname, server_status_line(addr, tinfo)))
 
         if tinfo is not None and tinfo.phase_mode == PHASE_MODE.PLAYERS_ALTERNATE \
-        and player_name(state, tinfo.phase).lower() in \
-        (n.lower() for c in chans for n in channel.track_channels[c.lower()]):
+        and any(player_name(state, tinfo.phase) in channel.track_channels[c.lower()]
+                for c in chans):
             now = time.time()
             uname = state.last_recv[PACKET_PLAYER_INFO, tinfo.phase]['username']
             conf['servers'][addr]['last_notify_time'] = now
@@ -609,10 +734,17 @@ def report_server_status(addrs, chans):
     save_conf()
 
 def report(addr, msg):
-    bot, = ab_link.installed_modes
+    bot = any_bot()
     for chan, dname in linked_channels(addr):
         bot.send_msg(chan, '%s: %s' % (dname, msg))
 
+# A bot on which this module is installed, preferring that connected to the
+# primary network. Messages sent by it to channels on other networks are
+# forwarded to the relevant bots, as described in amelia.NETWORK_SEP.
+def any_bot():
+    bots, primary = ab_link.installed_modes, amelia.networks.get(None)
+    return primary if primary in bots or not bots else next(iter(bots))
+
 def linked_channels(addr):
     for chan, cconf in conf['channels'].iteritems():
         for dname, csconf in cconf.iteritems():
@@ -649,8 +781,8 @@ def game_status_line(state, turn_info=None):
 def players_to_move(state, turn_info=None):
     if turn_info is None: turn_info = get_turn_info(state)
     return [
-        p for (k, p) in state.last_recv.iteritems()
-        if k[0] == PACKET_PLAYER_INFO and turn_info.phase == {
+        p for (k, p) in state.last_recv.iterpackets(PACKET_PLAYER_INFO)
+        if turn_info.phase == {
             PHASE_MODE.CONCURRENT: turn_info.phase,
             PHASE_MODE.TEAMS_ALTERNATE: p['team'],
             PHASE_MODE.PLAYERS_ALTERNATE: p['playerno'],
@@ -659,8 +791,8 @@ def players_to_move(state, turn_info=None):
 
 # Returns a list of PACKET_PLAYER_INFO dicts.
 def players_on_team(state, team_id):
-    return [p for (k, p) in state.last_recv.iteritems()
-            if k[0] == PACKET_PLAYER_INFO and p['team'] == team_id]
+    return [p for (k, p) in state.last_recv.iterpackets(PACKET_PLAYER_INFO)
+            if p['team'] == team_id]
 
 def get_turn_info(state):
     game_info = state.last_recv[PACKET_GAME_INFO,]
@@ -703,46 +835,83 @@ def h_fc_conn_err(state, exc=None):
     sconf['last_error'] = str(exc) if exc is not None else None
     save_conf()
 
-@fc_link(untwisted.event.BUFFER)
-def h_buffer(work, data):
+@fc_link(untwisted.event.DATA)
+def h_data(work):
     state = work.freeciv_state
-    while data:
+    state.recv_buf.append(work.data)
+    state.last_recv_time = time.time()
+    for ptype, pdata in read_packets(state):
+        yield sign(('FC_RECV_PACKET_DATA', ptype), work, pdata)
+
+# Yields (packet_type, packet_data) for each complete packet in the data received
+# so far, decompressing any compressed chunks as their data arrives. The data is
+# read in place from the Buffers of `state', rather than sliced, so that the time
+# taken is linear in the amount of data received.
+def read_packets(state):
+    raw, inflated = state.recv_buf, state.packet_buf
+    while True:
         if state.chunk_rem:
-            chunk, data = data[:state.chunk_rem], data[state.chunk_rem:]
-            state.chunk_buf += state.decompress_obj.decompress(chunk)
-            state.chunk_rem -= len(chunk)
-            if state.chunk_rem: break
-            state.chunk_buf += state.decompress_obj.flush()
-            del state.decompress_obj
-
-        if len(data) < 2: break
-        length, = struct.unpack('!H', data[:2])
- 
+            size = min(state.chunk_rem, len(raw))
+            if not size: break
+            inflated.append(state.decompress_obj.decompress(raw.view(0, size)))
+            raw.skip(size)
+            state.chunk_rem -= size
+            if not state.chunk_rem:
+                inflated.append(state.decompress_obj.flush())
+                state.decompress_obj = None
+            for packet in split_packets(state, inflated):
+                yield packet
+            continue
+
+        if len(raw) < PACKET_LENGTH.size: break
+        length, = raw.unpack(PACKET_LENGTH)
+
         if length > COMPRESSION_BORDER:
             if length == JUMBO_SIZE:
-                if len(data) < 6: break
-                state.chunk_rem = struct.unpack('!I', data[2:6])[0] - 6
-                data = data[6:]
+                if len(raw) < 6: break
+                state.chunk_rem = raw.unpack(JUMBO_LENGTH, 2)[0] - 6
+                raw.skip(6)
             else:
                 state.chunk_rem = length - COMPRESSION_BORDER - 2
-                data = data[2:]
+                raw.skip(2)
             state.decompress_obj = zlib.decompressobj()
-            continue
-
-        state.chunk_buf += data[:length]
-        data = data[length:]
-    work.stack = data
-
-    while len(state.chunk_buf) >= 2:
-        length, = struct.unpack('!H', state.chunk_buf[:2])
-        if len(state.chunk_buf) < length: break
-        pdata, state.chunk_buf = state.chunk_buf[2:length], state.chunk_buf[length:]
-        if work.freeciv_state.stage <= STAGE_INITIAL \
-        or work.freeciv_state.version[:2] <= (2, 6):
-            ptype, pdata = struct.unpack('!B', pdata[:1]) + (pdata[1:],)
+        elif len(inflated):
+            # A packet left incomplete at the end of a compressed chunk.
+            if len(raw) < length: break
+            inflated.append(raw.view(0, length))
+            raw.skip(length)
+            for packet in split_packets(state, inflated):
+                yield packet
         else:
-            ptype, pdata = struct.unpack('!H', pdata[:2]) + (pdata[2:],)
-        yield sign(('FC_RECV_PACKET_DATA', ptype), work, pdata)
+            start = raw.pos
+            for packet in split_packets(state, raw, COMPRESSION_BORDER):
+                yield packet
+            if raw.pos == start: break
+
+# Yields (packet_type, packet_data) for each complete packet at the front of the
+# given Buffer, removing it from the queue, and stopping at the first
+# incomplete packet, or the first whose length is greater than `max_length'.
+# Packets of types not in `state.recv_interest' are removed without being yielded.
+def split_packets(state, queue, max_length=None):
+    buf, unpack_length = queue.buf, PACKET_LENGTH.unpack_from
+    interest = None if state.debug else state.recv_interest
+    while True:
+        start = queue.pos
+        if len(buf) - start < PACKET_LENGTH.size: break
+        length, = unpack_length(buf, start)
+        if len(buf) - start < length: break
+        if max_length is not None and length > max_length: break
+        queue.pos = start + max(length, PACKET_LENGTH.size)
+
+        if state.stage <= STAGE_INITIAL or state.version[:2] <= (2, 6):
+            type_struct = PACKET_TYPE_8
+        else:
+            type_struct = PACKET_TYPE_16
+        data_start = start + PACKET_LENGTH.size + type_struct.size
+        if data_start > start + length: continue
+        ptype, = type_struct.unpack_from(buf, start + PACKET_LENGTH.size)
+        if interest is not None and ptype not in interest: continue
+        yield ptype, str(buf[data_start:start + length])
 
 @fc_link('FC_SEND_PACKET_DATA')
 def h_fc_send_packet_data(work, packet_type, data):
@@ -753,6 +922,13 @@ def h_fc_send_packet_data(work, packet_type, data):
         header = struct.pack('!HH', len(data) + 4, packet_type)
     work.dump(header + data)
 
+# Returns a struct.Struct for the given format. These are shared, so that field
+# types with equal formats also have equal attributes.
+def get_struct(format):
+    if format not in structs: structs[format] = struct.Struct(format)
+    return structs[format]
+structs = {}
+
 class Field(object):
     def __init__(self, name, field_type, key=False):
         self.name = name
@@ -771,6 +947,11 @@ class FieldType(object):
     def delta_write(self, value, prev_value, *args, **kwds):
         return ('', False, False) if value == prev_value else \
                (self.write(value), True, True)
+    # As read(), but reads from offset `pos' of `data', and returns the offset
+    # following the value, rather than the remaining data.
+    def read_from(self, data, pos, prev_value=None, prev_fields={}):
+        value, rest = self.read(data[pos:], prev_value, prev_fields)
+        return value, len(data) - len(rest)
     def array_typecode(self):
         return None
     def value_repr(self, value):
@@ -818,6 +999,50 @@ class Array(FieldType):
             self.element_type.read(data[el_size*i:el_size*(i+1)])[0]
             for i in xrange(ar_size))), data[el_size*ar_size:]
 
+    def read_from(self, data, pos, prev_value=None, prev_fields={}):
+        if self.diff:
+            value = self.default() if prev_value is None else \
+                    prev_value.copy() if isinstance(prev_value, util.md_array) \
+                    else deepcopy(prev_value)
+            items = value.array if isinstance(value, util.md_array) else value
+            if isinstance(self.element_type, Struct) \
+            and not self.element_type.multi:
+                unpack = self.element_type.struct.unpack_from
+                size = self.element_type.struct.size
+                while data[pos] != '\xFF':
+                    items[ord(data[pos])], = unpack(data, pos + 1)
+                    pos += 1 + size
+            else:
+                read_element = self.element_type.read_from
+                while data[pos] != '\xFF':
+                    items[ord(data[pos])], pos = read_element(data, pos + 1)
+            return value, pos + 1
+
+        dimensions = self.get_dimensions(prev_fields)
+        typecode = self.element_type.array_typecode()
+        if typecode is None:
+            return self.read_list_from(data, pos, dimensions)
+        ar_size = reduce(operator.mul, dimensions)
+        if isinstance(self.element_type, Struct) and not self.element_type.multi:
+            ar_struct = get_struct('!%d%s' % (ar_size, self.element_type.format[1:]))
+            elements = ar_struct.unpack_from(data, pos)
+            return util.md_array(typecode, dimensions, elements), pos + ar_struct.size
+        read_element, elements = self.element_type.read_from, []
+        for i in xrange(ar_size):
+            element, pos = read_element(data, pos)
+            elements.append(element)
+        return util.md_array(typecode, dimensions, elements), pos
+
+    def read_list_from(self, data, pos, dimensions):
+        if len(dimensions) == 0:
+            return self.element_type.read_from(data, pos)
+        count, dimensions = dimensions[0], dimensions[1:]
+        list = []
+        for i in xrange(count):
+            value, pos = self.read_list_from(data, pos, dimensions)
+            list.append(value)
+        return list, pos
+
     def read_list(self, data, dimensions):
         if len(dimensions) == 0:
             return self.element_type.read(data)
@@ -878,6 +1103,11 @@ class Struct(FieldType):
     def __init__(self, format, multi=False):
         self.format = '!' + format
         self.multi = multi
+        self.struct = get_struct(self.format)
+    def read_from(self, data, pos, *args, **kwds):
+        value = self.struct.unpack_from(data, pos)
+        if not self.multi: (value,) = value
+        return value, pos + self.struct.size
     def read(self, data, *args, **kwds):
         size = struct.calcsize(self.format)
         value = struct.unpack(self.format, data[:size])
@@ -935,12 +1165,16 @@ class BitVector(Struct):
 
     def write(self, bits, *args, **kwds):
         return super(BitVector, self).write(
-            self.bytes_to_bits(bytes), *args, **kwds)
+            tuple(self.bits_to_bytes(bits)), *args, **kwds)
 
     def read(self, data, *args, **kwds):
         value, data = super(BitVector, self).read(data, *args, **kwds)
         return self.bytes_to_bits(value), data
 
+    def read_from(self, data, pos, *args, **kwds):
+        value, pos = super(BitVector, self).read_from(data, pos, *args, **kwds)
+        return self.bytes_to_bits(value), pos
+
     def default(self):
         return self.bytes_to_bits(super(BitVector, self).default())
 
@@ -974,6 +1208,11 @@ class String(FieldType):
         assert end < self.max_length, 'len(%r) = %d >= %d' % (
             data[:end], end, self.max_length)
         return data[:end], data[end+1:]
+    def read_from(self, data, pos, *args, **kwds):
+        end = data.find('\0', pos)
+        assert 0 <= end - pos < self.max_length, 'len(%r) = %d >= %d' % (
+            data[pos:end], end - pos, self.max_length)
+        return data[pos:end], end + 1
     def write(self, value, *args, **kwds):
         if type(value) is unicode: value = value.encode('utf8')
         assert len(value) < self.max_length and '\0' not in value
@@ -989,9 +1228,19 @@ class Packet(object):
         self.delta = kwds.pop('delta', True)
         self.cancel = kwds.pop('cancel', ())
         assert not kwds
-
+        self.names = tuple(f.name for f in fields)
+        self.decode = self.compile_decoder()
+        self.encode = self.compile_encoder()
+
+    # read() and write() interpret the list of fields, and are used when
+    # debugging output is requested; otherwise, they defer to decode() and
+    # encode(), which are generated for each packet type by compile_decoder()
+    # and compile_encoder(), and have the same effect.
     def read(self, data, prev_packets, debug=False):
-        if debug: print('**> %s' % self.name)
+        if not debug:
+            packet, pos = self.decode(data, prev_packets)
+            return packet, data[pos:]
+        print('**> %s' % self.name)
         packet = {}
         key = (self.number,)
         if self.delta:
@@ -1017,7 +1266,7 @@ class Packet(object):
                     value_repr = field.type.value_repr(packet[field.name])
                     print('    | %s = %s' % (field.name, value_repr))
 
-        self.update_prev_packets(prev_packets, key, packet)
+        self.update_prev_packets(prev_packets, key, self.dict_values(packet))
         return packet, data
 
     def read_delta_header(self, data):
@@ -1027,7 +1276,9 @@ class Packet(object):
         return bits, data[nbytes:]
 
     def write(self, field_values, prev_packets, debug=False):
-        if debug: print('<** %s' % self.name)
+        if not debug:
+            return self.encode(field_values, prev_packets)
+        print('<** %s' % self.name)
         data = StringIO()
         key = (self.number,)
         if self.delta:
@@ -1035,13 +1286,14 @@ class Packet(object):
             for field in self.fields:
                 field_value = field_values[field.name]
                 if field.key:
-                    present, field_data = field.type.write(field_value, field_values)
+                    field_data = field.type.write(field_value, None, field_values)
+                    present = True
                     key += (field_value,)
                 else:
                     prev_value = prev_packets[key][field.name] \
                                  if key in prev_packets else None
-                    field_data, present, delta_bit = \
-                        field.type.delta_write(field_value, prev_value)
+                    field_data, present, delta_bit = field.type.delta_write(
+                        field_value, prev_value, field_values)
                     delta_header.append(delta_bit)
                 data.write(field_data)
                 if present and debug:
@@ -1062,29 +1314,154 @@ class Packet(object):
                     print('    | %s = %s' % (field.name, value_repr))
             data = data.getvalue()
 
-        self.update_prev_packets(prev_packets, key, field_values)
+        self.update_prev_packets(prev_packets, key, self.dict_values(field_values))
         return data
 
-    def update_prev_packets(self, prev_packets, key, packet):
-        prev_packets[key] = packet
+    # Returns a function `decode(data, prev_packets)' returning `(packet, pos)',
+    # where `pos' is the offset in `data' following the packet. The delta header
+    # is read as an integer, whose bits are tested by constant masks, each field
+    # which is a single number is read by a precompiled struct.Struct, and the
+    # previous values of fields are read from the DeltaState by position.
+    def compile_decoder(self):
+        env = {'update_prev_packets': self.update_prev_packets,
+               'header_bits': header_bits}
+        src = ['def decode(data, prev_packets):',
+               '    packet, key, pos = {}, (%d,), 0' % self.number]
+        if self.delta:
+            nbytes = -(-sum(1 for f in self.fields if not f.key)/8)
+            src += ['    prev = prev_packets.lookup(key)',
+                    '    bits, pos = header_bits(data, %d), %d' % (nbytes, nbytes)]
+
+        def read_src(index, field, prev_expr='None'):
+            env['t%d' % index] = field.type
+            if type(field.type) in (Struct, Enum, BitEnum) \
+            and not field.type.multi:
+                env['s%d' % index] = field.type.struct
+                return ['packet[%r], = s%d.unpack_from(data, pos)'
+                        % (field.name, index),
+                        'pos += %d' % field.type.struct.size]
+            return ['packet[%r], pos = t%d.read_from(data, pos, %s, packet)'
+                    % (field.name, index, prev_expr)]
+
+        bit = 0
+        for index, field in enumerate(self.fields):
+            name = field.name
+            if field.key or not self.delta:
+                src += ['    ' + line for line in read_src(index, field)]
+                if field.key:
+                    src += ['    key += (packet[%r],)' % name]
+                    if self.delta: src += ['    prev = prev_packets.lookup(key)']
+                continue
+            mask, bit = 1 << bit, bit + 1
+            if isinstance(field.type, Bool):
+                src += ['    packet[%r] = bool(bits & %d)' % (name, mask)]
+                continue
+            src += ['    if bits & %d:' % mask]
+            src += ['        ' + line for line in read_src(index, field,
+                    'prev[%d] if prev is not None else None' % index)]
+            src += ['    elif prev is not None:',
+                    '        packet[%r] = prev[%d]' % (name, index),
+                    '    else:',
+                    '        packet[%r] = t%d.default()' % (name, index)]
+
+        src += ['    update_prev_packets(prev_packets, key, (%s))' % ''.join(
+                    'packet[%r], ' % name for name in self.names),
+                '    return packet, pos']
+        exec compile('\n'.join(src), '<decode %s>' % self.name, 'exec') in env
+        return env['decode']
+
+    # Returns a function `encode(field_values, prev_packets)' returning the
+    # data of the packet, in the manner of compile_decoder().
+    def compile_encoder(self):
+        env = {'update_prev_packets': self.update_prev_packets,
+               'header_data': header_data}
+        src = ['def encode(values, prev_packets):',
+               '    key, parts = (%d,), []' % self.number]
+        if self.delta:
+            src += ['    prev = prev_packets.lookup(key)',
+                    '    bits = 0']
+
+        def write_expr(index, field, value_expr, prev_expr='None'):
+            env['t%d' % index] = field.type
+            if type(field.type) in (Struct, Enum, BitEnum) \
+            and not field.type.multi:
+                env['s%d' % index] = field.type.struct
+                return 's%d.pack(%s)' % (index, value_expr)
+            return 't%d.write(%s, %s, values)' % (index, value_expr, prev_expr)
+
+        bit = 0
+        for index, field in enumerate(self.fields):
+            name = field.name
+            if field.key or not self.delta:
+                src += ['    parts.append(%s)' % write_expr(
+                        index, field, 'values[%r]' % name)]
+                if field.key:
+                    src += ['    key += (values[%r],)' % name]
+                    if self.delta: src += ['    prev = prev_packets.lookup(key)']
+                continue
+            mask, bit = 1 << bit, bit + 1
+            if isinstance(field.type, Bool):
+                src += ['    if values[%r]: bits |= %d' % (name, mask)]
+                continue
+            src += ['    value = values[%r]' % name,
+                    '    if prev is None or value != prev[%d]:' % index,
+                    '        bits |= %d' % mask,
+                    '        parts.append(%s)' % write_expr(index, field,
+                        'value', 'prev[%d] if prev is not None else None' % index)]
+
+        src += ['    update_prev_packets(prev_packets, key, (%s))' % ''.join(
+                    'values[%r], ' % name for name in self.names)]
+        if self.delta:
+            src += ['    return header_data(bits, %d) + "".join(parts)'
+                    % -(-bit/8)]
+        else:
+            src += ['    return "".join(parts)']
+        exec compile('\n'.join(src), '<encode %s>' % self.name, 'exec') in env
+        return env['encode']
+
+    # Stores the tuple `values' of the fields of a packet in the DeltaState
+    # `prev_packets', and removes any packets of the types it cancels.
+    def update_prev_packets(self, prev_packets, key, values):
+        prev_packets.put(key, values)
         for cnumber in self.cancel:
             ckey = (cnumber,)
-            for field, cfield in izip(self.fields, PACKETS[cnumber].fields):
+            for value, field, cfield in izip(
+                values, self.fields, PACKETS[cnumber].fields
+            ):
                 if not cfield.key: continue
                 assert field.type == cfield.type
-                ckey += (packet[field.name],)
-            prev_packets.pop(ckey, None)
+                ckey += (value,)
+            prev_packets.discard(ckey)
 
-def fc_recv(packet):
+    def dict_values(self, packet):
+        return tuple(packet[name] for name in self.names)
+
+    def values_dict(self, values):
+        return dict(izip(self.names, values))
+
+# The integer whose little-endian representation is the first `nbytes' of `data'.
+def header_bits(data, nbytes):
+    return int(data[nbytes-1::-1].encode('hex'), 16) if nbytes else 0
+
+# The inverse of header_bits.
+def header_data(bits, nbytes):
+    return ''.join(chr((bits >> 8*i) & 0xFF) for i in xrange(nbytes))
+
+# Registers a packet type which may be received from servers. Unless `interest'
+# is False, packets of this type are decoded and signalled as ('FC_RECV', number)
+# events; otherwise, they are only decoded by connections in debug mode. Any type
+# which cancels the delta state of other types is always decoded, so that the
+# state of those types which are decoded remains correct.
+def fc_recv(packet, interest=True):
     @fc_link(('FC_RECV_PACKET_DATA', packet.number))
     def h_fc_recv_packet_data(work, data):
         field_values, data = packet.read(data, work.freeciv_state.last_recv,
             debug=work.freeciv_state.debug)
         assert not data, repr(data)
-        work.freeciv_state.last_recv_time = time.time()
         yield sign(('FC_RECV', packet.number), work, **field_values)
     globals()['PACKET_'+packet.name] = packet.number
     PACKETS[packet.number] = packet
+    if interest or packet.cancel: RECV_INTEREST.add(packet.number)
 
 def fc_send(packet):
     @fc_link(('FC_SEND', packet.number))
@@ -1131,7 +1508,7 @@ TECH_LEAKAGE_STYLE = Enum('NONE', 'EMBASSIES', 'PLAYERS', 'NO_BARBS')
 TECH_UPKEEP_STYLE  = Enum('NONE', 'BASIC', 'PER_CITY')
 VICTORY_CONDITIONS = Enum('SPACERACE', 'ALLIED', 'CULTURE')
 
-fc_recv(Packet('PROCESSING_STARTED', 0))
+fc_recv(Packet('PROCESSING_STARTED', 0), interest=False)
 
 fc_recv(Packet('PROCESSING_FINISHED', 1))
 
@@ -1345,7 +1722,7 @@ fc_recv(Packet('CONN_INFO', 115,
     Field('username', String(MAX_LEN_NAME)),
     Field('addr', String(MAX_LEN_ADDR)),
     Field('capability', String(MAX_LEN_CAPSTR)),
-))
+), interest=False)
 
 fc_recv(Packet('START_PHASE', 126,
     Field('phase', PHASE),
@@ -4,15 +4,16 @@ from itertools import *
 import traceback
 import datetime
 import time
-import json
 import re
 import os.path
 
 from untwisted.magic import sign, hold
+from amelia import split_network
 
 import nickserv
 import runtime
 import channel
+import store
 import util
 
 RPL_WHOISUSER = '311'
@@ -24,31 +25,32 @@ link, install, uninstall = util.LinkSet().triple()
 install, uninstall = util.depend(install, uninstall,
     'nickserv')
 
-prev_track_id = None
+prev_track_ids = None
 def reload(prev):
-    global prev_track_id
-    if hasattr(prev, 'track_id') and type(prev.track_id) is dict:
-        prev_track_id = prev.track_id
+    global prev_track_ids
+    if hasattr(prev, 'track_ids') and type(prev.track_ids) is dict:
+        prev_track_ids = prev.track_ids
 
 @link('POST_RELOAD')
 def h_post_reload(bot):
-    global prev_track_id
+    track_id = records(bot)
     all_nicks = set()
     for chan, nicks in channel.track_channels.iteritems():
+        if not channel.bot_channel(bot, chan): continue
         all_nicks.update(nick.lower() for nick in nicks)
+    prev_track_id = prev_track_ids and prev_track_ids.pop(bot.network, None)
     if prev_track_id is not None:
         for nick in all_nicks:
             track_id[nick] = Record()
             if nick in prev_track_id and hasattr(prev_track_id[nick], 'id') \
             and isinstance(prev_track_id[nick], tuple):
                 track_id[nick].id = util.ID(*prev_track_id[nick].id)
-        prev_track_id = None
     yield refresh(bot, list(all_nicks))
 
 #-------------------------------------------------------------------------------
-# track_id[nick.lower()]
-# is a Record instance, which exists only if the bot shares a channel with nick
-# or if nick is the bot's own nick.
+# track_ids[network][nick.lower()]
+# is a Record instance, which exists only if the bot connected to the given
+# network shares a channel with nick or if nick is the bot's own nick.
 class Record(object):
     __slots__ = 'id', 'access'
     def __init__(self, id=None):
@@ -59,7 +61,11 @@ class Record(object):
             '%s=%r' % (attr, getattr(self,attr))
             for attr in Record.__slots__)
 
-track_id = dict()
+track_ids = dict()
+
+# The identity-tracking records for the network of the given bot.
+def records(bot):
+    return track_ids.setdefault(bot.network, dict())
 
 #-------------------------------------------------------------------------------
 # credentials[name.lower()] - list of credentials providing access to name.
@@ -92,32 +98,35 @@ credentials = read_credentials()
 # prev_hosts[access_name.lower()]
 # is a list of (unique) 'nick!user@host' which have had access to access_name,
 # in chronological order with the most recent last.
-def read_prev_hosts():
-    new_prev_hosts = dict()
-    if os.path.exists(PREV_HOSTS_FILE):
+# Each list is persisted in prev_hosts_store under the key (access_name.lower(),)
+# and is replaced, rather than modified, when it changes.
+encode_prev_hosts, decode_prev_hosts = store.nested_format(1)
+prev_hosts_store = store.Store(PREV_HOSTS_FILE,
+    encode=encode_prev_hosts, decode=decode_prev_hosts)
+
+# The records are read when first needed, rather than when the module is loaded.
+prev_hosts = None
+
+def get_prev_hosts():
+    global prev_hosts
+    if prev_hosts is None:
         try:
-            with open(PREV_HOSTS_FILE) as file:
-                new_prev_hosts = json.load(file)
+            prev_hosts = encode_prev_hosts(prev_hosts_store.load())
         except (ValueError, IOError):
             traceback.print_exc()
-    new_prev_hosts = util.recursive_encode(new_prev_hosts, 'utf-8')
-    return new_prev_hosts
-
-def write_prev_hosts(new_prev_hosts):
-    try:
-        data = json.dumps(new_prev_hosts, indent=4, ensure_ascii=False)
-        with open(PREV_HOSTS_FILE, 'w') as file:
-            file.write(data)
-    except (ValueError, IOError):
-        traceback.print_exc()
+            prev_hosts = dict()
+    return prev_hosts
 
-prev_hosts = read_prev_hosts()
+def write_prev_hosts(access_name, hosts):
+    get_prev_hosts()[access_name.lower()] = hosts
+    prev_hosts_store.put((access_name.lower(),), hosts)
 
 #===============================================================================
 # yield check_access(bot, query, name) -> True iff query has access to name.
 # where query = nick or ID(nick, user, host)
 @util.mfun(link, 'identity.check_access')
 def check_access(bot, query, name, ret):
+    track_id = records(bot)
     name = name.lower()
 
     if isinstance(query, tuple):
@@ -154,6 +163,7 @@ def check_access(bot, query, name, ret):
                 break
         elif cred[0] == 'prev_hosts' and len(cred) > 1:
             # Authenticate using previously authenticated hosts.
+            prev_hosts = get_prev_hosts()
             if not id or name.lower() not in prev_hosts:
                 continue
             userhost = '%s@%s' % (id.user, id.host)
@@ -179,14 +189,20 @@ def get_id(bot, nick, ret):
     yield ret(result[0])
 
 RPL_WHOREPLY = '352'
+RPL_ENDOFWHO = '315'
 
-# get_id_cache[nick.lower()] = (ID(nick,user,host) or None, time.time())
-get_id_cache = {}
+# get_id_caches[network][nick.lower()] = (ID(nick,user,host) or None, time)
+get_id_caches = {}
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'get_id_caches', 'prev_hosts', 'prev_hosts_store'
 
 # yield get_ids(bot, [nick1, ...]) -> [ID(nick1,user1,host1) or None, ...]
 # This is more efficient than multiple separate invocations of get_id.
 @util.mfun(link, 'identity.get_ids')
 def get_ids(bot, nicks, ret, timeout_const_s=30, timeout_linear_s=5):
+    track_id = records(bot)
+    get_id_cache = get_id_caches.setdefault(bot.network, {})
     for nick, (id, ctime) in get_id_cache.items():
         now = time.time()
         if id is not None and ctime < now-10 or ctime < now-300:
@@ -234,6 +250,49 @@ def get_ids(bot, nicks, ret, timeout_const_s=30, timeout_linear_s=5):
 
     yield ret([nick_ids.get(n.lower()) for n in nicks])
 
+# yield get_chan_ids(bot, chan, [nick1, ...]) -> [ID(nick1,...) or None, ...]
+# Like get_ids, for nicks present in the given channel, except that any nicks
+# not already known are resolved with a single WHO query for the channel, whose
+# replies are waited for no longer than `timeout_s' seconds.
+@util.mfun(link, 'identity.get_chan_ids')
+def get_chan_ids(bot, chan, nicks, ret, timeout_s=30):
+    track_id = records(bot)
+    get_id_cache = get_id_caches.setdefault(bot.network, {})
+
+    wait_nicks = set()
+    nick_ids = {}
+    now = time.time()
+    for nick in nicks:
+        nick = nick.lower()
+        if nick in track_id and track_id[nick].id is not None:
+            nick_ids[nick] = track_id[nick].id
+        elif nick in get_id_cache and get_id_cache[nick][0] is not None \
+        and get_id_cache[nick][1] >= now-10:
+            nick_ids[nick] = get_id_cache[nick][0]
+        else:
+            wait_nicks.add(nick)
+
+    if wait_nicks:
+        bot.send_cmd('WHO %s' % chan)
+        chan_name = split_network(chan)[0].lower()
+        timeout = yield runtime.timeout(timeout_s)
+    while wait_nicks:
+        event, args = yield hold(bot, RPL_WHOREPLY, RPL_ENDOFWHO, timeout)
+        if event == timeout: break
+        if event == RPL_ENDOFWHO:
+            if args[3].lower() == chan_name: break
+            continue
+        _bot, _from, _to, _chan, user, host, _server, nick = args[:8]
+        id = util.ID(nick, user, host)
+        nick = nick.lower()
+        if nick in track_id:
+            track_id[nick].id = id
+        get_id_cache[nick] = (id, time.time())
+        if nick in wait_nicks:
+            nick_ids[nick] = id
+
+    yield ret([nick_ids.get(n.lower()) for n in nicks])
+
 #-------------------------------------------------------------------------------
 # yield get_hostmask(bot, nick) -> 'nick!user@host' or None
 @util.mfun(link, 'identity.get_hostmask')
@@ -243,8 +302,10 @@ def get_hostmask(bot, nick, ret):
 
 # yield get_hostmasks(bot, [nick1, ...]) -> ['nick1!user1@host1' or None, ..]
 # This is more efficient than multiple separate invocations of get_hostmask.
-def get_hostmasks(bot, nicks, ret):
-    ids = yield get_ids(bot, nicks)
+# Any keyword arguments are passed on to get_ids.
+@util.mfun(link, 'identity.get_hostmasks')
+def get_hostmasks(bot, nicks, ret, **kwds):
+    ids = yield get_ids(bot, nicks, **kwds)
     yield ret([None if id is None else id_to_hostmask(id) for id in ids])
 
 #-------------------------------------------------------------------------------
@@ -260,6 +321,7 @@ def id_to_hostmask(id):
 # yield refresh(bot, nicks) -> re-check certain credentials for each nick.
 @util.msub(link, 'identity.refresh')
 def refresh(bot, nicks):
+    track_id = records(bot)
     nicks = map(str.lower, nicks)
 
     ids = yield get_ids(bot, nicks, timeout_const_s=240)
@@ -280,6 +342,7 @@ def refresh(bot, nicks):
                         granted_nicks.add(id.nick.lower())
 
             elif cred[0] == 'prev_hosts' and len(cred) > 1:
+                prev_hosts = get_prev_hosts()
                 for id in ids:
                     if id is None or id.nick.lower() in granted_nicks: continue
                     if access_name.lower() not in prev_hosts: continue
@@ -306,6 +369,7 @@ def refresh(bot, nicks):
 # yield grant_access(bot, nick, access_name)
 @util.msub(link, 'identity.grant_access')
 def grant_access(bot, nick_or_id, access_name):
+    track_id = records(bot)
     if isinstance(nick_or_id, tuple):
         nick, id = nick_or_id.nick, None
     else:
@@ -327,11 +391,10 @@ def grant_access(bot, nick_or_id, access_name):
             id = yield get_id(bot, nick)
         if id:
             userhost = '%s@%s' % (id.user, id.host)
-            hosts = prev_hosts.get(access_name.lower(), list())
+            hosts = get_prev_hosts().get(access_name.lower(), list())
             if userhost.lower() not in map(str.lower, hosts):
                 hosts = (hosts + [userhost])[-max_prev_hosts:]
-            prev_hosts[access_name.lower()] = hosts
-            write_prev_hosts(prev_hosts)
+                write_prev_hosts(access_name, hosts)
 
     # Grant any 'access' credentials that are satisfied as a result.
     for further_name, creds in credentials.iteritems():
@@ -348,6 +411,7 @@ def grant_access(bot, nick_or_id, access_name):
 # records are used as a heuristic for the search.
 @util.mfun(link, 'identity.enum_access')
 def enum_access(bot, access_name, ret):
+    track_id = records(bot)
     access_name = access_name.lower()
     nicks = set()
     for nick, record in track_id.iteritems():
@@ -372,6 +436,7 @@ def known_as(access_name):
 #===============================================================================
 @link('NAMES_SYNC')
 def h_names_sync(bot, chan, chan_nicks, chan_umodes):
+    track_id = records(bot)
     # Upon receiving the nick list for a channel, create identity-tracking
     # records for any previously unknown nicks in the channel.
     for nick in chan_nicks:
@@ -382,6 +447,7 @@ def h_names_sync(bot, chan, chan_nicks, chan_umodes):
 
 @link('OTHER_JOIN')
 def h_other_join(bot, id, chan):
+    track_id = records(bot)
     # Create an identity-tracking record.
     nick = id.nick.lower()
     if nick not in track_id:
@@ -392,6 +458,7 @@ def h_other_join(bot, id, chan):
 @link('SELF_NICK',  a=lambda bot,     new_nick: (None, bot.nick, new_nick))
 @link('OTHER_NICK', a=lambda bot, id, new_nick: (id,   id.nick,  new_nick))
 def h_other_nick(bot, *args, **kwds):
+    track_id = records(bot)
     # Rename any identity-tracking record.
     id, old_nick, new_nick = kwds.pop('a')(bot, *args, **kwds)
     if old_nick.lower() in track_id:
@@ -413,19 +480,17 @@ def h_chan_mode(bot, source, chan, modes):
 @link('OTHER_PART',     a=lambda id, chan, *args:           (id.nick, chan))
 @link('OTHER_KICKED',   a=lambda nick, op_id, chan, *args:  (nick, chan))
 def h_other_exit(bot, *args, **kwds):
+    track_id = records(bot)
     # If no more common channels exist, delete any identity-tracking record.
     exit_nick, exit_chan = map(str.lower, kwds['a'](*args))
-    for chan, nicks in channel.track_channels.iteritems():
-        if chan == exit_chan:
-            continue
-        if any(exit_nick == nick.lower() for nick in nicks):
-            break
-    else:
-        if exit_nick.lower() in track_id:
-            del track_id[exit_nick.lower()]
+    if channel.user_channels(bot, exit_nick) - {exit_chan}:
+        return
+    if exit_nick in track_id:
+        del track_id[exit_nick]
 
 @link('OTHER_QUIT')
 def h_other_quit(bot, id, msg):
+    track_id = records(bot)
     # Delete any identity-tracking record.
     if id.nick.lower() in track_id:
         del track_id[id.nick.lower()]
@@ -433,13 +498,11 @@ def h_other_quit(bot, id, msg):
 @link('SELF_PART')
 @link('SELF_KICKED')
 def h_self_exit(bot, chan, *args):
+    track_id = records(bot)
     # Delete identity-tracking records for nicks for which
     # there is no longer a common channel.
     chan = chan.lower()
-    exit_nicks = set(n.lower() for n in channel.track_channels[chan])
-    for ochan, onicks in channel.track_channels.iteritems():
-        if ochan == chan: continue
-        exit_nicks.difference_update(n.lower() for n in onicks)
-    for nick in exit_nicks:
-        if nick in track_id:
-            del track_id[nick]
+    for nick in channel.track_channels[chan]:
+        if channel.user_channels(bot, nick) - {chan}: continue
+        if nick.lower() in track_id:
+            del track_id[nick.lower()]
@@ -1,6 +1,7 @@
 import traceback
 import os.path
 
+from amelia import split_network
 import util
 
 INVITE_FILE = 'state/channel_invite.txt'
@@ -8,9 +9,8 @@ INVITE_FILE = 'state/channel_invite.txt'
 link, install, uninstall = util.LinkSet().triple()
 invited = set()
 
-def reload(prev):
-    try: invited.update(prev.invited)
-    except: pass
+# See util.preserve_reload_state.
+__reload_preserve__ = 'invited',
 
 @link('INVITE')
 def h_invite(bot, id, target, channel, *args):
@@ -23,8 +23,11 @@ def h_autojoin(bot):
     if os.path.exists(INVITE_FILE):
         with open(INVITE_FILE) as file:
             file_invited = map(str.strip, file.readlines())
+        conf_chans = [bot.qualify(c).lower() for c in bot.conf['channels']]
         for chan in file_invited:
-            if chan.lower() in map(str.lower, bot.conf['channels']):
+            if split_network(chan)[1] != bot.network:
+                continue
+            if chan.lower() in conf_chans:
                 continue
             bot.send_cmd('JOIN %s' % chan)
 
@@ -8,6 +8,7 @@ from runtime import later
 import message
 import util
 import limit
+import workers
 
 import kakasi_lib
 
@@ -19,7 +20,8 @@ link, install, uninstall = util.LinkSet().triple()
 @not_quiet()
 def h_message(bot, id, target, msg):
     if limit.mark_activity(bot, id): return
-    kakasi(bot, id, target or id.nick, msg, target is not None, auto=True)
+    return kakasi(bot, id, target or id.nick, msg, target is not None,
+                  auto=True)
 
 @link('PROXY_MSG')
 @not_quiet()
@@ -27,7 +29,8 @@ def h_proxy_message(
     bot, id, target, msg, no_kakasi=False, no_auto=False, **kwds
 ):
     if no_kakasi or no_auto: return
-    kakasi(bot, id, target, msg, target.startswith('#'), auto=True, **kwds)
+    return kakasi(bot, id, target, msg, target.startswith('#'), auto=True,
+                  **kwds)
 '''
 
 #===============================================================================
@@ -48,12 +51,14 @@ def h_help_romaji(bot, reply, args):
 @link('!romaji')
 @link('!rj')
 def h_romaji(bot, id, target, args, full_msg):
-    kakasi(bot, id, target or id.nick, args, target is not None)
+    return kakasi(bot, id, target or id.nick, args, target is not None)
 
 #===============================================================================
+# A generator, to be chained by the caller, as the conversion may be performed
+# by a worker process.
 def kakasi(bot, id, target, msg, prefix=True, auto=False, **kwds):
     if auto and not kakasi_lib.is_ja(msg): return
-    raw_reply = kakasi_lib.kakasi(msg)
+    raw_reply = yield workers.call(bot, kakasi_lib.kakasi, msg)
     if auto and len(raw_reply) > 200: return
     reply = ('<%s> %s' % (id.nick, raw_reply)) if prefix and id else raw_reply
     bot.send_msg(target, reply)
@@ -25,7 +25,8 @@ def init_kakasi(*args):
 
     libkakasi.kakasi_getopt_argv(len(args), (c_char_p * len(args))(*args))
 
-init_kakasi('-Ka', '-Ha', '-Ja', '-s', '-p', '-rhepburn')
+# The library is loaded and initialised on first use, rather than on import.
+DEFAULT_ARGS = '-Ka', '-Ha', '-Ja', '-s', '-p', '-rhepburn'
 
 def kakasi(text):
     if type(text) is unicode:
@@ -37,6 +38,7 @@ def kakasi(text):
 
 def kakasi_unicode(text):
     if not text: return text
+    if libkakasi is None: init_kakasi(*DEFAULT_ARGS)
     text = pre_kakasi_unicode(text)
     text = backslash_escape(text).encode(KAKASI_CODEC, 'backslashreplace')
     res_ptr = libkakasi.kakasi_do(text)
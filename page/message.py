@@ -14,6 +14,7 @@ link, install, uninstall = LinkSet().triple()
 def h_xirclib_msg(event, bot, source, *args):
     if type(source) is tuple:
         source = ID(*source)
+    args = bot.qualify_args(event, args)
     yield sign(event, bot, source, *args)
 
 @link('COMMAND',        action=False)
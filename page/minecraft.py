@@ -8,23 +8,31 @@ import sys
 import socket
 import traceback
 import operator
+import time
 
 from untwisted.mode import Mode
 from untwisted.network import Work
-from untwisted.event import DATA, BUFFER, FOUND, CLOSE, RECV_ERR
-from untwisted.utils import std
-from untwisted.utils.common import append, shrug
+from untwisted.event import FOUND, CLOSE, RECV_ERR, CONNECT
+from untwisted.utils import std, framing
 from untwisted.magic import sign
+import untwisted.usual
 
 import util
 import debug
 import runtime
 import bridge
+import reconnect
 from util import NotInstalled, AlreadyInstalled
 
 
+# The least delay before reconnecting; see reconnect.wait.
 RECONNECT_DELAY_SECONDS = 1
 
+# The time after which a query with no response fails, and the times for which
+# the successful results of queries with the given keys are reused.
+QUERY_TIMEOUT_SECONDS = 10
+QUERY_CACHE_SECONDS = {'players': 5, 'map': 60}
+
 conf_servers = util.table('conf/minecraft.py', 'server', socket.__dict__)
 
 mc_work = []
@@ -32,8 +40,7 @@ mc_mode = Mode()
 mc_mode.domain = 'mc'
 mc_link = util.LinkSet()
 mc_link.link_module(std)
-mc_link.link(DATA, append)
-mc_link.link(BUFFER, shrug, '\n')
+mc_link.link_module(framing.Lines('\n'))
 if '--debug' in sys.argv: mc_link.link_module(debug)
 
 ab_mode = None
@@ -61,17 +68,15 @@ def init_work(server, reload_from=None, reconnect_from=None):
     elif hasattr(reload_from, 'minecraft_state'):
         work.minecraft_state.reload_from(reload_from.minecraft_state)
     work.setblocking(0)
-    work.connect_ex(server.address)
-    h_query(work, 'map')
-    h_query(work, 'agent')
+    reconnect.attempt(server_link(server))
+    reconnect.connect(work, server.address)
+    send_query(work, 'map')
+    send_query(work, 'agent')
 
 def kill_work(work, remove=True):
-    try: work.destroy()
-    except socket.error: pass
-    try: work.shutdown(socket.SHUT_RDWR)
-    except socket.error: pass
-    try: work.close()
-    except socket.error: pass
+    reconnect.cancel(work)
+    end_queries(work, ('failure', 'Disconnected from server.'))
+    work.terminate()
     if remove: mc_work.remove(work)
 
 def reload(prev):
@@ -109,6 +114,9 @@ def uninstall(bot, reload=False):
     ab_link.uninstall(ab_mode)
     ab_mode = None
 
+install, uninstall = util.depend(install, uninstall,
+    'reconnect')
+
 
 @ab_link('BRIDGE')
 def ab_bridge(bot, target_chan, msg, source, **kwds):
@@ -138,6 +146,7 @@ def h_bridge_names_req(bot, target, source, name_query):
 
 @mc_link(FOUND)
 def mc_found(work, line):
+    reconnect.established(server_link(work.minecraft))
     line = re.sub(r'§.', '', line)
 
     match = re.match('!query (\S+) (\S+) (.*)', line)
@@ -201,9 +210,18 @@ def strip_codes(msg):
 @mc_link(RECV_ERR)
 def mc_close_recv_error(work, *args):
     kill_work(work)
-    yield runtime.sleep(RECONNECT_DELAY_SECONDS)
+    link = server_link(work.minecraft)
+    reconnect.failed(link, args[0] if args else 'connection closed')
+    yield reconnect.wait(link, RECONNECT_DELAY_SECONDS)
     init_work(work.minecraft, reconnect_from=work)
 
+@mc_link(CONNECT)
+def mc_connect(work):
+    reconnect.connected(server_link(work.minecraft))
+
+def server_link(server):
+    return reconnect.get_link('minecraft:%s' % server.name)
+
 @mc_link(('QUERY_SUCCESS', 'map'))
 def h_query_success_map(work, type, key, val):
     work.minecraft_state.map_name = val
@@ -213,17 +231,67 @@ def h_query_success_map(work, type, key, val):
     work.minecraft_state.agent = val
 
 
-# (status, value) = yield minecraft.query(key),
-# where status is 'result' or 'failure'
-def query(work, key):
-    return util.mmcall(ab_mode, 'minecraft.query', work, key)
+#-------------------------------------------------------------------------------
+# query_waiters[work, key] = [resume, ...] for the callers of query() awaiting
+# the response to a query sent to `work'. A query is only sent if none with the
+# same key is already awaiting a response.
+query_waiters = dict()
 
+# query_cache[work, key] = (expiry_time, (status, value)), for the last
+# successful response to a query with a key in QUERY_CACHE_SECONDS.
+query_cache = dict()
 
-@ab_link('minecraft.query')
-def h_query(work, key):
+# (status, value) = yield minecraft.query(work, key),
+# where status is 'success' or 'failure'
+def query(work, key):
+    def act(source, chain):
+        def resume(result):
+            try:
+                chain.send(result)(source, chain)
+                untwisted.usual.chain(source, chain)
+            except StopIteration:
+                pass
+        cached = query_cache.get((work, key))
+        if cached is not None and cached[0] > time.time():
+            resume(cached[1])
+        elif (work, key) in query_waiters:
+            query_waiters[work, key].append(resume)
+        else:
+            waiters = query_waiters[work, key] = [resume]
+            send_query(work, key)
+            ab_mode.drive('minecraft.query_timeout', work, key, waiters)
+        raise StopIteration
+    return act
+
+def send_query(work, key):
     work.dump('?query %s\n' % key)
 
+@ab_link('minecraft.query_timeout')
+def h_query_timeout(work, key, waiters):
+    yield runtime.sleep(QUERY_TIMEOUT_SECONDS)
+    if query_waiters.get((work, key)) is waiters:
+        end_query(work, key, ('failure', 'No response from server.'))
+
 @mc_link(('QUERY_SUCCESS'))
 @mc_link(('QUERY_FAILURE'))
 def h_query_success_failure(work, type, key, val):
-    yield util.msign(ab_mode, ('minecraft.query', work, key), (type, val))
+    if type == 'success' and key in QUERY_CACHE_SECONDS:
+        query_cache[work, key] = \
+            (time.time() + QUERY_CACHE_SECONDS[key], (type, val))
+    end_query(work, key, (type, val))
+
+# Passes `result' to each caller waiting for a query with the given key.
+def end_query(work, key, result):
+    for resume in query_waiters.pop((work, key), ()):
+        try:
+            resume(result)
+        except Exception:
+            traceback.print_exc()
+
+# Discards all cached results for `work', and passes `result' to all callers
+# waiting for queries sent to it.
+def end_queries(work, result):
+    for (qwork, key) in query_cache.keys():
+        if qwork is work: del query_cache[qwork, key]
+    for (qwork, key) in query_waiters.keys():
+        if qwork is work: end_query(work, key, result)
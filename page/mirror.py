@@ -48,13 +48,8 @@ chan_times = defaultdict(dict)
 cache_old = dict()
 cache_new = dict()
 
-def reload(prev):
-    if hasattr(prev, 'chan_times') and isinstance(prev.chan_times, dict):
-        chan_times.update(prev.chan_times)
-    if hasattr(prev, 'cache_old') and isinstance(prev.cache_old, dict):
-        cache_old.update(prev.cache_old)
-    if hasattr(prev, 'cache_new') and isinstance(prev.cache_new, dict):
-        cache_new.update(prev.cache_new)
+# See util.preserve_reload_state.
+__reload_preserve__ = 'chan_times', 'cache_old', 'cache_new'
 
 def get_cache(key):
     return cache_new.get(key) \
@@ -13,42 +13,50 @@ link, ls_install, ls_uninstall = util.LinkSet().triple()
 REGISTERED = 'PRE_AUTOJOIN'
 IDENTIFIED = ('AFTER', REGISTERED, __name__)
 
-installed = False
+# The bots on which this module is installed.
+installed = set()
 
 def install(bot):
-    global installed
-    if installed: raise util.AlreadyInstalled
-    installed = True
+    if bot in installed: raise util.AlreadyInstalled
+    installed.add(bot)
     util.event_sub(bot, REGISTERED, IDENTIFIED)
     ls_install(bot)
     
 def uninstall(bot):
-    global installed
-    if not installed: raise util.NotInstalled
-    installed = False
+    if bot not in installed: raise util.NotInstalled
+    installed.remove(bot)
     ls_uninstall(bot)
     util.event_sub(bot, IDENTIFIED, REGISTERED)
 
-conf_cache = None
-def conf(*args, **kwds):
-    global conf_cache
-    if conf_cache is None and os.path.exists(CONF_FILE):
-        try:
-            conf_cache = util.fdict(CONF_FILE, util.__dict__)
-        except IOError:
-            traceback.print_exc()
-    return conf_cache and conf_cache.get(*args, **kwds)
+# The configuration for each network other than the primary one is read from
+# NETWORK_CONF_FILE, so that no password is given to another network's NickServ.
+NETWORK_CONF_FILE = 'conf/nickserv_%s.py'
+
+# conf_cache[network] = the configuration dict for the network, or None.
+conf_cache = dict()
+def conf(bot, *args, **kwds):
+    if bot.network not in conf_cache:
+        path = CONF_FILE if bot.network is None \
+               else NETWORK_CONF_FILE % bot.network
+        conf_cache[bot.network] = None
+        if os.path.exists(path):
+            try:
+                conf_cache[bot.network] = util.fdict(path, util.__dict__)
+            except IOError:
+                traceback.print_exc()
+    net_conf = conf_cache[bot.network]
+    return net_conf and net_conf.get(*args, **kwds)
 
 @link(REGISTERED)
 def registered(bot, *rargs):
-    if conf('password') and bot.nick == getattr(bot, 'auto_nick', None):
+    if conf(bot, 'password') and bot.nick == getattr(bot, 'auto_nick', None):
         nick_status = yield status(bot, bot.conf['nick'])
         if nick_status == 1:
             bot.send_msg(
-                conf('nickserv').nick,
-                'GHOST %s %s' % (bot.conf['nick'], conf('password')))
+                conf(bot, 'nickserv').nick,
+                'GHOST %s %s' % (bot.conf['nick'], conf(bot, 'password')))
             bot.send_cmd('NICK %s' % bot.conf['nick'])
-    if conf('password'):
+    if conf(bot, 'password'):
         timeout = yield runtime.timeout(30)
         yield hold(bot, 'NICKSERV_REGISTERED', timeout)
     yield sign(IDENTIFIED, bot, *rargs)
@@ -62,8 +70,8 @@ def h_mode(bot, source, target, modes, *args):
 @link('UNOTICE')
 def notice(bot, id, target, msg):
     if target is not None: return
-    if not conf('nickserv'): return
-    nickserv = conf('nickserv')
+    if not conf(bot, 'nickserv'): return
+    nickserv = conf(bot, 'nickserv')
     if id.nick.lower() != nickserv.nick.lower(): return
     if (id.user, id.host) != (nickserv.user, nickserv.host):
         raise Exception('%s is %s@%s; %s@%s expected.'
@@ -72,11 +80,11 @@ def notice(bot, id, target, msg):
 
 @link('NICKSERV_NOTICE')
 def nickserv_notice(bot, id, msg):
-    if conf('prompt') and conf('password') and msg.startswith(conf('prompt')):
-        bot.send_msg(id.nick, 'IDENTIFY %s %s' % (
-            bot.conf['nick'], conf('password')))
+    prompt, password = conf(bot, 'prompt'), conf(bot, 'password')
+    if prompt and password and msg.startswith(prompt):
+        bot.send_msg(id.nick, 'IDENTIFY %s %s' % (bot.conf['nick'], password))
         return
-    final = conf('final')
+    final = conf(bot, 'final')
     if final and msg.startswith(final):
         yield sign('NICKSERV_REGISTERED', bot)
         return
@@ -92,10 +100,16 @@ def status(bot, nick, ret):
 # sdict = yield statuses(bot, nicks) - sdict[nick.lower()] is STATUS of nick.
 STATUS_BATCH = 1
 STATUS_CACHE_SECONDS = 15
-status_cache = dict()
+
+# status_caches[network][nick.lower()] = (STATUS or None, time.time())
+status_caches = dict()
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'status_caches',
+
 @util.mfun(link, 'nickserv.statuses')
 def statuses(bot, nicks, ret, timeout_const_s=20, timeout_linear_s=1):
-    global status_cache
+    status_cache = status_caches.setdefault(bot.network, dict())
     earliest = time.time() - STATUS_CACHE_SECONDS
     for nick, (status, stime) in status_cache.items():
         if stime < earliest:
@@ -105,7 +119,7 @@ def statuses(bot, nicks, ret, timeout_const_s=20, timeout_linear_s=1):
     send_nicks = [n for n in nicks if n not in status_cache]
     for i in xrange(0, len(send_nicks), STATUS_BATCH):
         batch_nicks = ' '.join(send_nicks[i:i+STATUS_BATCH])
-        bot.send_msg(conf('nickserv').nick, 'STATUS %s' % batch_nicks)
+        bot.send_msg(conf(bot, 'nickserv').nick, 'STATUS %s' % batch_nicks)
 
     result, remain = dict(), set()
     for nick in nicks:
@@ -4,14 +4,14 @@ import sys
 import traceback
 import urllib
 import urllib2
-import json
 import re
 import UserDict
 
-from bs4 import BeautifulSoup
 from untwisted.magic import sign
 
 from runtime import later
+from util import BeautifulSoup
+import store
 import util
 import runtime
 import identity
@@ -24,27 +24,37 @@ TICK_PERIOD_S = 60
 
 link = util.LinkSet()
 def install(bot):
+    first = not link.installed_modes
     link.install(bot)
-    bot.drive('QDBS_TICK', bot, log_level=2)
+    if first: bot.drive('QDBS_TICK', bot, log_level=2)
 install, uninstall = util.depend(install, link.uninstall, 'identity')
 
 #===============================================================================
-def read_state():
-    try:
-        with open(STATE_FILE, 'r') as file:
-            return util.recursive_encode(json.load(file), 'utf-8')
-    except IOError as e:
-        if e.errno != 2: raise
-    except:
-        traceback.print_exc()
-    return dict()
-
-def write_state(wstate):
-    data = json.dumps(wstate, indent=4, ensure_ascii=False)
-    with open(STATE_FILE, 'w') as file:
-        file.write(data)
-
-state = read_state()
+# state[url][name.lower()] = {'last_quote': ...}, where the record for each
+# (url, name.lower()) is persisted by state_store.
+encode_state, decode_state = store.nested_format(2)
+state_store = store.Store(
+    STATE_FILE, encode=encode_state, decode=decode_state)
+
+# The state is read when first needed, rather than when the module is loaded.
+state = None
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'state', 'state_store'
+
+def get_state():
+    global state
+    if state is None:
+        try:
+            records = state_store.load()
+        except:
+            traceback.print_exc()
+            records = dict()
+        state = encode_state({k: dict(v) for (k, v) in records.iteritems()})
+    return state
+
+def write_state(url, name):
+    state_store.put((url, name), dict(state[url][name]))
 
 #===============================================================================
 @link('QDBS_TICK')
@@ -113,7 +123,7 @@ class Private(Configuration):
             quotes = self.quotes()
             if not quotes: return
 
-            url_state = state.get(self.admin_url, {})
+            url_state = get_state().get(self.admin_url, {})
             name_state = url_state.get(self.access_name.lower(), {})
             last_quote = name_state.get('last_quote')
     
@@ -137,7 +147,7 @@ class Private(Configuration):
             name_state['last_quote'] = last_quote
             url_state[self.access_name.lower()] = name_state
             state[self.admin_url] = url_state
-            write_state(state)
+            write_state(self.admin_url, self.access_name.lower())
         except:
             traceback.print_exc()
     
@@ -182,7 +192,7 @@ class Public(Configuration):
     def refresh(self, bot):
         try:
             quotes, title = self.quotes_title()
-            url_state = state.get(self.index_url, {})
+            url_state = get_state().get(self.index_url, {})
             chan_state = url_state.get(self.channel.lower(), {})
             last_quote = chan_state.get('last_quote')
 
@@ -209,7 +219,7 @@ class Public(Configuration):
                 chan_state['last_quote'] = last_quote
                 url_state[self.channel.lower()] = chan_state
                 state[self.index_url] = url_state
-                write_state(state)
+                write_state(self.index_url, self.channel.lower())
         except:
             traceback.print_exc()
 
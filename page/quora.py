@@ -6,8 +6,6 @@ import json
 import os.path
 import traceback
 
-from bs4 import BeautifulSoup
-
 from selenium.common.exceptions import NoSuchElementException
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.wait import WebDriverWait
@@ -17,6 +15,7 @@ from untwisted.magic import sign
 
 from url_collect import URL_PART_RE
 from url import BS4_PARSER, USER_AGENT
+from util import BeautifulSoup
 import channel
 import runtime
 import util
@@ -70,8 +69,9 @@ quora_login_cookies = {}
 
 #===============================================================================
 def install(bot):
+    first = not link.installed_modes
     link.install(bot)
-    bot.drive('QUORA_START', bot)
+    if first: bot.drive('QUORA_START', bot)
 
 def reload(prev):
     if isinstance(getattr(prev, 'msg_count', None), dict):
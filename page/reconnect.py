@@ -0,0 +1,216 @@
+#===============================================================================
+# reconnect.py - reconnection scheduling and health tracking for the bot's
+# connections to other services, such as game servers.
+#
+# Each connection is tracked by a Link, which persists across reconnections,
+# and is obtained by
+#     link = reconnect.get_link('minecraft:NAME')
+# The owning module calls attempt(link) when it starts each connection attempt,
+# connected(link) when the socket is connected (on untwisted.event.CONNECT),
+# established(link) when the connection is known to be working, and
+# failed(link, reason) when it is closed or fails, and then waits by
+#     yield reconnect.wait(link)
+# before trying again. The delay grows exponentially, with random jitter, in the
+# number of consecutive failures, from `min_delay' up to MAX_DELAY_S. After
+# BREAKER_FAILURES consecutive failures, the link's circuit breaker is "open",
+# and each further attempt is made only after BREAKER_DELAY_S, until one
+# succeeds. A connection which stays open for at least STABLE_S counts as a
+# success even if established() is never called.
+#
+# connect(work, address) connects an untwisted.network.Work, resolving any
+# host name in a background thread, so that a slow DNS server does not block
+# the bot. Until then, the Work is not polled; if the name cannot be resolved,
+# RECV_ERR is signalled for it, as for any other failure to connect.
+
+from __future__ import print_function
+
+from collections import deque
+import traceback
+import threading
+import socket
+import random
+import time
+import re
+
+from untwisted.event import TICK, RECV_ERR
+from untwisted.mode import Mode
+from untwisted.core import gear
+
+from util import LinkSet
+from message import reply
+from auth import admin
+import runtime
+import util
+
+ab_link, install, uninstall = LinkSet().triple()
+install, uninstall = util.depend(install, uninstall,
+    'auth')
+
+# The greatest delay between attempts while the circuit breaker is closed.
+MAX_DELAY_S = 300
+
+# The number of consecutive failures after which the circuit breaker opens,
+# and the delay between attempts while it is open.
+BREAKER_FAILURES = 8
+BREAKER_DELAY_S = 900
+
+# The time after which an open connection is considered to have succeeded.
+STABLE_S = 60
+
+#===============================================================================
+class Link(object):
+    __slots__ = (
+        'name', 'state', 'failures', 'attempts', 'total_failures',
+        'since', 'last_error', 'next_attempt')
+    def __init__(self, name):
+        self.name = name
+        self.state = 'new'
+        self.failures = 0
+        self.attempts = 0
+        self.total_failures = 0
+        self.since = time.time()
+        self.last_error = None
+        self.next_attempt = None
+
+# links[name] = Link(name), for each link that has been used.
+links = dict()
+
+# (resume, success, value) for each host name resolved by a background thread,
+# whose result has not yet been passed on.
+resolved = deque()
+
+# The Works whose host names are being resolved.
+resolving = set()
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'links', 'resolved', 'resolving'
+
+mode = Mode()
+mode.poll = mode
+gear.tick_list.append(mode)
+
+def reload(prev):
+    if hasattr(prev, 'mode') and prev.mode in gear.tick_list:
+        gear.tick_list.remove(prev.mode)
+
+def hard_reload(prev):
+    reload(prev)
+
+def get_link(name):
+    if name not in links: links[name] = Link(name)
+    return links[name]
+
+def attempt(link):
+    link.attempts += 1
+    link.next_attempt = None
+    set_state(link, 'connecting')
+
+def connected(link):
+    if link.state == 'connecting': set_state(link, 'connected')
+
+def established(link):
+    link.failures = 0
+    if link.state != 'up': set_state(link, 'up')
+
+def failed(link, reason=None):
+    if link.state in ('waiting', 'open'): return
+    if link.state == 'up' or link.state == 'connected' \
+    and time.time() - link.since >= STABLE_S:
+        link.failures = 0
+    link.failures += 1
+    link.total_failures += 1
+    link.last_error = str(reason) if reason is not None else None
+    set_state(link, 'open' if breaker_open(link) else 'waiting')
+
+def set_state(link, state):
+    link.state = state
+    link.since = time.time()
+
+def breaker_open(link):
+    return link.failures >= BREAKER_FAILURES
+
+# Returns the delay before the next attempt on the given link, given that there
+# have been link.failures consecutive failures.
+def delay(link, min_delay=1):
+    if breaker_open(link): return BREAKER_DELAY_S
+    limit = min(MAX_DELAY_S, min_delay * 2**max(link.failures - 1, 0))
+    return random.uniform(max(limit/2.0, min_delay), limit)
+
+# Returns an action which may be yielded in an untwisted event handler to wait
+# until the next attempt on the given link should be made.
+def wait(link, min_delay=1):
+    delay_s = delay(link, min_delay)
+    link.next_attempt = time.time() + delay_s
+    return runtime.sleep(delay_s)
+
+#===============================================================================
+# Connects `work' to `address', which is a (host, port, ...) tuple or, for Unix
+# sockets, a path. If the host is not a numeric address, it is first resolved in
+# a background thread, in the address family of the socket.
+def connect(work, address):
+    if not isinstance(address, tuple) or is_numeric(work.family, address[0]):
+        work.connect_ex(address)
+        return
+    work.destroy()
+    resolving.add(work)
+    def resume(success, value):
+        if work not in resolving: return
+        resolving.discard(work)
+        work.register()
+        if success:
+            work.connect_ex(value)
+        else:
+            work.poll.drive(RECV_ERR, work, value)
+    def run():
+        try:
+            info = socket.getaddrinfo(
+                address[0], address[1], work.family, socket.SOCK_STREAM)
+            result = (resume, True, info[0][4])
+        except Exception as e:
+            result = (resume, False, e)
+        resolved.append(result)
+    thread = threading.Thread(target=run, name='reconnect.resolve')
+    thread.daemon = True
+    thread.start()
+
+# Abandons any connection being made by connect() for the given Work, which
+# should be called when the Work is destroyed.
+def cancel(work):
+    resolving.discard(work)
+
+def is_numeric(family, host):
+    try:
+        socket.inet_pton(family, host)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+def h_tick(mode):
+    while resolved:
+        resume, success, value = resolved.popleft()
+        try:
+            resume(success, value)
+        except Exception:
+            traceback.print_exc()
+mode.link(TICK, h_tick)
+
+#===============================================================================
+@ab_link('!link-status')
+@admin
+def h_link_status(bot, id, target, args, full_msg):
+    pattern = re.compile(util.wc_to_re(args.strip() or '*'), re.I)
+    now = time.time()
+    def rows():
+        yield '\2Link', 'State', 'Since', 'Failures', 'Attempts', 'Next', \
+              'Last Error\2'
+        for name, link in sorted(links.iteritems()):
+            if not pattern.match(name): continue
+            yield (name, link.state, '%ds ago' % (now - link.since),
+                '%d (%d total)' % (link.failures, link.total_failures),
+                str(link.attempts),
+                'in %ds' % max(link.next_attempt - now, 0)
+                    if link.next_attempt is not None else '-',
+                link.last_error or '-')
+    lenf = lambda s: len(s.replace('\2', ''))
+    for line in util.join_rows(*rows(), lenf=lenf) + ['\2End of List\2']:
+        reply(bot, id, target, line, prefix=False)
@@ -4,14 +4,13 @@ import traceback
 import calendar
 import datetime
 import time
-import json
 import re
-import os.path
 
 from util import LinkSet
 from message import reply
 import channel
 import identity
+import store
 import util
 import auth
 
@@ -25,6 +24,9 @@ PRUNE_THRESHOLD = 100
 
 EVENT_TYPES = 'message', 'action', 'exit'
 
+# The maximum time in seconds for which !seen waits for the channel's WHO reply.
+WHO_TIMEOUT_S = 10
+
 #===============================================================================
 # global_state[chan.lower()]['nick!user@host'.lower()] = {
 #    'exit':    { time: T, params: PE },
@@ -38,45 +40,75 @@ EVENT_TYPES = 'message', 'action', 'exit'
 #     PM in ['message', msg], ['notice', msg]
 global_state = None
 
+# nick_index[chan.lower()][nick.lower()] = set of keys of global_state[chan]
+# having the given nick, for all records in global_state.
+nick_index = None
+
+# The records are persisted by a store.Store, in which the key (chan, id) holds
+# a copy of global_state[chan][id], so that the latter may be modified freely.
+encode_state, decode_state = store.nested_format(2)
+state_store = store.Store(
+    STATE_FILE, encode=encode_state, decode=decode_state)
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'global_state', 'nick_index', 'state_store'
+
 #-------------------------------------------------------------------------------
 def get_state():
     global global_state
     if global_state is not None:
         return global_state
     global_state = dict()
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE) as file:
-                global_state = json.load(file)
-        except (ValueError, IOError):
-            traceback.print_exc()
-    global_state = util.recursive_encode(global_state, 'utf-8')
-    return global_state
-
-#-------------------------------------------------------------------------------
-def put_state(new_state):
-    global global_state
-    global_state = prune_state(new_state)
     try:
-        data = json.dumps(global_state, ensure_ascii=False)
-        with open(STATE_FILE, 'w') as file:
-            file.write(data)
+        for (chan, id), record in state_store.load().iteritems():
+            global_state.setdefault(chan, dict())[id] = dict(record)
     except (ValueError, IOError):
         traceback.print_exc()
+    index_state(global_state)
+    return global_state
+
+#-------------------------------------------------------------------------------
+# Saves the record global_state[chan][id], which must exist.
+def put_record(chan, id):
+    state_store.put((chan, id), dict(global_state[chan][id]))
 
 #-------------------------------------------------------------------------------
-def prune_state(state):
+def prune_state():
+    state = get_state()
     if sum(imap(len, state.itervalues())) <= MAX_RECORDS + PRUNE_THRESHOLD:
-        return state
-    new_state = dict()
+        return
     records = sorted(
         ((c,i,ir) for (c,cr) in state.iteritems() for (i,ir) in cr.iteritems()),
         key=lambda t: max(t[2][et]['time'] for et in EVENT_TYPES if et in t[2]),
         reverse=True)
-    for chan, id, record in records[:MAX_RECORDS]:
-        if chan not in new_state: new_state[chan] = dict()
-        new_state[chan][id] = record
-    return new_state
+    for chan, id, record in records[MAX_RECORDS:]:
+        del state[chan][id]
+        if not state[chan]: del state[chan]
+        state_store.delete((chan, id))
+    index_state(state)
+
+#-------------------------------------------------------------------------------
+def index_state(state):
+    global nick_index
+    nick_index = dict()
+    for chan, chan_state in state.iteritems():
+        for key in chan_state.iterkeys():
+            index_record(chan, key)
+
+def index_record(chan, key):
+    nick = key.split('!', 1)[0]
+    nick_index.setdefault(chan, dict()).setdefault(nick, set()).add(key)
+
+#-------------------------------------------------------------------------------
+# Returns the keys of the records in global_state[chan] which may match the
+# given hostmask pattern: all records, unless the nick in the pattern has no
+# wildcards, in which case only those with that nick.
+def candidate_keys(chan, args):
+    nick = args.split('!', 1)[0] if '!' in args else None
+    if nick is None or '*' in nick or '?' in nick:
+        return get_state().get(chan, dict()).iterkeys()
+    get_state()
+    return nick_index.get(chan, dict()).get(nick.lower(), ())
 
 #===============================================================================
 @link('HELP*')
@@ -108,27 +140,34 @@ def h_seen(bot, id, target, args, full_msg):
 
     if not args: return
 
-    if re.search(r'!|@', args):
-        pattern = util.wc_to_re(args)
-    else:
-        pattern = util.wc_to_re('%s!*@*' % args)
+    if not re.search(r'!|@', args):
+        args = '%s!*@*' % args
+    pattern = re.compile(util.wc_to_re(args), re.I)
 
     # matching_nicks[nick.lower()] = (max_time, id_case)
     matching_nicks = dict()
 
+    # If the pattern has a nick part, only channel members matching it need be
+    # resolved; any not already known are resolved by one WHO for the channel.
+    cnicks = channel.track_channels.get(chan, ())
+    if '!' in args:
+        nick_pattern = re.compile(util.wc_to_re(args.split('!', 1)[0]), re.I)
+        cnicks = [n for n in cnicks if nick_pattern.match(n)]
+    cids = yield identity.get_chan_ids(bot, chan, list(cnicks),
+        timeout_s=WHO_TIMEOUT_S)
+
     in_channel = False
-    for cnick in channel.track_channels.get(chan, ()):
-        cmask = yield identity.get_hostmask(bot, cnick)
-        if re.match(pattern, cmask, re.I):
-            cid = util.ID(*re.match(r'(.*?)!(.*?)@(.*)', cmask).groups())
+    for cid in cids:
+        if cid is not None and pattern.match(identity.id_to_hostmask(cid)):
             matching_nicks[cid.nick.lower()] = (None, cid)
             in_channel = True
-            continue
 
     state = get_state()
+    chan_state = state.get(chan, dict())
     combined_record = dict()
-    for rmask, record in state.get(chan, dict()).iteritems():
-        if re.match(pattern, rmask, re.I):
+    for rmask in candidate_keys(chan, args):
+        record = chan_state[rmask]
+        if pattern.match(rmask):
             if 'id_case' in record:
                 rmask = record['id_case'].encode('utf8')
             rid = util.ID(*re.match(r'(.*?)!(.*?)@(.*)', rmask).groups())
@@ -380,7 +419,26 @@ def h_event(*args, **kwds):
     if chan not in state: state[chan] = dict()
     if id.lower() not in state[chan]:
         state[chan][id.lower()] = dict()
+        index_record(chan, id.lower())
     state[chan][id.lower()][event_type] = {
         'time': time.time(), 'params': params }
     state[chan][id.lower()]['id_case'] = id
-    put_state(state)
+    put_record(chan, id.lower())
+    prune_state()
+
+@link('NETSPLIT')
+def h_netsplit(bot, servers, chans):
+    state, now = get_state(), time.time()
+    for chan, ids in chans.iteritems():
+        if not chan.startswith('#'): continue
+        if chan not in state: state[chan] = dict()
+        for id in ids:
+            id = '%s!%s@%s' % id
+            if id.lower() not in state[chan]:
+                state[chan][id.lower()] = dict()
+                index_record(chan, id.lower())
+            state[chan][id.lower()]['exit'] = {
+                'time': now, 'params': ('quit', ' '.join(servers)) }
+            state[chan][id.lower()]['id_case'] = id
+            put_record(chan, id.lower())
+    prune_state()
@@ -0,0 +1,328 @@
+#===============================================================================
+# store.py - persistent keyed records with an append-only journal.
+#
+# A Store holds a dict of records, each identified by a key which is a tuple of
+# strings, and having any JSON-serialisable value. On disk, the records are kept
+# in a snapshot file, which contains the full set of records as of some point in
+# time, followed by a journal file, which contains one line for each change made
+# since the snapshot was written. Each change therefore costs only the writing
+# of a single line, and the snapshot is rewritten ("compacted") only when the
+# journal has grown sufficiently long.
+#
+# All file I/O is performed in order by a single background thread, so that
+# plugins calling Store.put and Store.delete from event handlers are not blocked
+# by the disk. The values passed to Store.put must not be mutated afterwards, as
+# they may still be waiting to be written by the background thread. Journal
+# entries are flushed to the operating system as they are written, but are only
+# synchronised to the disk (by fsync) at most once every FSYNC_INTERVAL_S.
+#
+# Plugins whose state is a single document, rather than a collection of records,
+# may instead use write_file() to have the whole file replaced in the background.
+
+from __future__ import print_function
+
+import threading
+import traceback
+import Queue
+import atexit
+import time
+import json
+import os
+import os.path
+
+import util
+
+# This module is not reloaded by !reload, so that the writer thread and its
+# queue persist, and writes scheduled before a reload are performed in order.
+__is_local__ = False
+
+# The number of journal entries after which the snapshot is rewritten.
+DEFAULT_COMPACT_ENTRIES = 1000
+
+# The greatest time in seconds for which journal entries may remain unsynced.
+FSYNC_INTERVAL_S = 5
+
+#===============================================================================
+class Store(object):
+    # `path' is the name of the snapshot file, and the journal file is named by
+    # appending '.journal' to this. If given, `encode(records)' should convert a
+    # dict of records to a JSON-serialisable object to be saved as the snapshot,
+    # and `decode(obj)' should perform the inverse operation; otherwise, the
+    # snapshot is saved as a list of [key, value] pairs. If `backups' is nonzero,
+    # then up to this many old snapshots are kept as per rotate_backups().
+    def __init__(
+        self, path, encode=None, decode=None, backups=0, backup_name=None,
+        compact_entries=DEFAULT_COMPACT_ENTRIES
+    ):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.encode = encode or encode_pairs
+        self.decode = decode or decode_pairs
+        self.backups = backups
+        self.backup_name = backup_name
+        self.compact_entries = compact_entries
+
+        self.records = {}
+        self.journal_entries = 0
+        self.journal_file = None
+        self.pending = []
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    # Reads the snapshot and journal from disk, and returns a dict of records,
+    # which should not be modified by the caller except via put() and delete().
+    # This is performed synchronously, and should be called before any changes.
+    def load(self):
+        # Any writes scheduled by a previous instance of the module which owns
+        # this Store, before that module was reloaded, are completed first.
+        flush()
+        records = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                obj = util.recursive_encode(json.load(file), 'utf8')
+            records.update(self.decode(obj))
+
+        entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as file:
+                for line in file:
+                    try:
+                        entry = util.recursive_encode(json.loads(line), 'utf8')
+                    except ValueError:
+                        # A truncated final line may result from a crash.
+                        traceback.print_exc()
+                        break
+                    if len(entry) > 1:
+                        records[tuple(entry[0])] = entry[1]
+                    else:
+                        records.pop(tuple(entry[0]), None)
+                    entries += 1
+
+        self.records = records
+        self.journal_entries = entries
+        return records
+
+    # Sets the record with the given key to the given value.
+    def put(self, key, value):
+        self.records[key] = value
+        self.append([list(key), value])
+
+    # Removes the record with the given key, if it exists.
+    def delete(self, key):
+        if key not in self.records: return
+        del self.records[key]
+        self.append([list(key)])
+
+    def append(self, entry):
+        with self.lock:
+            schedule = not self.pending
+            self.pending.append(entry)
+            generation = self.generation
+        if schedule:
+            submit(self.write_pending, generation)
+        self.journal_entries += 1
+        if self.journal_entries >= self.compact_entries:
+            self.compact()
+
+    # Schedules the rewriting of the snapshot file to contain all current
+    # records, and the subsequent truncation of the journal file. The entries
+    # not yet written are taken together with the copy of the records, and any
+    # changes made after this belong to a new generation, which is written to
+    # the journal only after it has been truncated, rather than being discarded
+    # along with it.
+    def compact(self):
+        self.journal_entries = 0
+        with self.lock:
+            entries, self.pending = self.pending, []
+            records = dict(self.records)
+            self.generation += 1
+        submit(self.write_snapshot, entries, records)
+
+    #---------------------------------------------------------------------------
+    # The following methods are called only from the background thread.
+
+    def write_pending(self, generation):
+        with self.lock:
+            # The entries of a later generation are written by a later call.
+            if generation != self.generation: return
+            entries, self.pending = self.pending, []
+        self.write_entries(entries)
+
+    def write_entries(self, entries):
+        if not entries: return
+        if self.journal_file is None:
+            make_dirs(self.journal_path)
+            self.journal_file = open(self.journal_path, 'a')
+        self.journal_file.write(''.join(
+            json.dumps(e, separators=(',',':')) + '\n' for e in entries))
+        self.journal_file.flush()
+        dirty_stores.add(self)
+
+    def write_snapshot(self, entries, records):
+        # The journal entries queued before this snapshot, which it includes,
+        # are written first, so that they are not lost if it is interrupted.
+        self.write_entries(entries)
+        data = json.dumps(self.encode(records), separators=(',',':'))
+        atomic_write(self.path, data, self.backups, self.backup_name)
+
+        # If the process is interrupted before this point, the remaining journal
+        # entries are harmlessly replayed on top of the new snapshot.
+        self.close_journal()
+        with open(self.journal_path, 'w'):
+            pass
+
+    def sync(self):
+        if self.journal_file is not None:
+            os.fsync(self.journal_file.fileno())
+
+    def close_journal(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        dirty_stores.discard(self)
+
+# The default snapshot format: a list of [key, value] pairs.
+def encode_pairs(records):
+    return [[list(k), v] for (k, v) in records.iteritems()]
+
+def decode_pairs(obj):
+    return {tuple(k): v for (k, v) in obj}
+
+# Returns an (encode, decode) pair for snapshots in the form of nested dicts,
+# such that records[(k1, ..., kn)] == obj[k1]...[kn], where n == depth.
+def nested_format(depth):
+    def encode(records):
+        obj = dict()
+        for key, value in records.iteritems():
+            parent = obj
+            for k in key[:-1]: parent = parent.setdefault(k, dict())
+            parent[key[-1]] = value
+        return obj
+    def decode(obj, key=(), depth=depth):
+        if depth == 0: return {key: obj}
+        records = dict()
+        for k, v in obj.iteritems():
+            records.update(decode(v, key + (k,), depth - 1))
+        return records
+    return encode, lambda obj: decode(obj)
+
+#===============================================================================
+# Schedules the file at `path' to be replaced by the string `data'. If this is
+# called again for the same path before the file has been written, only the
+# latest data is written.
+def write_file(path, data):
+    with files_lock:
+        schedule = path not in pending_files
+        pending_files[path] = data
+    if schedule:
+        submit(write_pending_file, path)
+
+def write_pending_file(path):
+    with files_lock:
+        data = pending_files.pop(path)
+    atomic_write(path, data)
+
+# Replaces the file at `path' with `data', such that if the process is
+# interrupted, the file contains either its old or its new contents.
+def atomic_write(path, data, backups=0, backup_name=None):
+    make_dirs(path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    if backups:
+        rotate_backups(path, backup_name, backups)
+    os.rename(temp_path, path)
+
+#===============================================================================
+# Given the name of an existing file, and the name of its backups containing
+# '%d', to be substituted with an integer from 1 to `backups', renames each
+# backup to the next highest number, and hard-links the file to the first
+# backup, so that the file may subsequently be replaced (via os.rename) without
+# its old version being copied or lost.
+def rotate_backups(path, backup_name, backups):
+    make_dirs(backup_name)
+    prev_name = None
+    for n in xrange(backups, -1, -1):
+        name = (backup_name % n) if n > 0 else path
+        # To prevent floods of changes from destroying all viable backups,
+        # the oldest, 2nd-oldest, and 3rd-oldest backups are only replaced
+        # by files newer than them by resp. 1 day, 1 hour, and 5 minutes.
+        # (Unless backups < 4, in which case the 4th-, 3rd- and 2nd-newest
+        # backups, when they exist, assume these roles.)
+        min_d = 86400 if n == max(3, backups-1) else \
+                 3600 if n == max(2, backups-2) else \
+                  300 if n == max(1, backups-3) else None
+        if os.path.exists(name) and prev_name is not None \
+        and (not os.path.exists(prev_name) \
+        or os.stat(name).st_mtime - os.stat(prev_name).st_mtime > min_d):
+            if n > 0:
+                os.rename(name, prev_name)
+            else:
+                if os.path.exists(prev_name): os.remove(prev_name)
+                os.link(name, prev_name)
+        prev_name = name
+
+def make_dirs(path):
+    dir = os.path.dirname(path)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+
+#===============================================================================
+# The background writer thread, shared by all Store instances.
+
+write_queue = Queue.Queue()
+writer_thread = None
+
+# The Stores with journal entries not yet synchronised to the disk.
+dirty_stores = set()
+
+# pending_files[path] = data, for each file scheduled by write_file().
+pending_files = dict()
+files_lock = threading.Lock()
+
+def submit(func, *args):
+    global writer_thread
+    if writer_thread is None or not writer_thread.is_alive():
+        writer_thread = threading.Thread(target=writer,
+            args=(write_queue, dirty_stores), name='store.writer')
+        writer_thread.daemon = True
+        writer_thread.start()
+    write_queue.put((func, args))
+
+def writer(queue, dirty):
+    last_sync = time.time()
+    while True:
+        timeout = max(0, last_sync + FSYNC_INTERVAL_S - time.time()) \
+                  if dirty else None
+        try:
+            func, args = queue.get(timeout=timeout)
+        except Queue.Empty:
+            func = None
+        if func is not None:
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                queue.task_done()
+        if dirty and time.time() >= last_sync + FSYNC_INTERVAL_S:
+            sync_stores(dirty)
+            last_sync = time.time()
+
+def sync_stores(dirty):
+    for store in list(dirty):
+        try:
+            store.sync()
+        except Exception:
+            traceback.print_exc()
+    dirty.clear()
+
+# Blocks until all scheduled writes have been completed and synchronised.
+def flush():
+    if writer_thread is None: return
+    submit(sync_stores, dirty_stores)
+    write_queue.join()
+
+atexit.register(lambda: flush())
@@ -22,6 +22,7 @@ from util import multi, wc_to_re
 from auth import admin
 import runtime
 import channel
+import store
 import util
 import auth
 import identity
@@ -36,6 +37,9 @@ install, uninstall = util.depend(install, uninstall,
 # Memory-cached plugin state.
 current_state = None
 
+# See util.preserve_reload_state.
+__reload_preserve__ = 'current_state',
+
 
 # File where the plugin state is stored.
 STATE_FILE = 'state/tell.pickle'
@@ -124,6 +128,8 @@ def put_state(state):
 # Retrieve the plugin's state.
 def load_state():
     global current_state
+    # Complete any write left pending from before this module was reloaded.
+    if not current_state: store.flush()
     if not current_state and os.path.exists(STATE_FILE):
         try:
             with open(STATE_FILE, 'r') as state_file:
@@ -135,12 +141,10 @@ def load_state():
     return current_state
 
 # Change to the given state without any processing of metadata.
+# The state is serialised immediately, but written to disk in the background.
 def set_state(state):
     global current_state
-    with open(STATE_FILE, 'w') as state_file:
-        pickler = pickle.Pickler(state_file)
-        pickler.clear_memo()
-        pickler.dump(state)
+    store.write_file(STATE_FILE, pickle.dumps(state))
     current_state = state    
 
 class HistoryEmpty(Exception): pass
@@ -2,6 +2,7 @@
 import util
 import runtime
 import terraria_protocol
+import reconnect
 import bridge
 
 from untwisted.magic import sign
@@ -19,6 +20,7 @@ import re
 import operator
 
 #==============================================================================#
+# The least delay before reconnecting after a failure; see reconnect.wait.
 RECONNECT_DELAY_SECONDS = 30
 VERSION_RECONNECT_DELAY_SECONDS = 5
 MAX_CHAT_LENGTH = 127
@@ -88,6 +90,9 @@ def uninstall(bot, reload=False):
     ab_link.uninstall(ab_mode)
     ab_mode = None
 
+install, uninstall = util.depend(install, uninstall,
+    'reconnect')
+
 def reload(prev):
     if not hasattr(prev, 'te_work'): return
     if not isinstance(prev.te_work, dict): return
@@ -110,8 +115,7 @@ def reload_work(work):
 #-------------------------------------------------------------------------------
 def init_work(server, reload_from=None, reconnect_from=None, version=None):
     if reload_from is not None:
-        reload_from.destroy()
-        work = untwisted.network.Work(te_mode, reload_from.sock)
+        work = reload_from.transfer(te_mode)
         if hasattr(reload_from, 'terraria_protocol'):
             work.terraria_protocol = reload_from.terraria_protocol
         work.prev_terraria_protocol = getattr(
@@ -125,7 +129,8 @@ def init_work(server, reload_from=None, reconnect_from=None, version=None):
             version = state.get('version')
         work = untwisted.network.Work(te_mode, socket.socket())
         work.setblocking(0)
-        work.connect_ex(server.address)
+        reconnect.attempt(server_link(server))
+        reconnect.connect(work, server.address)
         terraria_protocol.login(
             work, server.user, server.password, version=version)
         if hasattr(reconnect_from, 'prev_terraria_protocol'):
@@ -139,12 +144,8 @@ def kill_work(work, remove=True):
     if remove and hasattr(work, 'terraria'):
         del work.terraria
     terraria_protocol.close(work)
-    try: work.destroy()
-    except socket.error: pass
-    try: work.shutdown(socket.SHUT_RDWR)
-    except socket.error: pass
-    try: work.close()
-    except socket.error: pass
+    reconnect.cancel(work)
+    work.terminate()
 
 #==============================================================================#
 @ab_link('BRIDGE')
@@ -252,9 +253,15 @@ def te_disconnect(work, msg):
         disconnect_work(work)
     raise Stop
 
+#-------------------------------------------------------------------------------
+@te_link(untwisted.event.CONNECT)
+def te_connect(work):
+    reconnect.connected(server_link(work.terraria))
+
 #-------------------------------------------------------------------------------
 @te_link('CONNECTION_APPROVED')
 def te_connection_approved(work, *args):
+    reconnect.established(server_link(work.terraria))
     state = get_state()
     server_state = state.get(repr(work.terraria.address), dict())
     server_state['version'] = work.terraria_protocol.version
@@ -280,7 +287,7 @@ def te_disconnect_recv_err(work, info):
 @te_link(untwisted.event.RECV_ERR)
 @te_link(untwisted.event.CLOSE)
 def te_disconnect_recv_err_close(work, *args):
-    yield reconnect_work(work)
+    yield reconnect_work(work, reason=args[0] if args else 'connection closed')
 
 #-------------------------------------------------------------------------------
 @te_link('TERRARIA')
@@ -290,17 +297,29 @@ def te_terraria(work, msg, **kwds):
         work.terraria.name, msg, wname, **kwds)
 
 #==============================================================================#
-def reconnect_work(work, version=None, delay=None):
-    return util.msign(ab_mode, 'terraria.reconnect_work', work, version, delay)
+# If `delay' is given, reconnects after this many seconds, as when trying another
+# protocol version; otherwise, the connection is considered to have failed, and
+# the delay is chosen by reconnect.wait.
+def reconnect_work(work, version=None, delay=None, reason=None):
+    return util.msign(ab_mode, 'terraria.reconnect_work',
+        work, version, delay, reason)
 
 @ab_link('terraria.reconnect_work')
-def h_reconnect_work(work, version, delay):
+def h_reconnect_work(work, version, delay, reason):
     server = work.terraria
     disconnect_work(work, remove=False)
-    yield runtime.sleep(delay or RECONNECT_DELAY_SECONDS)
+    if delay is not None:
+        yield runtime.sleep(delay)
+    else:
+        link = server_link(server)
+        reconnect.failed(link, reason)
+        yield reconnect.wait(link, RECONNECT_DELAY_SECONDS)
     new_work = init_work(server, version=version, reconnect_from=work)
     te_work[server.name.lower()] = new_work
 
+def server_link(server):
+    return reconnect.get_link('terraria:%s' % server.name)
+
 def disconnect_work(work, remove=True):
     server = work.terraria
     kill_work(work, remove=remove)
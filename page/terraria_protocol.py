@@ -4,12 +4,14 @@ import runtime
 import util
 
 from untwisted import event
-from untwisted.utils import common
 from untwisted.utils import std
+from untwisted.utils.framing import Buffer
 from untwisted.magic import sign
 from untwisted import event
 
+from collections import deque
 import struct
+import time
 import sys
 import re
 
@@ -17,10 +19,39 @@ import re
 __INSTALL_BOT__ = False
 
 DEFAULT_VERSION = 'Terraria188'
+RECV_SIZE = 64 * 1024
+
+# The headers of messages in protocol versions from 156, and before 156: the
+# length and type of each message. In the earlier versions, the length does not
+# include the 4 bytes of the length field itself.
+HEADER = struct.Struct('<HB')
+OLD_HEADER = struct.Struct('<iB')
+
+# The types of messages which are discarded as they are received, without being
+# buffered or dispatched, including the tile data which forms most of the data
+# sent by the server on login. Messages of other types longer than
+# MAX_MESSAGE_LENGTH are also discarded, so that the size of the receive buffer
+# is bounded.
+IGNORED_TYPES = frozenset((0x0a, 0x14, 0x17, 0x1a, 0x1b, 0x1c, 0x1d))
+MAX_MESSAGE_LENGTH = 0x10000
+
+# The greatest length of the text of a chat message, and the greatest length of
+# a line, including the sender's name as it is shown by the server.
+MAX_CHAT_LENGTH = 127
+
+# Chat messages are sent at most once every CHAT_INTERVAL_S seconds, except for
+# bursts of up to CHAT_BURST messages after a period of inactivity. Messages
+# which must wait are queued, and consecutive queued messages of the same colour
+# are merged, separated by CHAT_SEPARATOR, while the result is short enough.
+# If more than MAX_CHAT_QUEUE messages are queued, the oldest are dropped, and a
+# count of the dropped messages is sent in their place.
+CHAT_INTERVAL_S = 1.0
+CHAT_BURST = 4
+CHAT_SEPARATOR = ' | '
+MAX_CHAT_QUEUE = 20
 
 link = util.LinkSet()
 link.link_module(std)
-link.link(event.DATA, common.append)
 
 debug_link = util.LinkSet()
 
@@ -40,21 +71,42 @@ def uninstall(mode):
     del mode.terraria_protocol
 
 
-@link(event.BUFFER)
-def h_buffer(work, data):
-    if work.terraria_protocol.version_number > 155:
-        while len(data) > 2:
-            length, type = struct.unpack('<hB', data[:3])
-            if len(data) < length: break
-            yield sign('MESSAGE', work, type, data[:length][3:])
-            data = data[length:]
+@link(event.DATA)
+def h_data(work):
+    if not hasattr(work, 'terraria_protocol'): return
+    proto, data = work.terraria_protocol, work.data
+    if getattr(proto, 'recv_buf', None) is None:
+        proto.recv_buf, proto.skip_rem = Buffer(), 0
+    if proto.skip_rem:
+        skip = min(proto.skip_rem, len(data))
+        proto.skip_rem -= skip
+        if skip == len(data): return
+        data = buffer(data, skip)
+    proto.recv_buf.append(data)
+    for type, body in read_messages(proto):
+        yield sign('MESSAGE', work, type, body)
+
+# Yields (type, body) for each complete message in the receive buffer of the
+# given protocol state, reading the headers in place, and removing from the
+# buffer each message yielded or discarded. If a discarded message is incomplete,
+# `proto.skip_rem' is set to the number of bytes of it still to be received.
+def read_messages(proto):
+    queue = proto.recv_buf
+    if proto.version_number > 155:
+        header, extra = HEADER, 0
     else:
-        while len(data) > 4:
-            length, type = struct.unpack('<iB', data[:5])
-            if len(data) < length + 4: break
-            yield sign('MESSAGE', work, type, data[4:][1:length])
-            data = data[4:][length:]
-    work.stack = data
+        header, extra = OLD_HEADER, 4
+    while len(queue) >= header.size:
+        length, type = queue.unpack(header)
+        length = max(length + extra, header.size)
+        if type in IGNORED_TYPES or length > MAX_MESSAGE_LENGTH:
+            proto.skip_rem = max(length - len(queue), 0)
+            queue.skip(length)
+            continue
+        if len(queue) < length: break
+        body = queue.get(header.size, length)
+        queue.skip(length)
+        yield type, body
 
 
 @link('MESSAGE')
@@ -102,7 +154,7 @@ def h_message(work, head, body):
         yield sign('WORLD_INFORMATION', work, spawn, world_name)
     elif head == 0x25:
         yield sign('REQUEST_PASSWORD', work)
-    elif head not in (0x0a, 0x14, 0x17, 0x1a, 0x1b, 0x1c, 0x1d):
+    elif head not in IGNORED_TYPES:
         yield sign('UNKNOWN', work, '$%02X' % head, body)
 
 def unpack_string(bot, data):
@@ -212,7 +264,8 @@ def send_password(work, password):
 
 @debug_send
 def send_chat(work, slot, (r,g,b), text):
-    body = struct.pack('<B3B', slot, r,g,b) + pack_string(work, text[:127])
+    body = struct.pack('<B3B', slot, r,g,b) \
+         + pack_string(work, text[:MAX_CHAT_LENGTH])
     send_message(work, 0x19, body)
 
 
@@ -222,20 +275,71 @@ def login(work, name, password='', version=None):
 
     class TerrariaProtocol(object): pass
     work.terraria_protocol = TerrariaProtocol()
-    work.terraria_protocol.chat_queue = []
+    init_chat(work.terraria_protocol)
     work.terraria_protocol.players = dict()
     work.terraria_protocol.stage = 0
     work.terraria_protocol.name = name
     work.terraria_protocol.password = password
     work.terraria_protocol.version = version
     work.terraria_protocol.version_number = version_number
+    work.terraria_protocol.recv_buf = Buffer()
+    work.terraria_protocol.skip_rem = 0
+    work.SIZE = RECV_SIZE
     send_connect_request(work, version)
 
+def init_chat(proto, queue=()):
+    # Before reload, the queue may be a list of strings.
+    proto.chat_queue = deque(((255,255,255), t) if isinstance(t, str) else t
+                             for t in queue)
+    proto.chat_dropped = 0
+    proto.chat_tokens = CHAT_BURST
+    proto.chat_time = time.time()
+    proto.chat_sending = False
+
+# Queues a chat message to be sent as soon as the rate limit allows, and after
+# the player has spawned; see CHAT_INTERVAL_S.
 def chat(work, text, colour=(255,255,255)):
-    if work.terraria_protocol.stage != 3:
-        work.terraria_protocol.chat_queue.append(text)
+    proto = work.terraria_protocol
+    if not hasattr(proto, 'chat_tokens'): init_chat(proto, proto.chat_queue)
+    queue = proto.chat_queue
+    max_length = MAX_CHAT_LENGTH - len('<%s> ' % proto.name)
+    if queue and queue[-1][0] == colour and len(queue[-1][1]) \
+    + len(CHAT_SEPARATOR) + len(text) <= max_length:
+        queue[-1] = (colour, queue[-1][1] + CHAT_SEPARATOR + text)
     else:
-        send_chat(work, work.terraria_protocol.slot, colour, text)    
+        queue.append((colour, text))
+        if len(queue) > MAX_CHAT_QUEUE:
+            queue.popleft()
+            proto.chat_dropped += 1
+    if proto.stage == 3 and not proto.chat_sending:
+        work.poll.drive('CHAT_SEND', work)
+
+@link('CHAT_SEND')
+def h_chat_send(work):
+    if not hasattr(work, 'terraria_protocol'): return
+    proto = work.terraria_protocol
+    if proto.chat_sending: return
+    proto.chat_sending = True
+    try:
+        while getattr(work, 'terraria_protocol', None) is proto \
+        and (proto.chat_queue or proto.chat_dropped):
+            now = time.time()
+            proto.chat_tokens = min(CHAT_BURST, proto.chat_tokens
+                + (now - proto.chat_time) / CHAT_INTERVAL_S)
+            proto.chat_time = now
+            if proto.chat_tokens < 1:
+                yield runtime.sleep((1 - proto.chat_tokens) * CHAT_INTERVAL_S)
+                continue
+            proto.chat_tokens -= 1
+            if proto.chat_dropped:
+                colour, text = (255,255,255), '[%d message%s omitted]' % (
+                    proto.chat_dropped, 's' if proto.chat_dropped > 1 else '')
+                proto.chat_dropped = 0
+            else:
+                colour, text = proto.chat_queue.popleft()
+            send_chat(work, proto.slot, colour, text)
+    finally:
+        proto.chat_sending = False
 
 def close(work):
     if hasattr(work, 'terraria_protocol'):
@@ -278,9 +382,7 @@ def h_spawn(work):
     work.terraria_protocol.stage = 3
     spawn = (0, 9999)
     send_spawn_player(work, work.terraria_protocol.slot, *spawn)
-    for text in work.terraria_protocol.chat_queue:
-        chat(work, text)
-    work.terraria_protocol.chat_queue = []
+    yield sign('CHAT_SEND', work)
     yield sign('HEARTBEAT', work)
 
 @link('HEARTBEAT')
@@ -21,15 +21,15 @@ import locale
 import os.path
 import sys
 
-from bs4 import BeautifulSoup
 from untwisted.magic import sign
 
 from url_collect import URL_PART_RE
-from util import multi, is_global_address
+from util import multi, is_global_address, BeautifulSoup
 from runtime import later
 import url_collect
 import runtime
 import util
+import workers
 import imgur
 import identity
 
@@ -41,6 +41,8 @@ USER_AGENT_TEXT = 'Links (2.16; Linux 4.16.3-1-ARCH x86_64; GNU C 8.1; text)'
 ACCEPT_ENCODING = 'gzip, deflate'
 
 TIMEOUT_S = 20
+# The time limit for all requests made for a single URL by a worker process.
+WORKER_TIMEOUT_S = 120
 READ_BYTES_MAX = 1024*1024
 CMDS_PER_LINE_MAX = 6
 GIBG_CACHE_SIZE = 128
@@ -127,7 +129,11 @@ def h_url(bot, id, target, args, full_msg, action, reply):
 
     for url in urls:
         try:
-            result = get_title_proxy(url)
+            # The cache is filled here from the result, rather than by the
+            # worker process, whose copy of it is discarded.
+            result = yield workers.call(bot, get_title_proxy, url,
+                gibg_cache=dict(gibg_cache), timeout=WORKER_TIMEOUT_S)
+            if result.get('gibg'): put_gibg_cache(*result['gibg'])
             reply(result['title'])
 
             # Generate a URL-suppressed proxy message for the basic component.
@@ -169,7 +175,9 @@ def get_title(url):
 #   'title_bare':     'title' without any parenthetical information.
 #   'proxy_msg':      The part of 'title' considered to be a proxy message.
 #   'proxy_msg_full': The unabbreviated version of 'proxy_msg'.
-def get_title_proxy(url):
+#   'gibg':           (url, guess), if a Google image best guess was looked up.
+# If given, `gibg_cache' is a dict of cached results of google_image_best_guess.
+def get_title_proxy(url, gibg_cache=None):
     url, is_nsfw = url_collect.url_nsfw(url)
     url = utf8_url_to_ascii(url)
 
@@ -210,7 +218,8 @@ def get_title_proxy(url):
             size = info['Content-Length'] if 'Content-Length' in info else None
             final_url = stream.geturl()
             parts = try_bind_hosts(partial(
-                get_title_parts, final_url, ctype, stream=stream))
+                get_title_parts, final_url, ctype, stream=stream,
+                gibg_cache=gibg_cache))
             return info, ctype, size, final_url, parts
 
     info, ctype, size, final_url, parts = try_bind_hosts(read_url)
@@ -242,7 +251,8 @@ def get_title_proxy(url):
         'title':      '%s [%s]' % (title, url_info),
         'title_bare': title,
         'proxy':      parts.get('proxy'),
-        'proxy_full': parts.get('proxy_full') }
+        'proxy_full': parts.get('proxy_full'),
+        'gibg':       parts.get('gibg') }
 
 #-------------------------------------------------------------------------------
 # Given a URL and its MIME type (according to HTTP), and possibly also given a
@@ -255,6 +265,7 @@ def get_title_proxy(url):
 #   'proxy':      the part of 'info' (if any) considered to be a proxy message.
 #   'proxy_full': the unabbreviated version (if any) of 'proxy'.
 #   'nsfw':       True to indicate that the content is "not safe for work".
+#   'gibg':       (url, guess), if a Google image best guess was looked up.
 def get_title_parts(url, type, **kwds):
     match = URL_PART_RE.match(url)
     path, query = decode_url_path(match.group('path'))
@@ -329,10 +340,10 @@ def get_title_html(url, type, stream=None, **kwds):
 
 #-------------------------------------------------------------------------------
 def get_title_image(url, type, **kwds):
-    title = google_image_best_guess(url, **kwds)
+    guess = google_image_best_guess(url, **kwds)
     title = 'Possibly related: %s' % (
-        format_title(title) if title else '(no result)')
-    return { 'title': title }
+        format_title(guess) if guess else '(no result)')
+    return { 'title': title, 'gibg': (url, guess) }
 
 #-------------------------------------------------------------------------------
 def get_title_youtube(url, type, **kwds):
@@ -510,23 +521,29 @@ def bytes_to_human_size(bytes):
         return ('%.1f %s' if m>1 else '%d %s') % (units, s)
 
 #===============================================================================
-# Returns the "best guess" phrase that Google's reverse image search offers to
-# describe the image at the given URL, or None if no such phrase is offered.
 gibg_cache = dict()
-def google_image_best_guess(url, use_cache=False, **kwds):
-    if use_cache and url in gibg_cache:
+
+# See util.preserve_reload_state.
+__reload_preserve__ = 'gibg_cache',
+
+# Returns the "best guess" phrase that Google's reverse image search offers to
+# describe the image at the given URL, or None if no such phrase is offered. If
+# given, `gibg_cache' is a dict of earlier results, in which `url' is looked up
+# first; the caller is responsible for adding the result using put_gibg_cache.
+def google_image_best_guess(url, gibg_cache=None, **kwds):
+    if gibg_cache is not None and url in gibg_cache:
         return gibg_cache[url]
 
     PHRASE = 'Possible related search:'
     soup = google_image_title_soup(url, **kwds)
     node = soup.find(text=re.compile(re.escape(PHRASE)))
 
-    result = node and node.parent.text.replace(PHRASE, '').strip()
-    if use_cache:
-        gibg_cache[url] = result
-        while len(gibg_cache) > GIBG_CACHE_SIZE:
-            gibg_cache.popitem()
-    return result
+    return node and node.parent.text.replace(PHRASE, '').strip()
+
+def put_gibg_cache(url, guess):
+    gibg_cache[url] = guess
+    while len(gibg_cache) > GIBG_CACHE_SIZE:
+        gibg_cache.popitem()
 
 def google_image_title_soup(url, bind_host=None, **kwds):
     request = urllib2.Request('https://www.google.com/searchbyimage?'
@@ -23,10 +23,8 @@ URL_PART_RE = re.compile(
 
 history = collections.defaultdict(lambda: [])
 
-#==============================================================================#
-def reload(prev):
-    if hasattr(prev, 'history') and isinstance(prev.history, dict):
-        history.update(prev.history)
+# See util.preserve_reload_state.
+__reload_preserve__ = 'history',
 
 #==============================================================================#
 @link('MESSAGE', 'UNOTICE')
@@ -113,6 +113,23 @@ def module_is_local(mod):
     root = os.path.dirname(__file__)
     return os.path.commonprefix([mod.__file__, root]) == root
 
+# When a module is reloaded by !reload, the objects named in its tuple
+# __reload_preserve__, such as caches and indexes, are passed as-is from the
+# previous version of the module to the new version, before the new version's
+# reload function, if any, is called. This only happens if the two versions have
+# the same __reload_version__ (by default, 0), which should be changed whenever
+# the structure of any such object changes. Returns the names of the objects
+# that were passed.
+def preserve_reload_state(module, prev):
+    if getattr(module, '__reload_version__', 0) \
+    != getattr(prev, '__reload_version__', 0): return []
+    prev_names = getattr(prev, '__reload_preserve__', ())
+    names = [n for n in getattr(module, '__reload_preserve__', ())
+             if n in prev_names and hasattr(prev, n)]
+    for name in names:
+        setattr(module, name, getattr(prev, name))
+    return names
+
 # Returns the sum of `throws' PRNG-simulated rolls of a `sides'-sided die.
 def dice(throws, sides):
     return sum(random.randint(1, sides) for n in xrange(throws))
@@ -447,24 +464,24 @@ def wc_to_re(wc, anchor=True):
 #===============================================================================
 # Given a module install and uninstall function, returns a new pair of such
 # functions which enforce the given module names as dependencies, to be
-# installed first.
+# installed first. Any further arguments to uninstall are passed on.
 def depend(install, uninstall, *deps):
-    installed = [False]
+    installed = set()
 
     def depend_install(mode):
-        if installed[0]: raise AlreadyInstalled
+        if mode in installed: raise AlreadyInstalled
         for dep in deps:
             try: __import__(dep).install(mode)
             except AlreadyInstalled: pass
         try: install(mode)
         except AlreadyInstalled: pass
-        installed[0] = True
+        installed.add(mode)
 
-    def depend_uninstall(mode):
-        if not installed[0]: raise NotInstalled
-        try: uninstall(mode)
+    def depend_uninstall(mode, *args, **kwds):
+        if mode not in installed: raise NotInstalled
+        try: uninstall(mode, *args, **kwds)
         except NotInstalled: pass
-        installed[0] = False
+        installed.remove(mode)
 
     return depend_install, depend_uninstall
 
@@ -584,6 +601,12 @@ def ext_url_opener(
     opener.open, base_open = ext_open, opener.open
     return opener
 
+# As bs4.BeautifulSoup, except that bs4, which (with its parsers) is slow to
+# import, is only imported when this is first called.
+def BeautifulSoup(*args, **kwds):
+    import bs4
+    return bs4.BeautifulSoup(*args, **kwds)
+
 def ext_urlopen(url, data=None, timeout=EXT_URL_DEFAULT_TIMEOUT, *args, **kwds):
     return urllib2.urlopen(url, data, timeout, *args, **kwds)
 
@@ -638,10 +661,18 @@ class md_array(object):
         return self.dimensions != other.dimensions or self.array != other.array
     def __iter__(self):
         return iter(self.array)
+    def copy(self):
+        other = md_array.__new__(md_array)
+        other.dimensions, other.array = self.dimensions, self.array[:]
+        return other
     def __repr__(self):
         return 'md_array(%r, %r, %r)' % (
             self.array.typecode, self.dimensions, list(self.array))
 
+#===============================================================================
+# A first-in, first-out queue of bytes, for the framing of network protocols.
+from untwisted.utils.framing import Buffer as ByteQueue
+
 #==============================================================================#
 # True if the given hostname or IPV4 or IPV6 address string is not in any
 # address range reserved for private or local use, or otherwise False.
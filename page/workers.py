@@ -0,0 +1,217 @@
+#===============================================================================
+# workers.py - a pool of worker processes for CPU-intensive computations.
+#
+# A function defined at the top level of a module, whose arguments and result
+# can be pickled, may be called in a worker process from an untwisted event
+# handler by
+#     result = yield workers.call(bot, func, arg1, arg2, ...)
+# which suspends the handler, without blocking the processing of other events,
+# until the result is available. Any exception raised by the function is raised
+# again in the handler. If the function does not return within `timeout'
+# seconds (given as a keyword argument), the pool is restarted, so as to stop
+# it, and WorkerTimeout is raised instead.
+#
+# The number of worker processes is given by the `workers' setting of the bot;
+# if this is 0, or if the pool cannot be started, the function is just called
+# directly. Worker processes are forked from the bot when the pool is started,
+# so the function must not depend on any state changed since then, other than
+# through its arguments; and the pool is restarted when this module is reloaded,
+# so that the workers use the current version of each module.
+
+from __future__ import print_function
+
+from collections import deque
+import multiprocessing
+import traceback
+import cPickle
+import socket
+import random
+import time
+
+from untwisted.event import READ, TICK
+from untwisted.mode import Mode
+import untwisted.network
+import untwisted.usual
+
+# The default time limit, in seconds, for each call.
+DEFAULT_TIMEOUT_S = 30
+
+class WorkerError(Exception):
+    pass
+
+class WorkerTimeout(WorkerError):
+    pass
+
+#===============================================================================
+class Job(object):
+    __slots__ = 'func', 'args', 'kwds', 'deadline', 'resume', 'attempt'
+    def __init__(self, func, args, kwds, deadline, resume):
+        self.func, self.args, self.kwds = func, args, kwds
+        self.deadline, self.resume = deadline, resume
+        self.attempt = None
+
+# The pool, if it has been started, and the number of processes it has.
+pool = None
+pool_size = None
+
+# The jobs submitted to the pool, whose results have not yet been received.
+pending = set()
+
+# (job, attempt, success, value) for each job whose result has been received
+# by the pool's result thread, but not yet passed on to the job's handler.
+results = deque()
+
+# A pair of connected sockets, of which one is written to by the pool's result
+# thread to wake the main thread, which receives from the other.
+wake_send, wake_recv = None, None
+
+mode = Mode()
+
+#===============================================================================
+def call(bot, func, *args, **kwds):
+    timeout = kwds.pop('timeout', DEFAULT_TIMEOUT_S)
+    def act(source, chain):
+        def resume(success, value):
+            try:
+                next = chain.send(value) if success else chain.throw(value)
+                next(source, chain)
+                untwisted.usual.chain(source, chain)
+            except StopIteration:
+                pass
+        if not enabled(bot):
+            try:
+                value = func(*args, **kwds)
+            except Exception as e:
+                resume(False, e)
+            else:
+                resume(True, value)
+        else:
+            job = Job(func, args, kwds, time.time() + timeout, resume)
+            submit(job)
+        raise StopIteration
+    return act
+
+# True if call() would use a worker process for the given bot, in which case
+# callers may need to copy any state on which the function depends.
+def enabled(bot):
+    return get_pool(bot.conf.get('workers', 0)) is not None
+
+# Returns the pool, starting it with `size' processes if necessary, or None if
+# there is to be no pool. A change in `size' takes effect after the next reload.
+def get_pool(size):
+    global pool, pool_size, wake_send, wake_recv
+    if pool is not None:
+        return pool
+    if not size or size < 0:
+        return None
+    try:
+        pool = multiprocessing.Pool(size, initializer=init_worker)
+    except Exception:
+        traceback.print_exc()
+        return None
+    pool_size = size
+    if wake_recv is None:
+        wake_send, wake_recv = socket.socketpair()
+        wake_send.setblocking(0)
+        wake_recv.setblocking(0)
+        untwisted.network.Work(mode, wake_recv)
+        mode.link(READ, h_read)
+        mode.link(TICK, h_tick)
+    return pool
+
+def init_worker():
+    # Otherwise, each worker would produce the same random numbers.
+    random.seed()
+
+def submit(job):
+    attempt = job.attempt = object()
+    def callback(result):
+        results.append((job, attempt) + result)
+        try:
+            wake_send.send('\0')
+        except socket.error:
+            pass
+    pending.add(job)
+    pool.apply_async(run_job, (job.func, job.args, job.kwds), callback=callback)
+
+# Called in a worker process. Returns (True, result) or (False, exception),
+# where the exception is replaced by a WorkerError if it cannot be pickled.
+def run_job(func, args, kwds):
+    try:
+        return (True, func(*args, **kwds))
+    except Exception as e:
+        try:
+            cPickle.dumps(e, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            e = WorkerError('%s: %s' % (type(e).__name__, e))
+        return (False, e)
+
+#===============================================================================
+def h_read(work):
+    try:
+        while wake_recv.recv(4096): pass
+    except socket.error:
+        pass
+    while results:
+        job, attempt, success, value = results.popleft()
+        if job.attempt is not attempt: continue
+        pending.discard(job)
+        try:
+            job.resume(success, value)
+        except Exception:
+            traceback.print_exc()
+
+# Restarts the pool if any job has exceeded its time limit, resubmitting any
+# other unfinished jobs, and raising WorkerTimeout for those that have expired.
+def h_tick(work):
+    now = time.time()
+    expired = [j for j in pending if j.deadline < now]
+    if not expired: return
+    jobs = list(pending)
+    stop_pool()
+    get_pool(pool_size)
+    for job in jobs:
+        if job not in expired and pool is not None:
+            submit(job)
+            continue
+        try:
+            job.resume(False,
+                WorkerTimeout('The computation took too long.')
+                if job in expired else
+                WorkerError('The worker pool failed to restart.'))
+        except Exception:
+            traceback.print_exc()
+
+def stop_pool():
+    global pool
+    if pool is None: return
+    try:
+        pool.terminate()
+    except Exception:
+        traceback.print_exc()
+    pool = None
+    pending.clear()
+    results.clear()
+
+# Stops the pool and abandons all unfinished jobs, with WorkerError.
+def shutdown():
+    global wake_send, wake_recv
+    jobs = list(pending)
+    stop_pool()
+    for job in jobs:
+        try:
+            job.resume(False, WorkerError('The worker pool was restarted.'))
+        except Exception:
+            traceback.print_exc()
+    if wake_recv is not None:
+        for work in list(untwisted.network.gear.rlist):
+            if getattr(work, 'poll', None) is mode: work.destroy()
+        wake_send.close()
+        wake_recv.close()
+        wake_send, wake_recv = None, None
+
+def reload(prev):
+    prev.shutdown()
+
+def hard_reload(prev):
+    prev.shutdown()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+#===============================================================================
+# Measures the speed at which the `freeciv' module splits the data received
+# from a Freeciv server into packets, by replaying a captured stream, and
+# compares this with the previous implementation, which sliced strings.
+#
+# Usage: bench_freeciv.py [CAPTURE_FILE] [-c RECV_SIZE] [-v MAJOR.MINOR] [-s SCALE]
+#
+# CAPTURE_FILE should contain the raw data sent by a server to a client over
+# the course of joining a game, as saved for example by `tcpflow'. If it is not
+# given, a stream resembling the start of a large game is generated instead,
+# with its number of packets multiplied by SCALE.
+# The data is divided into pieces of RECV_SIZE bytes, as if received from a
+# socket, and the version is used to determine the size of packet types.
+# The `selective' run yields only those packets in freeciv.RECV_INTEREST, as
+# for a connection not in debug mode, while the others yield every packet.
+
+from __future__ import print_function
+
+from itertools import *
+import argparse
+import os.path
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path[:0] = [
+    os.path.join(os.path.dirname(__file__), '../ameliabot'),
+    os.path.join(os.path.dirname(__file__), '../lib'),
+    os.path.join(os.path.dirname(__file__), '../page')]
+
+import freeciv
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture_file', nargs='?')
+    parser.add_argument('-c', '--recv-size', type=int, default=freeciv.RECV_SIZE)
+    parser.add_argument('-v', '--version', default='2.6')
+    parser.add_argument('-s', '--scale', type=int, default=1)
+    args = parser.parse_args()
+
+    version = freeciv.Version(*map(int, args.version.split('.')) + [0])
+    if args.capture_file is not None:
+        with open(args.capture_file, 'rb') as file:
+            stream = file.read()
+    else:
+        stream = generate_stream(version, args.scale)
+    pieces = [stream[i:i+args.recv_size]
+              for i in xrange(0, len(stream), args.recv_size)]
+
+    print('%d bytes in %d pieces of up to %d bytes.' % (
+        len(stream), len(pieces), args.recv_size))
+    for name, func, debug in (('selective', run_current, False),
+                              ('current', run_current, True),
+                              ('previous', run_previous, True)):
+        state = freeciv.FreecivState(name='bench')
+        state.stage, state.version = freeciv.STAGE_LOADED, version
+        state.debug = debug
+        start = time.time()
+        count, total = func(state, pieces)
+        elapsed = time.time() - start
+        print('%-9s: %d packets (%d bytes) in %.3fs: %.1f MB/s.' % (
+            name, count, total, elapsed, len(stream)/elapsed/1e6))
+
+def run_current(state, pieces):
+    count, total = 0, 0
+    for piece in pieces:
+        state.recv_buf.append(piece)
+        for ptype, pdata in freeciv.read_packets(state):
+            count, total = count + 1, total + len(pdata)
+    return count, total
+
+# The implementation of freeciv.h_buffer prior to the use of framing.Buffer.
+def run_previous(state, pieces):
+    count, total, stack = 0, 0, ''
+    state.chunk_buf = ''
+    for piece in pieces:
+        data = stack + piece
+        while data:
+            if state.chunk_rem:
+                chunk, data = data[:state.chunk_rem], data[state.chunk_rem:]
+                state.chunk_buf += state.decompress_obj.decompress(chunk)
+                state.chunk_rem -= len(chunk)
+                if state.chunk_rem: break
+                state.chunk_buf += state.decompress_obj.flush()
+                del state.decompress_obj
+            if len(data) < 2: break
+            length, = struct.unpack('!H', data[:2])
+            if length > freeciv.COMPRESSION_BORDER:
+                if length == freeciv.JUMBO_SIZE:
+                    if len(data) < 6: break
+                    state.chunk_rem = struct.unpack('!I', data[2:6])[0] - 6
+                    data = data[6:]
+                else:
+                    state.chunk_rem = length - freeciv.COMPRESSION_BORDER - 2
+                    data = data[2:]
+                state.decompress_obj = zlib.decompressobj()
+                continue
+            # This check was missing, so that packets divided between pieces
+            # were misread, as the benchmark shows if it is removed.
+            if len(data) < length: break
+            state.chunk_buf += data[:length]
+            data = data[length:]
+        stack = data
+
+        while len(state.chunk_buf) >= 2:
+            length, = struct.unpack('!H', state.chunk_buf[:2])
+            if len(state.chunk_buf) < length: break
+            pdata, state.chunk_buf = \
+                state.chunk_buf[2:length], state.chunk_buf[length:]
+            if state.version[:2] <= (2, 6):
+                ptype, pdata = struct.unpack('!B', pdata[:1]) + (pdata[1:],)
+            else:
+                ptype, pdata = struct.unpack('!H', pdata[:2]) + (pdata[2:],)
+            count, total = count + 1, total + len(pdata)
+    return count, total
+
+# Returns a stream consisting mostly of small packets, as sent by a server when
+# a client joins a game with a large map, grouped into compressed chunks, one of
+# which is large enough to be sent as a "jumbo" chunk.
+def generate_stream(version, scale=1, seed=0):
+    rand = random.Random(seed)
+    type_format = '!B' if version[:2] <= (2, 6) else '!H'
+    def packet(ptype, size):
+        data = struct.pack(type_format, ptype) + ''.join(
+            chr(rand.choice((0, 0, 0, 1, 2, rand.randrange(256))))
+            for i in xrange(size))
+        return struct.pack('!H', len(data) + 2) + data
+    def compressed(data):
+        data = zlib.compress(data)
+        if len(data) + 2 < freeciv.JUMBO_SIZE - freeciv.COMPRESSION_BORDER:
+            return struct.pack('!H',
+                len(data) + 2 + freeciv.COMPRESSION_BORDER) + data
+        return struct.pack('!HI', freeciv.JUMBO_SIZE, len(data) + 6) + data
+
+    stream = [packet(5, 100), packet(25, 400)]
+    for chunk_packets in 200, 200, 20000, 500, 500, 500:
+        stream.append(compressed(''.join(
+            packet(rand.choice((15, 31, 62, 63)), rand.randrange(10, 60))
+            for i in xrange(chunk_packets * scale))))
+        stream.extend(packet(88, 8) for i in xrange(10))
+    return ''.join(stream)
+
+if __name__ == '__main__':
+    main()